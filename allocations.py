@@ -0,0 +1,191 @@
+# Traffic allocations of many experiments at once. The bucket ranges of a
+# set of experiments are packed into flat arrays (the experiment each range
+# belongs to, the variation key it buckets into, and where it ends), and
+# per-variation shares, traffic and the comparison between two configs are
+# computed over whole arrays rather than experiment by experiment.
+#
+# Shares are in hundredths of a percent, and compare the same way as the
+# summaries from differ.TrafficAllocation: by variation key, leaving out
+# empty shares. NumPy is used if it's installed and there are enough
+# ranges to be worth its per-call overhead; otherwise the same arrays are
+# summed in a loop.
+from array import array
+from itertools import repeat
+
+
+FULL = 100 * 100
+
+# Variation code of ranges that don't bucket into any variation.
+NOT_BUCKETED = -1
+
+# Changes in traffic of at most this much are taken to be rebalancing
+# after variations were added or removed, rather than a change in traffic.
+EPSILON = 10
+
+# Below this many ranges, the loop is faster than NumPy.
+NUMPY_MIN_RANGES = 2000
+
+_numpy = {}
+
+
+def numpy():
+    # NumPy is slow to import, so only on first use. None if it isn't
+    # installed.
+    if 'module' not in _numpy:
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        _numpy['module'] = np
+    return _numpy['module']
+
+
+class AllocationTable(object):
+    def __init__(self, experiments, ids, keys):
+        # experiments maps ids to raw experiment dicts, of which those in
+        # `ids` are packed in that order. keys maps variation keys to
+        # codes, and is shared between the tables being compared.
+        self.ids = ids
+        self.experiment = array('l')
+        self.variation = array('l')
+        self.end = array('l')
+
+        for n, i in enumerate(ids):
+            e = experiments[i]
+            codes = {'': NOT_BUCKETED}
+            for v in e['variations']:
+                code = keys.get(v['key'])
+                if code is None:
+                    code = keys[v['key']] = len(keys)
+                codes[v['id']] = code
+
+            ranges = e['trafficAllocation']
+            try:
+                self.variation.extend([codes[a['entityId']] for a in ranges])
+            except KeyError:
+                # Ranges for variations the experiment doesn't have are
+                # keyed by their id.
+                for a in ranges:
+                    vid = a['entityId']
+                    if vid not in codes:
+                        codes[vid] = keys.setdefault(vid, len(keys))
+                self.variation.extend([codes[a['entityId']] for a in ranges])
+            self.end.extend([a['endOfRange'] for a in ranges])
+            self.experiment.extend(repeat(n, len(ranges)))
+
+    def __len__(self):
+        return len(self.end)
+
+    def shares(self):
+        # ({(experiment index, variation code): share}, [traffic]) with
+        # only the non-empty shares.
+        totals = {}
+        traffic = [0] * len(self.ids)
+        last = -1
+        start = 0
+        for n, code, stop in zip(self.experiment, self.variation, self.end):
+            if n != last:
+                last = n
+                start = 0
+            if code != NOT_BUCKETED:
+                width = stop - start
+                totals[n, code] = totals.get((n, code), 0) + width
+                traffic[n] += width
+            start = stop
+        return ({ k: v for k, v in totals.items() if v > 0 },
+                [min(t, FULL) for t in traffic])
+
+    def numpy_shares(self, np, codes):
+        # The same as shares(), as arrays: the (experiment index * codes +
+        # variation code) and share of each non-empty share, sorted, and
+        # the traffic of every experiment.
+        experiment = np.frombuffer(self.experiment, dtype='l')
+        variation = np.frombuffer(self.variation, dtype='l')
+        end = np.frombuffer(self.end, dtype='l')
+
+        # Each range starts where the one before it in the same experiment
+        # ended, or at 0.
+        start = np.zeros_like(end)
+        if len(end):
+            start[1:] = end[:-1]
+            start[1:][experiment[1:] != experiment[:-1]] = 0
+        width = end - start
+
+        bucketed = variation != NOT_BUCKETED
+        experiment = experiment[bucketed]
+        width = width[bucketed]
+        traffic = np.minimum(np.bincount(
+            experiment, weights=width, minlength=len(self.ids)), FULL)
+
+        pairs, inverse = np.unique(experiment * codes + variation[bucketed],
+                                   return_inverse=True)
+        totals = np.bincount(inverse, weights=width, minlength=len(pairs))
+        keep = totals > 0
+        return (pairs[keep], totals[keep].astype('l'),
+                traffic.astype('l'))
+
+
+def traffic(experiment):
+    # The share of traffic bucketed into any variation.
+    total = 0
+    start = 0
+    for a in experiment['trafficAllocation']:
+        if a['entityId']:
+            total += a['endOfRange'] - start
+        start = a['endOfRange']
+    return min(total, FULL)
+
+
+def classify(old_traffic, traffic):
+    if traffic - old_traffic > EPSILON:
+        return 'traffic_increased'
+    elif traffic - old_traffic < -EPSILON:
+        return 'traffic_decreased'
+    return 'weighting_changed'
+
+
+def compare(old_experiments, current_experiments, ids, backend=None):
+    # For the experiments `ids`, which must be in both configs, returns
+    # (id, kind, old traffic, traffic) for each whose allocation changed,
+    # in the order of `ids`. kind is 'traffic_increased',
+    # 'traffic_decreased' or 'weighting_changed'. backend is 'numpy' or
+    # 'array', or None to pick one.
+    ids = list(ids)
+    keys = {}
+    old = AllocationTable(old_experiments, ids, keys)
+    current = AllocationTable(current_experiments, ids, keys)
+
+    if backend is None:
+        big = len(old) + len(current) >= NUMPY_MIN_RANGES
+        backend = 'numpy' if big and numpy() is not None else 'array'
+    if backend == 'numpy':
+        return compare_numpy(numpy(), old, current, max(len(keys), 1))
+
+    shares0, traffic0 = old.shares()
+    shares1, traffic1 = current.shares()
+    changed = sorted({ n for (n, _), _ in
+                       set(shares0.items()) ^ set(shares1.items()) })
+    return [(ids[n], classify(traffic0[n], traffic1[n]), traffic0[n],
+             traffic1[n]) for n in changed]
+
+
+def compare_numpy(np, old, current, codes):
+    pairs0, totals0, traffic0 = old.numpy_shares(np, codes)
+    pairs1, totals1, traffic1 = current.numpy_shares(np, codes)
+
+    # Pairs are sorted and appear once per table. An experiment changed if
+    # one of its pairs is only in one table, or has a different share.
+    _, in0, in1 = np.intersect1d(pairs0, pairs1, assume_unique=True,
+                                 return_indices=True)
+    changed = np.unique(np.concatenate([
+        np.setxor1d(pairs0, pairs1, assume_unique=True),
+        pairs0[in0[totals0[in0] != totals1[in1]]],
+    ]) // codes)
+
+    delta = traffic1[changed] - traffic0[changed]
+    kinds = np.where(delta > EPSILON, 0, np.where(delta < -EPSILON, 1, 2))
+    names = ('traffic_increased', 'traffic_decreased', 'weighting_changed')
+    ids = old.ids
+    return [(ids[n], names[k], t0, t1) for n, k, t0, t1 in zip(
+        changed.tolist(), kinds.tolist(), traffic0[changed].tolist(),
+        traffic1[changed].tolist())]
@@ -0,0 +1,94 @@
+# Compares finding the experiments whose traffic allocation changed one
+# experiment at a time (traffic_change, as the differ used to) against the
+# bulk engine in allocations.py, with and without NumPy.
+# Every experiment in both revisions is compared, not just the modified
+# ones, so this is the worst case for each.
+#
+#   python -m bench.bench_allocations --experiments 10000 --output allocations.json
+import allocations
+import argparse
+from bench.harness import measure, write_results, print_table
+from bench.synthetic import generate_datafile, mutate
+from differ import DatafileDiffer
+
+
+def traffic_change(differ, experiment_id):
+    # How the differ compared one experiment's allocation summaries, as
+    # (id, kind, old traffic, traffic), or None if they're the same.
+    prev_alloc = differ.old_allocation.summarize(experiment_id)
+    curr_alloc = differ.current_allocation.summarize(experiment_id)
+    if prev_alloc == curr_alloc:
+        return None
+
+    curr_traffic = allocations.FULL - curr_alloc.get('not bucketed', 0)
+    prev_traffic = allocations.FULL - prev_alloc.get('not bucketed', 0)
+    return (experiment_id, allocations.classify(prev_traffic, curr_traffic),
+            prev_traffic, curr_traffic)
+
+
+def per_experiment(differ, ids):
+    return [c for c in (traffic_change(differ, i) for i in ids) if c]
+
+
+def retained_ids(differ):
+    return sorted(differ.old_experiment_map.keys() &
+                  differ.current_experiment_map.keys())
+
+
+def run(params, repeat):
+    old = generate_datafile(
+        experiments=params['experiments'],
+        variations=params['variations'],
+        events=0,
+        seed=params['seed'])
+    current = mutate(old, density=params['density'], seed=params['seed'] + 1)
+
+    def fresh():
+        # Summaries are memoized per differ.
+        return DatafileDiffer(old, current)
+
+    d = fresh()
+    ids = retained_ids(d)
+    fields = {'compared': len(ids),
+              'changed': len(allocations.compare(
+                  d.old_experiment_map, d.current_experiment_map, ids))}
+
+    results = [measure('per_experiment', lambda d: per_experiment(d, ids),
+                       setup=fresh, repeat=repeat, **fields)]
+    backends = ['array']
+    if allocations.numpy() is not None:
+        backends.append('numpy')
+    for backend in backends:
+        results.append(measure(
+            'bulk/%s' % backend, lambda d: allocations.compare(
+                d.old_experiment_map, d.current_experiment_map, ids,
+                backend=backend),
+            setup=fresh, repeat=repeat, **fields))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--experiments', type=int, default=10000)
+    parser.add_argument('--variations', type=int, default=3)
+    parser.add_argument('--density', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='-',
+                        help='where to write JSON results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    params = {
+        'experiments': args.experiments,
+        'variations': args.variations,
+        'density': args.density,
+        'seed': args.seed,
+    }
+    results = run(params, args.repeat)
+    write_results(args.output, 'allocations', params, results)
+    if args.output != '-':
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
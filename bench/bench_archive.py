@@ -0,0 +1,131 @@
+# Compares the full and delta archive formats: bytes stored for a history
+# of revisions, and the time to rebuild a revision from the archive.
+#
+# The history is the fixtures under data/ (each pair as a revision and the
+# one after it) followed by synthetic revisions of a large datafile, so
+# both realistic small edits and large datafiles are covered.
+#
+#   python -m bench.bench_archive --revisions 200 --output archive.json
+import argparse
+from bench.harness import measure, write_results, print_table
+from bench.synthetic import generate_datafile, mutate
+import deltas
+import json
+import os
+
+
+def fixture_history(root='data'):
+    history = []
+    for name in sorted(os.listdir(root)):
+        for n in (0, 1):
+            with open(os.path.join(root, name, '%d.json' % n), 'r') as f:
+                history.append(json.loads(f.read()))
+    return history
+
+
+def synthetic_history(params):
+    d = generate_datafile(
+        experiments=params['experiments'],
+        events=params['events'],
+        seed=params['seed'])
+    history = [d]
+    for i in range(params['revisions'] - 1):
+        d = mutate(d, density=params['density'], seed=params['seed'] + i + 1)
+        history.append(d)
+    return history
+
+
+def archive(history, interval, max_ratio=0.5):
+    # Archives `history` the way main.save_datafile does, returning
+    # {path: bytes}. interval=1 is the full format.
+    objects = {}
+    base = None
+    for i, d in enumerate(history):
+        content = json.dumps(d).encode('utf-8')
+        path = 'datafile/1/%d/a.json' % i
+        data = None
+        if base and base[2] + 1 < interval:
+            data = deltas.encode(base[0], 1, deltas.make_patch(base[1], d))
+            if len(data) > max_ratio * len(content):
+                data = None
+        if data is None:
+            objects[path] = content
+            base = (path, d, 0)
+        else:
+            objects[path + deltas.DELTA_SUFFIX] = data
+            base = (base[0], base[1], base[2] + 1)
+    return objects
+
+
+def run(name, history, intervals, repeat):
+    results = []
+    full = sum(len(json.dumps(d).encode('utf-8')) for d in history)
+    for interval in intervals:
+        objects = archive(history, interval)
+        stored = sum(len(v) for v in objects.values())
+        paths = sorted(objects, key=lambda p: int(p.split('/')[2]))
+        fields = {
+            'history': name,
+            'interval': interval,
+            'revisions': len(history),
+            'stored_bytes': stored,
+            'full_bytes': full,
+            'ratio': stored / full,
+        }
+        results.append(measure(
+            '%s/read_latest/interval=%d' % (name, interval),
+            lambda: deltas.read_revision(objects.__getitem__, paths[-1]),
+            repeat=repeat, **fields))
+
+        # Replaying reuses each parsed snapshot for the deltas against it.
+        def read_all():
+            snapshots = {}
+            return [deltas.read_revision(objects.__getitem__, p, snapshots)
+                    for p in paths]
+
+        results.append(measure(
+            '%s/read_all/interval=%d' % (name, interval), read_all,
+            repeat=repeat, memory=False, **fields))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--experiments', type=int, default=2000)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--revisions', type=int, default=100)
+    parser.add_argument('--density', type=float, default=0.002,
+                        help='fraction of experiments and events changed '
+                             'per revision')
+    parser.add_argument('--interval', type=int, action='append',
+                        help='snapshot interval(s) to compare (default: '
+                             '1, 10, 50)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='-',
+                        help='where to write JSON results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    params = {
+        'experiments': args.experiments,
+        'events': args.events,
+        'revisions': args.revisions,
+        'density': args.density,
+        'seed': args.seed,
+    }
+    intervals = args.interval or [1, 10, 50]
+    results = (run('fixtures', fixture_history(), intervals, args.repeat) +
+               run('synthetic', synthetic_history(params), intervals,
+                   args.repeat))
+    write_results(args.output, 'archive', params, results)
+    if args.output != '-':
+        print_table(results)
+        for r in results:
+            if r['name'].endswith('read_latest/interval=%d' % r['interval']):
+                print('%-10s interval=%-3d %12d B stored (%.1f%% of full)' % (
+                    r['history'], r['interval'], r['stored_bytes'],
+                    100 * r['ratio']))
+
+
+if __name__ == '__main__':
+    main()
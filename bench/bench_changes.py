@@ -0,0 +1,81 @@
+# Benchmarks detecting, sorting and rendering very large change sets, such
+# as every experiment in a project being paused at once.
+#
+#   python -m bench.bench_changes --experiments 10000 --output changes.json
+import argparse
+from bench.harness import measure, write_results, print_table
+from bench.synthetic import generate_datafile, mutate
+import copy
+from differ import DatafileDiffer, render, render_json
+
+
+def scenarios(params):
+    full = generate_datafile(
+        experiments=params['experiments'],
+        variations=params['variations'],
+        events=params['events'],
+        seed=params['seed'])
+    paused = copy.deepcopy(full)
+    paused['experiments'] = []
+    for ev in paused['events']:
+        ev['experimentIds'] = []
+
+    return [
+        ('mass_pause', full, paused),
+        ('mass_enable', paused, full),
+        ('mutate', full, mutate(full, density=1, seed=params['seed'] + 1)),
+    ]
+
+
+def run(params, repeat):
+    results = []
+    for name, old, current in scenarios(params):
+        def fresh():
+            return DatafileDiffer(old, current)
+
+        # Changes render their text on first use, so each render gets
+        # freshly detected ones.
+        def detected():
+            return fresh().changes()
+
+        fields = {'scenario': name, 'changes': len(detected())}
+        results.append(measure(
+            '%s/changes' % name, lambda d: d.changes(),
+            setup=fresh, repeat=repeat, **fields))
+        results.append(measure(
+            '%s/render' % name, render,
+            setup=detected, repeat=repeat, **fields))
+        results.append(measure(
+            '%s/render_json' % name, render_json,
+            setup=detected, repeat=repeat, **fields))
+        results.append(measure(
+            '%s/describe' % name, lambda d: d.describe(),
+            setup=fresh, repeat=repeat, **fields))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--experiments', type=int, default=10000)
+    parser.add_argument('--variations', type=int, default=3)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='-',
+                        help='where to write JSON results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    params = {
+        'experiments': args.experiments,
+        'variations': args.variations,
+        'events': args.events,
+        'seed': args.seed,
+    }
+    results = run(params, args.repeat)
+    write_results(args.output, 'changes', params, results)
+    if args.output != '-':
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
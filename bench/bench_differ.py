@@ -0,0 +1,99 @@
+# Benchmarks differ.DatafileDiffer over synthetic datafiles.
+#
+#   python -m bench.bench_differ --experiments 2000 --events 2000 \
+#       --density 0.01 --output differ.json
+#   python -m bench.bench_differ --compare before.json after.json
+import argparse
+from bench.harness import measure, write_results, compare, print_table
+from bench.synthetic import generate_datafile, mutate
+from differ import DatafileDiffer, ENGINES
+
+
+def detectors(d):
+    return sorted(name for name in dir(d) if name.startswith('detect_'))
+
+
+def run(params, engines, repeat):
+    old = generate_datafile(
+        experiments=params['experiments'],
+        variations=params['variations'],
+        events=params['events'],
+        groups=params['groups'],
+        features=params['features'],
+        seed=params['seed'])
+    current = mutate(old, density=params['density'], seed=params['seed'] + 1)
+
+    results = []
+    for engine in engines:
+        results.append(measure(
+            'construct/%s' % engine,
+            lambda: DatafileDiffer(old, current, engine),
+            repeat=repeat, engine=engine))
+
+        # Detectors may cache on the differ, so each run gets a fresh one,
+        # built outside the timed section.
+        def fresh():
+            return DatafileDiffer(old, current, engine)
+
+        d = fresh()
+        for name in detectors(d):
+            results.append(measure(
+                '%s/%s' % (name, engine),
+                lambda differ, name=name: list(getattr(differ, name)()),
+                setup=fresh, repeat=repeat, engine=engine))
+
+        ids = [e['id'] for e in current['experiments']]
+        results.append(measure(
+            'summarize_allocation/%s' % engine,
+            lambda differ: [differ.current_allocation.summarize(i) for i in ids],
+            setup=fresh, repeat=repeat, engine=engine, experiments=len(ids)))
+
+        results.append(measure(
+            'describe/%s' % engine,
+            lambda differ: differ.describe(),
+            setup=fresh, repeat=repeat, engine=engine,
+            changes=len(d.describe().split('\n'))))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--experiments', type=int, default=1000)
+    parser.add_argument('--variations', type=int, default=3)
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=0)
+    parser.add_argument('--features', type=int, default=0)
+    parser.add_argument('--density', type=float, default=0.01,
+                        help='fraction of each kind of entity changed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES),
+                        help='engine(s) to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='-',
+                        help='where to write JSON results (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    params = {
+        'experiments': args.experiments,
+        'variations': args.variations,
+        'events': args.events,
+        'groups': args.groups,
+        'features': args.features,
+        'density': args.density,
+        'seed': args.seed,
+    }
+    results = run(params, args.engine or sorted(ENGINES), args.repeat)
+    write_results(args.output, 'differ', params, results)
+    if args.output != '-':
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
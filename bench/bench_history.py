@@ -0,0 +1,132 @@
+# Fills a change history database with synthetic changes, then times the
+# queries `main.py history` makes: one experiment's or event's history by
+# id or key, one kind of change, and the latest changes in a project.
+#
+#   python -m bench.bench_history --rows 1000000 --output history.json
+import argparse
+from bench.harness import measure, write_results, print_table
+from differ import Change
+from history import ChangeHistory
+import os
+import random
+import shutil
+import tempfile
+import time
+
+
+EXPERIMENT_KINDS = ['experiment_enabled', 'experiment_paused',
+                    'experiment_renamed', 'traffic_increased',
+                    'traffic_decreased', 'weighting_changed']
+
+EVENT_KINDS = ['event_live', 'event_dead', 'event_renamed']
+
+
+def change(rng, params):
+    if rng.random() < 0.7:
+        n = rng.randrange(params['experiments'])
+        kind = rng.choice(EXPERIMENT_KINDS)
+        key = 'experiment-%d' % n
+        fields = {'key': key}
+        if kind == 'experiment_renamed':
+            fields['old_key'] = key + '-old'
+        elif kind in ('experiment_enabled', 'weighting_changed'):
+            fields['allocation'] = {'a': 5000, 'b': 5000}
+            if kind == 'weighting_changed':
+                fields['old_allocation'] = {'a': 2500, 'b': 7500}
+        elif kind.startswith('traffic'):
+            fields.update(old_traffic=1000, traffic=5000,
+                          allocation={'a': 2500, 'b': 2500,
+                                      'not bucketed': 5000})
+        return Change(kind=kind, entity_id=str(10 ** 10 + n), **fields)
+
+    n = rng.randrange(params['events'])
+    kind = rng.choice(EVENT_KINDS)
+    fields = {'key': 'event-%d' % n}
+    if kind == 'event_renamed':
+        fields['old_key'] = 'event-%d-old' % n
+    return Change(kind=kind, entity_id=str(2 * 10 ** 10 + n), **fields)
+
+
+def fill(store, params):
+    # One webhook per `per_revision` changes, spread over the projects.
+    rng = random.Random(params['seed'])
+    timestamp = 1500000000
+    written = 0
+    while written < params['rows']:
+        timestamp += 60
+        changes = [change(rng, params) for _ in range(params['per_revision'])]
+        store.record(rng.randrange(params['projects']), timestamp, changes,
+                     str(timestamp))
+        written += len(changes)
+    return written
+
+
+def run(params, repeat, root):
+    path = os.path.join(root, 'history.db')
+    store = ChangeHistory(path)
+    start = time.perf_counter()
+    rows = fill(store, params)
+    fill_s = time.perf_counter() - start
+    size = os.path.getsize(path)
+
+    queries = [
+        ('experiment_by_id', {'entity_id': str(10 ** 10 + 7)}),
+        ('experiment_by_key', {'key': 'experiment-7', 'entity': 'experiment'}),
+        ('experiment_by_old_key', {'key': 'experiment-7-old',
+                                   'entity': 'experiment'}),
+        ('event_by_key', {'key': 'event-3', 'entity': 'event'}),
+        ('kind', {'kinds': ['experiment_paused']}),
+        ('latest', {}),
+        ('last_month', {'since': 1500000000 + 60 * rows // params['per_revision']
+                                 - 30 * 86400}),
+    ]
+    results = [{'name': 'fill', 'wall_s': fill_s, 'rows': rows,
+                'rows_per_s': rows / fill_s, 'bytes': size}]
+    for name, kwargs in queries:
+        found = len(store.query(0, limit=params['limit'], **kwargs))
+        results.append(measure(
+            'query/%s' % name,
+            lambda: store.query(0, limit=params['limit'], **kwargs),
+            repeat=repeat, memory=False, found=found))
+    store.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--projects', type=int, default=4)
+    parser.add_argument('--experiments', type=int, default=5000)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--per-revision', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dir', help='where to put the database and keep it '
+                        '(default: a temporary directory)')
+    parser.add_argument('--output', default='-',
+                        help='where to write JSON results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    params = {
+        'rows': args.rows,
+        'projects': args.projects,
+        'experiments': args.experiments,
+        'events': args.events,
+        'per_revision': args.per_revision,
+        'limit': args.limit,
+        'seed': args.seed,
+    }
+    root = args.dir or tempfile.mkdtemp(prefix='bench-history-')
+    try:
+        results = run(params, args.repeat, root)
+    finally:
+        if not args.dir:
+            shutil.rmtree(root)
+    write_results(args.output, 'history', params, results)
+    if args.output != '-':
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
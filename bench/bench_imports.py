@@ -0,0 +1,148 @@
+# Measures the cold-start cost of the webhook for each kind of request:
+# a fresh interpreter imports main and handles one webhook, under
+# `python -X importtime`. Reports the time spent importing, how many
+# modules were loaded, and which of the heavy dependencies were pulled in.
+#
+# Storage and the CDN are faked in-process (after main is imported), the
+# same way for every scenario, so the storage client is only imported by
+# the scenarios whose code path would import it anyway.
+#
+#   python -m bench.bench_imports --output imports.json
+import argparse
+from bench.harness import write_results
+import os
+import subprocess
+import sys
+import time
+
+
+HEAVY = ['google.cloud.storage', 'requests', 'flask', 'optimizely', 'jsonschema']
+
+SCENARIOS = ['import', 'rejected', 'snippet_updated', 'datafile_updated']
+
+SCRIPT = r'''
+import main
+from hashlib import sha1
+import hmac
+import json
+import sys
+
+scenario = sys.argv[1]
+
+class Request(object):
+    def __init__(self, payload, signature=None):
+        self.json = payload
+        self.data = json.dumps(payload).encode('utf-8')
+        self.headers = {'X-Hub-Signature': signature or 'sha1=' + hmac.new(
+            b'foo', msg=self.data, digestmod=sha1).hexdigest()}
+
+    def get_data(self):
+        return self.data
+
+def datafile_payload(timestamp):
+    url = 'https://cdn.optimizely.com/datafiles/abc.json'
+    return {'event': 'project.datafile_updated', 'project_id': 1,
+            'timestamp': timestamp,
+            'data': {'cdn_url': url, 'origin_url': url,
+                     'environment': 'Production'}}
+
+if scenario == 'rejected':
+    try:
+        main.webhook_post(Request({'event': 'project.snippet_updated'}, 'sha1=x'))
+    except Exception as e:
+        assert getattr(e, 'code', None) == 400, e
+elif scenario == 'snippet_updated':
+    main.webhook_post(Request({'event': 'project.snippet_updated',
+                               'project_id': 1}))
+elif scenario == 'datafile_updated':
+    from fake_gcs import FakeClient
+    from google.cloud import storage
+    import requests
+    client = FakeClient()
+    storage.Client = lambda: client
+    with open('data/experiment-renamed/0.json', 'rb') as f:
+        old = f.read()
+    with open('data/experiment-renamed/1.json', 'rb') as f:
+        new = f.read()
+    bucket = client.bucket('bench')
+    archived = bucket.put('datafile/1/1/abc.json', old)
+    bucket.put('datafile/1/_latest/pointer.json', json.dumps({
+        'path': archived.name, 'generation': archived.generation,
+        'sha256': 'x', 'timestamp': 1}))
+
+    class Response(object):
+        content = new
+        def raise_for_status(self):
+            pass
+    requests.Session.get = lambda self, url, **kwargs: Response()
+    main.webhook_post(Request(datafile_payload(2)))
+'''
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:   self |  cumulative | name", where
+    # nesting is shown by indenting the name.
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def run_scenario(scenario):
+    env = dict(os.environ,
+               OPTIMIZELY_WEBHOOK_SECRET='foo',
+               GCS_BUCKET_NAME='bench',
+               PYTHONPATH=os.getcwd())
+    env.pop('SLACK_URL', None)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT, scenario],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    wall = time.perf_counter() - start
+
+    modules = parse_importtime(proc.stderr)
+    return {
+        'name': scenario,
+        'wall_s': wall,
+        'import_us': sum(s for s, _ in modules.values()),
+        'main_us': modules.get('main', (0, 0))[1],
+        'modules': len(modules),
+        'heavy': [h for h in HEAVY if h in modules],
+    }
+
+
+def run(scenarios, repeat):
+    # Best of `repeat` fresh interpreters per scenario.
+    results = []
+    for scenario in scenarios:
+        runs = [run_scenario(scenario) for _ in range(repeat)]
+        best = min(runs, key=lambda r: r['import_us'])
+        best['wall_s'] = min(r['wall_s'] for r in runs)
+        results.append(best)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario(s) to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='-',
+                        help='where to write JSON results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    results = run(args.scenario or SCENARIOS, args.repeat)
+    write_results(args.output, 'imports', {'repeat': args.repeat}, results)
+    if args.output != '-':
+        for r in results:
+            print('%-20s %8.1fms importing (%3d modules; main %6.1fms) %s' % (
+                r['name'], r['import_us'] / 1000, r['modules'],
+                r['main_us'] / 1000, ', '.join(r['heavy']) or '-'))
+
+
+if __name__ == '__main__':
+    main()
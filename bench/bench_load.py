@@ -0,0 +1,236 @@
+# Load test: runs webhook_post end to end, from signature check to
+# archiving and diffing, at a high request rate against the local storage
+# backend (LOCAL_STORAGE_DIR). The CDN is faked in-process, serving a
+# synthetic history of revisions for each project, so the numbers cover
+# everything but the network.
+#
+# Requests go round-robin over the projects, one revision of each at a
+# time, from `--concurrency` threads, optionally paced at `--rate`
+# requests per second. Afterwards, each project's latest pointer must name
+# its last revision.
+#
+#   python -m bench.bench_load --projects 20 --revisions 25 --concurrency 16
+import argparse
+from bench.harness import write_results
+from bench.synthetic import generate_datafile, mutate
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1, sha256
+import hmac
+import json
+import logging
+from local_storage import LocalBucket
+import main as function
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracing
+from unittest.mock import patch
+
+
+SECRET = 'load-test'
+
+STAGES = ['verify_request', 'load_latest', 'fetch_datafile', 'save_datafile',
+          'publish_latest', 'diff']
+
+
+class Request(object):
+    def __init__(self, payload):
+        self.json = payload
+        self.data = json.dumps(payload).encode('utf-8')
+        self.headers = {'X-Hub-Signature': 'sha1=' + hmac.new(
+            SECRET.encode('utf-8'), msg=self.data, digestmod=sha1).hexdigest()}
+
+    def get_data(self):
+        return self.data
+
+
+class Response(object):
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class CDN(object):
+    # Stands in for the requests session, serving datafiles by URL.
+    def __init__(self, datafiles):
+        self.datafiles = datafiles
+
+    def get(self, url, **kwargs):
+        return Response(self.datafiles[url])
+
+
+def datafile_url(project_id, revision):
+    # Only the path ends up in the archive, so the revision can go in the
+    # query string.
+    return 'https://cdn.optimizely.com/datafiles/%s.json?revision=%d' % (
+        project_id, revision)
+
+
+def payload(project_id, revision):
+    url = datafile_url(project_id, revision)
+    return {
+        'event': 'project.datafile_updated',
+        'project_id': project_id,
+        'timestamp': revision + 1,
+        'data': {'cdn_url': url, 'origin_url': url,
+                 'environment': 'Production', 'revision': revision},
+    }
+
+
+def history(params):
+    # {url: datafile bytes} for every project and revision.
+    datafiles = {}
+    for p in range(params['projects']):
+        project_id = 1000 + p
+        d = generate_datafile(experiments=params['experiments'],
+                              events=params['events'], seed=p)
+        for r in range(params['revisions']):
+            if r:
+                d = mutate(d, density=params['density'], seed=p * 1000 + r)
+            datafiles[datafile_url(project_id, r)] = json.dumps(d).encode('utf-8')
+    return datafiles
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[int(round(q * (len(values) - 1)))]
+
+
+def verify(root, params, datafiles):
+    # Returns the ids of projects whose latest pointer isn't at their last
+    # revision.
+    bucket = LocalBucket(root)
+    last = params['revisions'] - 1
+    wrong = []
+    for p in range(params['projects']):
+        project_id = 1000 + p
+        pointer = bucket.get_blob(function.latest_pointer_gcs_path(
+            {'project_id': project_id}))
+        expected = sha256(datafiles[datafile_url(project_id, last)]).hexdigest()
+        if pointer is None or json.loads(
+                pointer.download_as_bytes())['sha256'] != expected:
+            wrong.append(project_id)
+    return wrong
+
+
+def run(params, root):
+    datafiles = history(params)
+    requests = [Request(payload(1000 + p, r))
+                for r in range(params['revisions'])
+                for p in range(params['projects'])]
+
+    env = {
+        'OPTIMIZELY_WEBHOOK_SECRET': SECRET,
+        'LOCAL_STORAGE_DIR': root,
+        'ARCHIVE_FORMAT': params['archive_format'],
+    }
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = None
+
+    def send(i):
+        if params['rate']:
+            delay = start + i / params['rate'] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        t = time.perf_counter()
+        try:
+            function.webhook_post(requests[i])
+        except Exception as e:
+            with lock:
+                errors.append(type(e).__name__)
+        finally:
+            elapsed = time.perf_counter() - t
+            with lock:
+                latencies.append(elapsed)
+
+    function.reset_gcs()
+    tracing.reset()
+    with patch.dict(os.environ, {k: v for k, v in env.items() if v}), \
+         patch.object(function, 'http_session', lambda: CDN(datafiles)), \
+         patch.object(function, 'slack_url', lambda: None):
+        with ThreadPoolExecutor(max_workers=params['concurrency']) as pool:
+            start = time.perf_counter()
+            list(pool.map(send, range(len(requests))))
+            wall = time.perf_counter() - start
+    function.reset_gcs()
+
+    latencies.sort()
+    stages = {}
+    for name in STAGES:
+        count, total, _ = tracing.totals(name)
+        stages[name] = round(total / count * 1000, 3) if count else None
+    return {
+        'name': 'webhook %d projects x %d revisions, %d threads' % (
+            params['projects'], params['revisions'], params['concurrency']),
+        'wall_s': wall,
+        'requests': len(requests),
+        'throughput_rps': len(requests) / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'errors': len(errors),
+        'error_types': sorted(set(errors)),
+        'stage_mean_ms': stages,
+        'stale_projects': verify(root, params, datafiles),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--revisions', type=int, default=25,
+                        help='webhooks per project')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='target requests per second (default: as fast as possible)')
+    parser.add_argument('--experiments', type=int, default=200)
+    parser.add_argument('--events', type=int, default=100)
+    parser.add_argument('--density', type=float, default=0.01)
+    parser.add_argument('--archive-format', choices=['full', 'delta'],
+                        default='full')
+    parser.add_argument('--dir', help='storage directory to use and keep '
+                        '(default: a temporary directory)')
+    parser.add_argument('--output', default='-',
+                        help='where to write JSON results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    # The function logs a few lines per webhook, which would swamp the
+    # results.
+    logging.disable(logging.INFO)
+    params = {
+        'projects': args.projects,
+        'revisions': args.revisions,
+        'concurrency': args.concurrency,
+        'rate': args.rate,
+        'experiments': args.experiments,
+        'events': args.events,
+        'density': args.density,
+        'archive_format': args.archive_format,
+    }
+    root = args.dir or tempfile.mkdtemp(prefix='bench-load-')
+    try:
+        result = run(params, root)
+    finally:
+        if not args.dir:
+            shutil.rmtree(root)
+
+    write_results(args.output, 'load', params, [result])
+    if args.output != '-':
+        print('%d requests in %.2fs: %.1f req/s, p50 %.1fms p95 %.1fms '
+              'p99 %.1fms, %d errors, %d stale projects' % (
+                  result['requests'], result['wall_s'],
+                  result['throughput_rps'], result['p50_ms'],
+                  result['p95_ms'], result['p99_ms'], result['errors'],
+                  len(result['stale_projects'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Benchmarks webhook signature verification as the number of configured
+# secrets grows, comparing a per-request loop over every secret with
+# signatures.WebhookVerifier with and without a project routing hint.
+#
+#   python -m bench.bench_signatures --secrets 1 10 100 --output sig.json
+import argparse
+from bench.harness import measure, write_results, print_table
+from hashlib import sha1
+import hmac
+import json
+from signatures import WebhookVerifier
+
+
+def naive_verify(secrets, body, signature):
+    # What verify_request did before WebhookVerifier.
+    for secret in secrets.split(','):
+        csig = 'sha1=' + hmac.new(
+            bytes(secret.strip(), 'utf-8'), msg=body, digestmod=sha1).hexdigest()
+        if csig == signature:
+            return True
+    return False
+
+
+def run(counts, body_bytes, iterations, repeat):
+    body = json.dumps({
+        'project_id': 1000,
+        'event': 'project.datafile_updated',
+        'data': {'padding': 'x' * body_bytes},
+    }).encode('utf-8')
+
+    results = []
+    for n in counts:
+        secrets = ['secret-%d' % i for i in range(n)]
+        # The worst case for a loop: the matching secret is the last one.
+        project_id = str(1000 + n - 1)
+        config = ','.join(secrets)
+        routed = ','.join('%d:%s' % (1000 + i, s) for i, s in enumerate(secrets))
+        signature = 'sha1=' + hmac.new(
+            secrets[-1].encode('utf-8'), msg=body, digestmod=sha1).hexdigest()
+
+        def loop(verify):
+            def run():
+                for _ in range(iterations):
+                    assert verify()
+            return run
+
+        plain = WebhookVerifier.from_config(config)
+        hinted = WebhookVerifier.from_config(routed)
+        cases = [
+            ('naive', lambda: naive_verify(config, body, signature)),
+            ('verifier', lambda: plain.verify(body, signature)),
+            ('verifier-routed', lambda: hinted.verify(body, signature, project_id)),
+        ]
+        for name, verify in cases:
+            r = measure('%s/%d' % (name, n), loop(verify), repeat=repeat,
+                        memory=False, secrets=n, iterations=iterations)
+            r['per_request_us'] = r['wall_s'] / iterations * 1e6
+            results.append(r)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--secrets', type=int, nargs='+',
+                        default=[1, 5, 20, 50, 200])
+    parser.add_argument('--body-bytes', type=int, default=1024)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args(argv)
+
+    params = {'secrets': args.secrets, 'body_bytes': args.body_bytes,
+              'iterations': args.iterations}
+    results = run(args.secrets, args.body_bytes, args.iterations, args.repeat)
+    write_results(args.output, 'signatures', params, results)
+    if args.output != '-':
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
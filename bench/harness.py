@@ -0,0 +1,103 @@
+# Shared plumbing for the benchmarks in this directory. Each benchmark
+# produces a list of result dicts, which are written as JSON along with
+# enough metadata to compare runs between revisions.
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(name, fn, repeat=5, memory=True, setup=None, **fields):
+    # Wall time is the best of `repeat` runs with tracing off. Peak memory
+    # and allocation counts come from one extra run under tracemalloc.
+    # `allocations` counts the memory blocks allocated during the call
+    # that were still alive at its end, including its return value.
+    # If `setup` is given, its result is passed to `fn` and its own cost
+    # isn't measured.
+    def call():
+        if setup is None:
+            return fn
+        arg = setup()
+        return lambda: fn(arg)
+
+    times = []
+    for _ in range(repeat):
+        f = call()
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+
+    result = {'name': name, 'wall_s': min(times), 'mean_s': sum(times) / len(times)}
+    result.update(fields)
+
+    if memory:
+        f = call()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            keep = f()
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        del keep
+
+        stats = after.compare_to(before, 'filename')
+        result['peak_bytes'] = peak
+        result['allocations'] = sum(max(s.count_diff, 0) for s in stats)
+
+    return result
+
+
+def write_results(path, benchmark, params, results):
+    doc = {
+        'benchmark': benchmark,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'params': params,
+        'results': results,
+    }
+    if path == '-':
+        json.dump(doc, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(path, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+    return doc
+
+
+def compare(old_path, new_path, out=sys.stdout):
+    with open(old_path) as f:
+        old = { r['name']: r for r in json.load(f)['results'] }
+    with open(new_path) as f:
+        new = json.load(f)['results']
+
+    for r in new:
+        o = old.get(r['name'])
+        if not o:
+            out.write('%-50s %10.6fs (new)\n' % (r['name'], r['wall_s']))
+            continue
+        out.write('%-50s %10.6fs -> %10.6fs (%.2fx)\n' % (
+            r['name'], o['wall_s'], r['wall_s'],
+            o['wall_s'] / r['wall_s'] if r['wall_s'] else float('inf')))
+
+
+def print_table(results, out=sys.stdout):
+    for r in results:
+        line = '%-50s %10.6fs' % (r['name'], r['wall_s'])
+        if 'peak_bytes' in r:
+            line += ' %12d B peak %10d allocs' % (r['peak_bytes'], r['allocations'])
+        out.write(line + '\n')
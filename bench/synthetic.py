@@ -0,0 +1,199 @@
+# Generates large, valid (v4) Optimizely datafiles, and revisions of them
+# with a controlled fraction of changes, for benchmarking the differ.
+import copy
+import random
+
+
+def ids(rng):
+    return str(rng.randrange(10 ** 10, 10 ** 11))
+
+
+def traffic_allocation(rng, variations, traffic=10000):
+    # Split `traffic` evenly over the variations, in a handful of ranges
+    # the way the Optimizely UI tends to produce them, and leave the rest
+    # not bucketed.
+    allocation = []
+    end = 0
+    share = traffic // max(len(variations), 1)
+    for v in variations:
+        stop = end + share
+        for _ in range(rng.randint(0, 2)):
+            end += max(share // 3, 1)
+            allocation.append({'entityId': v['id'], 'endOfRange': end})
+        end = stop
+        allocation.append({'entityId': v['id'], 'endOfRange': end})
+    if end < 10000:
+        allocation.append({'entityId': '', 'endOfRange': 10000})
+    return allocation
+
+
+def experiment(rng, key, variations, layer_id=None):
+    vs = [{'id': ids(rng), 'key': 'variation-%d' % i, 'variables': []}
+          for i in range(variations)]
+    return {
+        'id': ids(rng),
+        'key': key,
+        'layerId': layer_id or ids(rng),
+        'status': 'Running',
+        'audienceIds': [],
+        'forcedVariations': {},
+        'variations': vs,
+        'trafficAllocation': traffic_allocation(
+            rng, vs, rng.choice([100, 1000, 5000, 10000])),
+    }
+
+
+def feature(rng, key, rules, variables):
+    # A feature flag and its rollout: `rules` targeted rules, the last of
+    # them for everyone else, and `variables` string variables.
+    rollout_id = ids(rng)
+    rollout = {'id': rollout_id, 'experiments': []}
+    for i in range(rules):
+        e = experiment(rng, '%s-rule-%d' % (key, i), 1, rollout_id)
+        e['variations'][0]['featureEnabled'] = rng.random() < 0.5
+        e['trafficAllocation'] = [{
+            'entityId': e['variations'][0]['id'],
+            'endOfRange': 10000 if i == rules - 1 else
+                          rng.choice([100, 1000, 5000, 10000]),
+        }]
+        rollout['experiments'].append(e)
+    flag = {
+        'id': ids(rng),
+        'key': key,
+        'rolloutId': rollout_id,
+        'experimentIds': [],
+        'variables': [{'id': ids(rng), 'key': 'variable-%d' % i,
+                       'type': 'string', 'defaultValue': 'value-%d' % i}
+                      for i in range(variables)],
+    }
+    return flag, rollout
+
+
+def generate_datafile(experiments=100, variations=2, events=100, groups=0,
+                      events_per_experiment=3, features=0, seed=0):
+    rng = random.Random(seed)
+
+    exps = [experiment(rng, 'experiment-%d' % n, variations)
+            for n in range(experiments)]
+
+    group_list = []
+    for g in range(groups):
+        members = [experiment(rng, 'group-%d-experiment-%d' % (g, i), variations)
+                   for i in range(2)]
+        group_list.append({
+            'id': ids(rng),
+            'policy': 'random',
+            'experiments': members,
+            'trafficAllocation': [
+                {'entityId': members[0]['id'], 'endOfRange': 5000},
+                {'entityId': members[1]['id'], 'endOfRange': 10000},
+            ],
+        })
+
+    evs = [{'id': ids(rng), 'key': 'event-%d' % n, 'experimentIds': []}
+           for n in range(events)]
+    if evs:
+        for e in exps:
+            for ev in rng.sample(evs, min(events_per_experiment, len(evs))):
+                ev['experimentIds'].append(e['id'])
+
+    flags, rollouts = [], []
+    for n in range(features):
+        flag, rollout = feature(rng, 'feature-%d' % n, 2, 2)
+        flags.append(flag)
+        rollouts.append(rollout)
+
+    return {
+        'version': '4',
+        'accountId': '1',
+        'projectId': '1',
+        'revision': '1',
+        'anonymizeIP': True,
+        'botFiltering': False,
+        'attributes': [],
+        'audiences': [],
+        'variables': [],
+        'featureFlags': flags,
+        'rollouts': rollouts,
+        'groups': group_list,
+        'experiments': exps,
+        'events': evs,
+    }
+
+
+def mutate(datafile, density=0.01, seed=1):
+    # Returns a new revision of `datafile` where roughly `density` of the
+    # experiments and events have changed. Changes are split evenly
+    # between pausing, enabling, renaming and reallocating experiments,
+    # and renaming and (de)activating events. The same share of groups are
+    # reallocated, of rollout rules ramped or toggled, and of feature
+    # variables renamed or given a new default.
+    rng = random.Random(seed)
+    d = copy.deepcopy(datafile)
+    d['revision'] = str(int(d['revision']) + 1)
+
+    exps = d['experiments']
+    n = int(len(exps) * density)
+    picked = rng.sample(range(len(exps)), min(n, len(exps)))
+    paused = set()
+    for i, idx in enumerate(picked):
+        e = exps[idx]
+        kind = i % 4
+        if kind == 0:
+            paused.add(idx)
+        elif kind == 1:
+            e['key'] += '-renamed'
+        elif kind == 2:
+            vs = e['variations']
+            e['trafficAllocation'] = traffic_allocation(
+                rng, vs, rng.choice([100, 1000, 5000, 10000]))
+        else:
+            # Move the first range to another variation.
+            vs = e['variations']
+            first = e['trafficAllocation'][0]
+            first['entityId'] = vs[-1]['id'] \
+                if first['entityId'] == vs[0]['id'] else vs[0]['id']
+
+    paused_ids = { exps[i]['id'] for i in paused }
+    d['experiments'] = [e for i, e in enumerate(exps) if i not in paused]
+    variations = len(exps[0]['variations']) if exps else 2
+    for k in range(n // 4):
+        d['experiments'].append(
+            experiment(rng, 'experiment-new-%d' % k, variations))
+
+    evs = d['events']
+    m = int(len(evs) * density)
+    for i, idx in enumerate(rng.sample(range(len(evs)), min(m, len(evs)))):
+        ev = evs[idx]
+        if i % 2:
+            ev['key'] += '-renamed'
+        elif ev['experimentIds']:
+            ev['experimentIds'] = []
+        elif d['experiments']:
+            ev['experimentIds'] = [d['experiments'][0]['id']]
+
+    for ev in evs:
+        if paused_ids & set(ev['experimentIds']):
+            ev['experimentIds'] = [
+                x for x in ev['experimentIds'] if x not in paused_ids]
+
+    for g in rng.sample(d['groups'], int(len(d['groups']) * density)):
+        g['trafficAllocation'][0]['endOfRange'] = rng.choice([1000, 2500, 7500])
+
+    rules = [e for r in d['rollouts'] for e in r['experiments']]
+    for i, e in enumerate(rng.sample(rules, int(len(rules) * density))):
+        if i % 2:
+            v = e['variations'][0]
+            v['featureEnabled'] = not v['featureEnabled']
+        else:
+            a = e['trafficAllocation'][0]
+            a['endOfRange'] = 1000 if a['endOfRange'] == 5000 else 5000
+
+    variables = [v for f in d['featureFlags'] for v in f['variables']]
+    for i, v in enumerate(rng.sample(variables, int(len(variables) * density))):
+        if i % 2:
+            v['key'] += '-renamed'
+        else:
+            v['defaultValue'] += '-changed'
+
+    return d
@@ -0,0 +1,11 @@
+from bench.bench_allocations import run
+from unittest import TestCase
+
+
+class AllocationsBenchmarkTest(TestCase):
+    def test_runs(self):
+        results = run({'experiments': 40, 'variations': 2, 'density': 0.5,
+                       'seed': 0}, 1)
+        names = [r['name'] for r in results]
+        self.assertEqual(['per_experiment', 'bulk/array'], names[:2])
+        self.assertTrue(all(r['changed'] for r in results))
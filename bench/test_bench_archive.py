@@ -0,0 +1,17 @@
+from bench.bench_archive import archive, fixture_history
+import deltas
+from unittest import TestCase
+
+
+class ArchiveBenchmarkTest(TestCase):
+    def test_archive_reads_back(self):
+        history = fixture_history()
+        objects = archive(history, 10)
+        paths = sorted(objects, key=lambda p: int(p.split('/')[2]))
+        self.assertEqual(len(history), len(paths))
+        # A snapshot every 10 revisions, as none of the fixtures' patches
+        # are too big.
+        self.assertEqual((len(history) + 9) // 10,
+                         len([p for p in paths if not deltas.is_delta(p)]))
+        self.assertEqual(history, [
+            deltas.read_revision(objects.__getitem__, p) for p in paths])
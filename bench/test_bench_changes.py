@@ -0,0 +1,12 @@
+from bench.bench_changes import run
+from unittest import TestCase
+
+
+class ChangesBenchmarkTest(TestCase):
+    def test_runs(self):
+        results = run({'experiments': 20, 'variations': 2, 'events': 10,
+                       'seed': 0}, 1)
+        by_name = { r['name']: r for r in results }
+        # Every experiment paused and every event dead.
+        self.assertEqual(30, by_name['mass_pause/render']['changes'])
+        self.assertEqual(12, len(results))
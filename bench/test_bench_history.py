@@ -0,0 +1,19 @@
+from bench.bench_history import run
+import shutil
+import tempfile
+from unittest import TestCase
+
+
+class HistoryBenchmarkTest(TestCase):
+    def test_runs(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        results = run({'rows': 2000, 'projects': 1, 'experiments': 20,
+                       'events': 10, 'per_revision': 10, 'limit': 100,
+                       'seed': 0}, 1, root)
+        by_name = { r['name']: r for r in results }
+        self.assertEqual(2000, by_name['fill']['rows'])
+        self.assertEqual(100, by_name['query/latest']['found'])
+        self.assertTrue(by_name['query/experiment_by_key']['found'])
+        self.assertEqual(by_name['query/experiment_by_id']['found'],
+                         by_name['query/experiment_by_old_key']['found'])
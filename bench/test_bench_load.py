@@ -0,0 +1,29 @@
+from bench.bench_load import run
+import shutil
+import tempfile
+from unittest import TestCase
+
+
+class LoadBenchmarkTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_every_project_ends_at_its_last_revision(self):
+        for archive_format in ('full', 'delta'):
+            with self.subTest(archive_format=archive_format):
+                root = tempfile.mkdtemp(dir=self.root)
+                result = run({
+                    'projects': 3,
+                    'revisions': 4,
+                    'concurrency': 4,
+                    'rate': 0,
+                    'experiments': 10,
+                    'events': 5,
+                    'density': 0.2,
+                    'archive_format': archive_format,
+                }, root)
+                self.assertEqual(12, result['requests'])
+                self.assertEqual(0, result['errors'])
+                self.assertEqual([], result['stale_projects'])
+                self.assertLessEqual(result['p50_ms'], result['p99_ms'])
@@ -0,0 +1,11 @@
+from bench.bench_signatures import run
+from unittest import TestCase
+
+
+class SignatureBenchmarkTest(TestCase):
+    def test_runs(self):
+        results = run([1, 3], 10, 2, 1)
+        self.assertEqual(
+            ['naive/1', 'verifier/1', 'verifier-routed/1',
+             'naive/3', 'verifier/3', 'verifier-routed/3'],
+            [r['name'] for r in results])
@@ -0,0 +1,46 @@
+from bench.bench_differ import run
+from bench.synthetic import generate_datafile, mutate
+from differ import describe
+import json
+from optimizely.optimizely import Optimizely
+from unittest import TestCase
+
+
+class SyntheticDatafileTest(TestCase):
+    def test_valid(self):
+        d = generate_datafile(experiments=20, events=20, groups=2, features=3)
+        self.assertTrue(Optimizely(json.dumps(d)).is_valid)
+        self.assertTrue(Optimizely(json.dumps(mutate(d, 0.5))).is_valid)
+
+    def test_deterministic(self):
+        self.assertEqual(generate_datafile(seed=3), generate_datafile(seed=3))
+        d = generate_datafile()
+        self.assertEqual(mutate(d, seed=2), mutate(d, seed=2))
+
+    def test_density(self):
+        d = generate_datafile(experiments=100, events=100)
+        self.assertIsNone(describe(d, mutate(d, 0)))
+        few = describe(d, mutate(d, 0.04)).split('\n')
+        many = describe(d, mutate(d, 0.4)).split('\n')
+        self.assertLess(len(few), len(many))
+
+    def test_does_not_modify_original(self):
+        d = generate_datafile(experiments=10, events=10)
+        before = json.dumps(d)
+        mutate(d, 1)
+        self.assertEqual(before, json.dumps(d))
+
+
+class DifferBenchmarkTest(TestCase):
+    def test_runs(self):
+        results = run({
+            'experiments': 10, 'variations': 2, 'events': 10, 'groups': 1,
+            'features': 2, 'density': 0.5, 'seed': 0,
+        }, ['lightweight'], 1)
+        names = { r['name'] for r in results }
+        self.assertIn('construct/lightweight', names)
+        self.assertIn('detect_traffic_changes/lightweight', names)
+        self.assertIn('detect_rollout_traffic_changes/lightweight', names)
+        self.assertIn('describe/lightweight', names)
+        for r in results:
+            self.assertGreaterEqual(r['peak_bytes'], 0)
@@ -0,0 +1,147 @@
+# Merges the changes from bursts of datafile revisions into one
+# notification per project. The first change for a project opens a window;
+# everything that arrives before it closes is sent together. Changes that
+# undo each other within the window (an experiment enabled and then paused
+# again) are dropped.
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('optimizely-changes.coalesce')
+
+# Pairs of change kinds that undo each other on the same entity.
+OPPOSITES = {
+    'experiment_enabled': 'experiment_paused',
+    'experiment_paused': 'experiment_enabled',
+    'event_live': 'event_dead',
+    'event_dead': 'event_live',
+    'rollout_rule_enabled': 'rollout_rule_disabled',
+    'rollout_rule_disabled': 'rollout_rule_enabled',
+}
+
+
+def parse_windows(default, overrides):
+    # `overrides` looks like '10847551550=300,8896740779=0'.
+    windows = {}
+    for item in (overrides or '').split(','):
+        if item.strip():
+            project_id, seconds = item.split('=')
+            windows[project_id.strip()] = float(seconds)
+    return float(default or 0), windows
+
+
+def timer(delay, fn):
+    t = threading.Timer(delay, fn)
+    t.daemon = True
+    t.start()
+    return t
+
+
+class Batch(object):
+    # Changes are indexed by (kind, entity id) and by entity, so adding one
+    # doesn't scan the batch, however big it gets. Dicts keep the order
+    # changes were added in.
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.items = {}
+        self.by_kind = {}
+        self.by_entity = {}
+
+    @property
+    def changes(self):
+        return list(self.items)
+
+    def add(self, change):
+        if change in self.items:
+            return
+
+        opposite = OPPOSITES.get(change.kind)
+        if opposite and change.entity_id is not None:
+            found = self.by_kind.get((opposite, change.entity_id))
+            if found:
+                c = next(iter(found))
+                if c.kind == 'experiment_enabled':
+                    # It didn't exist before the window and doesn't now,
+                    # so nothing in between matters either.
+                    for x in list(self.by_entity[change.entity_id]):
+                        self.discard(x)
+                else:
+                    self.discard(c)
+                return
+
+        self.items[change] = None
+        self.by_kind.setdefault((change.kind, change.entity_id), {})[change] = None
+        if change.entity_id is not None:
+            self.by_entity.setdefault(change.entity_id, {})[change] = None
+
+    def discard(self, change):
+        del self.items[change]
+        key = (change.kind, change.entity_id)
+        del self.by_kind[key][change]
+        if not self.by_kind[key]:
+            del self.by_kind[key]
+        if change.entity_id is not None:
+            del self.by_entity[change.entity_id][change]
+            if not self.by_entity[change.entity_id]:
+                del self.by_entity[change.entity_id]
+
+
+class Coalescer(object):
+    # `send(project_id, changes)` is called with each merged batch. It's
+    # called from a timer thread unless `schedule` is replaced, as the
+    # tests do to drive the windows with a fake clock.
+    def __init__(self, send, window=0, windows=None, clock=time.monotonic,
+                 schedule=timer):
+        self.send = send
+        self.window = window
+        self.windows = windows or {}
+        self.clock = clock
+        self.schedule = schedule
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def window_for(self, project_id):
+        return self.windows.get(str(project_id), self.window)
+
+    def add(self, project_id, changes):
+        window = self.window_for(project_id)
+        if window <= 0:
+            if changes:
+                self.send(project_id, list(changes))
+            return
+
+        with self.lock:
+            batch = self.batches.get(project_id)
+            opened = batch is None
+            if opened:
+                batch = self.batches[project_id] = Batch(self.clock() + window)
+            for c in changes:
+                batch.add(c)
+
+        if opened:
+            logger.info('Coalescing changes for project %s for %ss' % (
+                project_id, window))
+            self.schedule(window, self.flush_due)
+
+    def flush_due(self):
+        now = self.clock()
+        with self.lock:
+            due = [(p, b) for p, b in self.batches.items() if b.deadline <= now]
+            for p, _ in due:
+                del self.batches[p]
+        self.deliver(due)
+
+    def flush(self):
+        with self.lock:
+            due = list(self.batches.items())
+            self.batches.clear()
+        self.deliver(due)
+
+    def deliver(self, batches):
+        for project_id, batch in batches:
+            changes = batch.changes
+            if changes:
+                self.send(project_id, changes)
+            else:
+                logger.info('Changes for project %s cancelled out' % project_id)
@@ -0,0 +1,149 @@
+# A compact archive format for datafile revisions. Most revisions differ
+# from the one before by a handful of fields, so instead of a full copy
+# each one can be stored as a gzipped JSON patch (RFC 6902, add/remove/
+# replace only) against the last full snapshot. Every delta is relative to
+# its snapshot rather than to the previous delta, so any revision is
+# rebuilt from exactly two reads.
+#
+# Deltas sit next to full revisions in the archive, under the same
+# datafile/<project_id>/<timestamp>/ prefix, with DELTA_SUFFIX appended.
+import difflib
+import gzip
+import json
+
+
+DELTA_SUFFIX = '.delta'
+
+
+def is_delta(path):
+    return path.endswith(DELTA_SUFFIX)
+
+
+def escape(token):
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+
+def unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def list_key(item):
+    # Datafile lists are mostly of entities with ids; those are aligned by
+    # id so an edited entity is patched in place rather than replaced.
+    if isinstance(item, dict) and 'id' in item:
+        return ('id', str(item['id']))
+    return ('value', json.dumps(item, sort_keys=True))
+
+
+def make_patch(old, new, path=''):
+    if old == new:
+        return []
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for k in old:
+            if k not in new:
+                ops.append({'op': 'remove', 'path': '%s/%s' % (path, escape(k))})
+        for k, v in new.items():
+            p = '%s/%s' % (path, escape(k))
+            if k not in old:
+                ops.append({'op': 'add', 'path': p, 'value': v})
+            else:
+                ops.extend(make_patch(old[k], v, p))
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list):
+        return list_patch(old, new, path)
+
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+
+def list_patch(old, new, path):
+    # The common prefix and suffix are skipped outright, which is all it
+    # takes for the usual single edit. What's left is aligned with
+    # difflib. At each opcode the list being patched reads
+    # new[:j1] + old[i1:], so indices into it are indices into `new`.
+    start = 0
+    limit = min(len(old), len(new))
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    a = old[start:len(old) - end]
+    b = new[start:len(new) - end]
+
+    matcher = difflib.SequenceMatcher(
+        None, [list_key(x) for x in a], [list_key(x) for x in b],
+        autojunk=False)
+    ops = []
+    for _, i1, i2, j1, j2 in matcher.get_opcodes():
+        common = min(i2 - i1, j2 - j1)
+        for k in range(common):
+            ops.extend(make_patch(
+                a[i1 + k], b[j1 + k], '%s/%d' % (path, start + j1 + k)))
+        for _ in range(i2 - i1 - common):
+            ops.append({'op': 'remove',
+                        'path': '%s/%d' % (path, start + j1 + common)})
+        for k in range(common, j2 - j1):
+            ops.append({'op': 'add', 'path': '%s/%d' % (path, start + j1 + k),
+                        'value': b[j1 + k]})
+    return ops
+
+
+def apply_patch(doc, patch):
+    # Applies `patch` to a copy of `doc`. Only the containers along each
+    # patched path are copied; everything else is shared with `doc`.
+    # Each container is copied at most once, however many ops touch it.
+    root = [doc]
+    copied = set()
+    for op in patch:
+        tokens = [unescape(t) for t in op['path'].split('/')[1:]]
+        parent = root
+        key = 0
+        for token in tokens:
+            child = parent[key]
+            if id(child) not in copied:
+                child = dict(child) if isinstance(child, dict) else list(child)
+                copied.add(id(child))
+                parent[key] = child
+            parent = child
+            key = int(token) if isinstance(child, list) else token
+
+        if op['op'] == 'remove':
+            del parent[key]
+        elif op['op'] == 'add' and isinstance(parent, list):
+            parent.insert(key, op['value'])
+        else:
+            parent[key] = op['value']
+    return root[0]
+
+
+def encode(base_path, base_generation, patch):
+    return gzip.compress(json.dumps({
+        'base': base_path,
+        'base_generation': base_generation,
+        'patch': patch,
+    }, separators=(',', ':')).encode('utf-8'))
+
+
+def decode(data):
+    return json.loads(gzip.decompress(data))
+
+
+def read_revision(read, path, snapshots=None):
+    # Rebuilds the datafile archived at `path`, delta or not. `read` maps
+    # an archive path to its bytes. `snapshots`, if given, is a dict of
+    # parsed snapshots by path shared between calls.
+    if not is_delta(path):
+        return json.loads(read(path))
+
+    delta = decode(read(path))
+    base = delta['base']
+    if snapshots is None:
+        datafile = json.loads(read(base))
+    else:
+        if base not in snapshots:
+            snapshots[base] = json.loads(read(base))
+        datafile = snapshots[base]
+    return apply_patch(datafile, delta['patch'])
@@ -1,12 +1,22 @@
-from cached_property import cached_property
-from collections import defaultdict
+import allocations
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+try:
+    # The cached-property package imports asyncio, which is a good part of
+    # a cold start. Only fall back to it where functools lacks one.
+    from functools import cached_property
+except ImportError:
+    from cached_property import cached_property
 from itertools import chain
 import io
 import json
-from operator import itemgetter
-from optimizely.optimizely import Optimizely # derp
+from operator import attrgetter, itemgetter
+import re
 
 
+# Allocations are in hundredths of a percent, so there are at most 10001
+# distinct inputs.
+@lru_cache(maxsize=None)
 def pct(v):
     return ('%.2f' % (v / 100,)).rstrip('0').rstrip('.') + '%'
 
@@ -15,11 +25,180 @@ def event_id_map(opt):
     return { ev['id']: ev for ev in opt.config.events }
 
 
+# Event changes between two configs. live and dead are (id, key) pairs,
+# renamed is (id, old key, new key), and experiments is
+# (id, key, added experiment ids, removed experiment ids) for events that
+# stayed active but moved between experiments present in both configs.
+EventDiff = namedtuple('EventDiff', 'live dead renamed experiments')
+
+
+# Ids of the entities that differ between two configs, from a structural
+# comparison of the raw datafile dicts. Detectors only look at these, so
+# their cost scales with the size of the change rather than the datafile.
+Changeset = namedtuple('Changeset', 'added removed modified')
+
+
+def structural_diff(old, current):
+    # old and current map ids to raw entity dicts. Unchanged entities are
+    # compared with ==, which happens in C without building anything.
+    added = [i for i in current if i not in old]
+    removed = [i for i in old if i not in current]
+    modified = [i for i, e in current.items()
+                if i in old and old[i] is not e and old[i] != e]
+    return Changeset(added, removed, modified)
+
+
+class DatafileIndex(object):
+    # Id-indexed maps of the raw entities in one datafile, each built on
+    # first use in one pass over it, so that detectors never have to look
+    # entities up one at a time through the SDK.
+    def __init__(self, datafile):
+        self.datafile = datafile
+
+    @cached_property
+    def experiments(self):
+        # Experiments in exclusion groups are experiments like any other.
+        return { e['id']: e for e in chain(
+            self.datafile.get('experiments', []),
+            chain.from_iterable(g['experiments'] for g in self.groups.values()))
+        }
+
+    @cached_property
+    def groups(self):
+        return { g['id']: g for g in self.datafile.get('groups', []) }
+
+    @cached_property
+    def rollout_rules(self):
+        return { e['id']: e for r in self.datafile.get('rollouts', [])
+                 for e in r['experiments'] }
+
+    @cached_property
+    def rule_features(self):
+        # Rules of rollouts no feature uses are named after the rollout.
+        features = { f['rolloutId']: f['key']
+                     for f in self.datafile.get('featureFlags', [])
+                     if f.get('rolloutId') }
+        return { e['id']: features.get(r['id'], r['id'])
+                 for r in self.datafile.get('rollouts', [])
+                 for e in r['experiments'] }
+
+    @cached_property
+    def variables(self):
+        return { v['id']: v for f in self.datafile.get('featureFlags', [])
+                 for v in f.get('variables', []) }
+
+    @cached_property
+    def variable_features(self):
+        return { v['id']: f['key'] for f in self.datafile.get('featureFlags', [])
+                 for v in f.get('variables', []) }
+
+
+def group_allocation(group):
+    # Shares of a group's traffic by experiment id, like the summaries from
+    # TrafficAllocation.summarize.
+    vals = defaultdict(int)
+    vals['not bucketed'] = 100 * 100
+    end = 0
+    for alloc in group['trafficAllocation']:
+        if alloc['entityId']:
+            vals[alloc['entityId']] += alloc['endOfRange'] - end
+            vals['not bucketed'] -= alloc['endOfRange'] - end
+        end = alloc['endOfRange']
+    return { k: v for k, v in vals.items() if v > 0 }
+
+
+def rule_enabled(rule):
+    # Turning a rollout rule off in Optimizely keeps it running, but with
+    # the feature disabled in all of its variations.
+    return rule.get('status', 'Running') == 'Running' and any(
+        v.get('featureEnabled') for v in rule['variations'])
+
+
+class Entity(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class DatafileConfig(object):
+    # The subset of the SDK's ProjectConfig that the differ reads, indexed
+    # straight from the parsed datafile. Unlike the SDK this doesn't
+    # validate the datafile or build audience, feature or bucketing
+    # indexes, and entities are only built when they're looked up.
+    def __init__(self, datafile):
+        self.experiments = datafile.get('experiments', [])
+        self.events = datafile.get('events', [])
+
+        self.experiment_id_map = {}
+        self.experiment_key_map = {}
+        for e in chain(
+                chain.from_iterable(
+                    r['experiments'] for r in datafile.get('rollouts', [])),
+                chain.from_iterable(
+                    g['experiments'] for g in datafile.get('groups', [])),
+                self.experiments):
+            self.experiment_id_map[e['id']] = e
+            self.experiment_key_map[e['key']] = e
+
+        self.variation_id_maps = {}
+
+    def get_experiment_from_id(self, experiment_id):
+        e = self.experiment_id_map.get(experiment_id)
+        return Entity(**e) if e else None
+
+    def get_variation_from_id(self, experiment_key, variation_id):
+        variations = self.variation_id_maps.get(experiment_key)
+        if variations is None:
+            e = self.experiment_key_map.get(experiment_key)
+            variations = self.variation_id_maps[experiment_key] = {
+                v['id']: v for v in (e['variations'] if e else [])
+            }
+
+        v = variations.get(variation_id)
+        return Entity(**v) if v else None
+
+
+class LightweightOptimizely(object):
+    def __init__(self, datafile):
+        self.config = DatafileConfig(datafile)
+
+
+def sdk_optimizely(datafile):
+    # The SDK (and jsonschema with it) is slow to import, so it's only
+    # loaded if this engine is used.
+    from optimizely.optimizely import Optimizely # derp
+    opt = Optimizely(json.dumps(datafile))
+    if not opt.is_valid:
+        raise ValueError('Datafile failed the SDK\'s validation')
+    return opt
+
+
+# How datafiles are loaded for diffing. Which entities changed is always
+# worked out from the raw datafiles (see DatafileIndex); the engine only
+# serves the lookups by id behind keys and allocation summaries. So the
+# SDK engine doesn't change what's reported, it only adds validation:
+# it's slower, but refuses datafiles the SDKs themselves would reject.
+ENGINES = {
+    'lightweight': LightweightOptimizely,
+    'sdk': sdk_optimizely,
+}
+
+DEFAULT_ENGINE = 'lightweight'
+
+
 class TrafficAllocation(object):
+    # Summaries are memoized per experiment, so one instance per config can
+    # be shared by every detector. Don't modify the returned dicts.
     def __init__(self, optimizely):
         self.optimizely = optimizely
+        self.summaries = {}
 
     def summarize(self, experiment_id):
+        s = self.summaries.get(experiment_id)
+        if s is None:
+            s = self.summaries[experiment_id] = self.compute(experiment_id)
+        return s
+
+    def compute(self, experiment_id):
         conf = self.optimizely.config
         e = conf.get_experiment_from_id(experiment_id)
 
@@ -42,43 +221,276 @@ class TrafficAllocation(object):
         return { k: v for k, v in vals.items() if v > 0 }
 
 
+def format_allocation(summary):
+    items = ['%s %s' % (pct(p), k)
+             for k, p in sorted(summary.items(), key=itemgetter(0))
+             if k != 'not bucketed']
+
+    nb = summary.get('not bucketed')
+    if nb:
+        items.append('%s not bucketed' % pct(nb))
+
+    return ', '.join(items)
+
+
+def format_tracking(fields):
+    parts = []
+    if fields['added']:
+        parts.append('now tracked by %s' % ', '.join(
+            '`%s`' % k for k in fields['added']))
+    if fields['removed']:
+        parts.append('no longer tracked by %s' % ', '.join(
+            '`%s`' % k for k in fields['removed']))
+    return '; '.join(parts)
+
+
+# Slack text for each kind of change, filled in from its fields. Traffic
+# is in hundredths of a percent and allocations are summaries as returned
+# by TrafficAllocation.summarize; both are formatted here. Events moving
+# between experiments don't fit a template; see RENDERERS.
+TEMPLATES = {
+    'experiment_enabled': 'Experiment `%(key)s` enabled. %(allocation)s.',
+    'experiment_paused': 'Experiment `%(key)s` paused.',
+    'experiment_renamed': 'Experiment `%(old_key)s` renamed to `%(key)s`.',
+    'traffic_increased': 'Experiment `%(key)s` traffic increased from '
+                         '%(old_traffic)s to %(traffic)s. Currently: '
+                         '%(allocation)s.',
+    'traffic_decreased': 'Experiment `%(key)s` traffic decreased from '
+                         '%(old_traffic)s to %(traffic)s. Currently: '
+                         '%(allocation)s.',
+    'weighting_changed': 'Experiment `%(key)s` variation weighting changed. '
+                         'Was: %(old_allocation)s; currently: %(allocation)s.',
+    'event_live': 'Event `%(key)s` added to active experiments. Tracking '
+                  'calls will now send curls.',
+    'event_dead': 'Event `%(key)s` removed from all active experiments. '
+                  'Tracking calls are now not sending curls.',
+    'event_renamed': 'Event `%(old_key)s` renamed to `%(key)s` (may affect '
+                     'track calls).',
+    'group_traffic_changed': 'Exclusion group `%(key)s` traffic changed. '
+                             'Was: %(old_allocation)s; currently: '
+                             '%(allocation)s.',
+    'rollout_rule_added': 'Feature `%(feature)s` rollout rule `%(key)s` '
+                          'added with %(traffic)s of traffic.',
+    'rollout_rule_removed': 'Feature `%(feature)s` rollout rule `%(key)s` '
+                            'removed.',
+    'rollout_rule_enabled': 'Feature `%(feature)s` rollout rule `%(key)s` '
+                            'turned on.',
+    'rollout_rule_disabled': 'Feature `%(feature)s` rollout rule `%(key)s` '
+                             'turned off.',
+    'rollout_traffic_changed': 'Feature `%(feature)s` rollout rule `%(key)s` '
+                               'traffic changed from %(old_traffic)s to '
+                               '%(traffic)s.',
+    'feature_variable_added': 'Feature `%(feature)s` variable `%(key)s` '
+                              'added with default `%(value)s`.',
+    'feature_variable_removed': 'Feature `%(feature)s` variable `%(key)s` '
+                                'removed.',
+    'feature_variable_renamed': 'Feature `%(feature)s` variable '
+                                '`%(old_key)s` renamed to `%(key)s`.',
+    'feature_variable_changed': 'Feature `%(feature)s` variable `%(key)s` '
+                                'default changed from `%(old_value)s` to '
+                                '`%(value)s`.',
+}
+
+FORMATTERS = {
+    'traffic': pct,
+    'old_traffic': pct,
+    'allocation': format_allocation,
+    'old_allocation': format_allocation,
+}
+
+
+def compile_template(template):
+    # Turns a template into a function of a change's fields, with the
+    # field lookups and formatters worked out once up front.
+    names = re.findall(r'%\((\w+)\)s', template)
+    positional = re.sub(r'%\((\w+)\)s', '%s', template)
+    steps = [(n, FORMATTERS.get(n)) for n in names]
+
+    if not any(f for _, f in steps):
+        get = itemgetter(*names)
+        if len(names) == 1:
+            return lambda fields: positional % (get(fields),)
+        return lambda fields: positional % get(fields)
+
+    def render(fields):
+        return positional % tuple(
+            f(fields[n]) if f else fields[n] for n, f in steps)
+    return render
+
+
+RENDERERS = { kind: compile_template(t) for kind, t in TEMPLATES.items() }
+RENDERERS['event_experiments_changed'] = lambda fields: \
+    'Event `%s` %s.' % (fields['key'], format_tracking(fields))
+
+# Changes sort the way their text would: by the entity named at the start
+# of the message, then by what follows it. RANKS orders the kinds for one
+# entity by the text after its name, and gives the words the message starts
+# with.
+RANKS = { kind: (label, i) for label, kinds in [
+    ('Event', [
+        'event_live',                 # added to...
+        'event_experiments_changed',  # no longer / now tracked by...
+        'event_dead',                 # removed from...
+        'event_renamed',              # renamed to...
+    ]),
+    ('Exclusion group', [
+        'group_traffic_changed',      # traffic changed...
+    ]),
+    ('Experiment', [
+        'experiment_enabled',         # enabled.
+        'experiment_paused',          # paused.
+        'experiment_renamed',         # renamed to...
+        'traffic_decreased',          # traffic decreased...
+        'traffic_increased',          # traffic increased...
+        'weighting_changed',          # variation weighting...
+    ]),
+    ('Feature', [
+        'rollout_rule_added',         # added with...
+        'rollout_rule_removed',       # removed.
+        'rollout_traffic_changed',    # traffic changed...
+        'rollout_rule_disabled',      # turned off.
+        'rollout_rule_enabled',       # turned on.
+        'feature_variable_added',     # added with default...
+        'feature_variable_changed',   # default changed...
+        'feature_variable_removed',   # removed.
+        'feature_variable_renamed',   # renamed to...
+    ]),
+] for i, kind in enumerate(kinds) }
+
+# Feature messages name the rule or variable after the feature, so both
+# are part of the name.
+NAMES = dict.fromkeys([
+    'rollout_rule_added', 'rollout_rule_removed', 'rollout_rule_enabled',
+    'rollout_rule_disabled', 'rollout_traffic_changed',
+], '%s` rollout rule `%s')
+NAMES.update(dict.fromkeys([
+    'feature_variable_added', 'feature_variable_removed',
+    'feature_variable_renamed', 'feature_variable_changed',
+], '%s` variable `%s'))
+
+
+def change_sort_key(description, kind, entity_id, fields):
+    if description is not None:
+        return (description, '', -1, '')
+
+    # The closing backtick is part of the key, as it is in the text, so
+    # `a-b` sorts before `a`.
+    label, rank = RANKS[kind]
+    name = fields['old_key'] if 'old_key' in fields else fields['key']
+    if kind in NAMES:
+        name = NAMES[kind] % (fields['feature'], name)
+    return (label, name + '`', rank, entity_id)
+
+
 class Change(object):
-    def __init__(self, description):
-        self.description = description
+    # kind and entity_id say what changed, e.g. ('experiment_paused',
+    # '11716925753'), so that changes can be merged across revisions. The
+    # rest of what's known about the change is in `fields`, from which its
+    # text is rendered on first use. A description can also be given
+    # outright, without fields.
+    __slots__ = ('_description', '_text', '_hash', 'kind', 'entity_id',
+                 'fields', 'sort_key')
+
+    def __init__(self, description=None, kind=None, entity_id=None, **fields):
+        self._description = description
+        self._text = description
+        self._hash = hash((kind, entity_id, description))
+        self.kind = kind
+        self.entity_id = entity_id
+        self.fields = fields
+        self.sort_key = change_sort_key(description, kind, entity_id, fields)
+
+    @property
+    def description(self):
+        if self._text is None:
+            self._text = RENDERERS[self.kind](self.fields)
+        return self._text
+
+    def identity(self):
+        return (self.kind, self.entity_id, self._description, self.fields)
+
+    def to_dict(self):
+        d = {'kind': self.kind, 'entity_id': self.entity_id,
+             'text': self.description}
+        d.update(self.fields)
+        return d
 
     def __eq__(self, other):
-        return other.description == self.description
+        return isinstance(other, Change) and other.identity() == self.identity()
 
     def __hash__(self):
-        return hash(self.description)
+        return self._hash
 
     def __str__(self):
         return self.description
 
 
 class DatafileDiffer(object):
-    def __init__(self, old, current):
+    def __init__(self, old, current, engine=DEFAULT_ENGINE):
         self.old = old
         self.current = current
 
-        self.current_opt = Optimizely(json.dumps(self.current))
-        self.old_opt = Optimizely(json.dumps(self.old))
+        load = ENGINES[engine]
+        self.current_opt = load(self.current)
+        self.old_opt = load(self.old)
+        self.current_index = DatafileIndex(self.current)
+        self.old_index = DatafileIndex(self.old)
+
+    @cached_property
+    def old_allocation(self):
+        return TrafficAllocation(self.old_opt)
+
+    @cached_property
+    def current_allocation(self):
+        return TrafficAllocation(self.current_opt)
 
     @property
-    def old_experiments(self):
-        return self.old_opt.config.experiments
+    def old_experiment_map(self):
+        return self.old_index.experiments
 
     @property
-    def current_experiments(self):
-        return self.current_opt.config.experiments
+    def current_experiment_map(self):
+        return self.current_index.experiments
+
+    @cached_property
+    def old_event_map(self):
+        return event_id_map(self.old_opt)
+
+    @cached_property
+    def current_event_map(self):
+        return event_id_map(self.current_opt)
+
+    @cached_property
+    def experiment_changes(self):
+        return structural_diff(self.old_experiment_map, self.current_experiment_map)
 
     @cached_property
-    def retained_experiment_ids(self):
-        return ({ e['id'] for e in self.current_experiments } &
-                { e['id'] for e in self.old_experiments })
+    def event_changes(self):
+        return structural_diff(self.old_event_map, self.current_event_map)
+
+    @cached_property
+    def group_changes(self):
+        return structural_diff(self.old_index.groups, self.current_index.groups)
+
+    @cached_property
+    def rule_changes(self):
+        return structural_diff(self.old_index.rollout_rules,
+                               self.current_index.rollout_rules)
+
+    @cached_property
+    def variable_changes(self):
+        return structural_diff(self.old_index.variables,
+                               self.current_index.variables)
+
+    def is_retained_experiment(self, experiment_id):
+        return (experiment_id in self.old_experiment_map and
+                experiment_id in self.current_experiment_map)
 
     def describe(self):
-        return '\n'.join(sorted({ str(c) for c in self.generate_changes() })) or None
+        return render(self.generate_changes())
+
+    def changes(self):
+        return sort_changes(self.generate_changes())
 
     def generate_changes(self):
         return chain(*(generator() for generator in (
@@ -89,128 +501,223 @@ class DatafileDiffer(object):
             self.detect_event_live,
             self.detect_event_dead,
             self.detect_event_renamed,
+            self.detect_event_experiments_changed,
+            self.detect_group_traffic_changes,
+            self.detect_rollout_rules_added,
+            self.detect_rollout_rules_removed,
+            self.detect_rollout_rules_toggled,
+            self.detect_rollout_traffic_changes,
+            self.detect_feature_variables_added,
+            self.detect_feature_variables_removed,
+            self.detect_feature_variables_changed,
         )))
 
     def detect_experiments_added(self):
-        new_ids = ({ e['id'] for e in self.current_experiments } -
-                   { e['id'] for e in self.old_experiments })
-
-        for i in new_ids:
+        for i in self.experiment_changes.added:
             e = self.current_opt.config.get_experiment_from_id(i)
-            yield Change('Experiment `%s` enabled. %s.' % (
-                e.key, self.summarize_traffic_allocation(e.id)))
+            yield Change(kind='experiment_enabled', entity_id=e.id, key=e.key,
+                         allocation=self.current_allocation.summarize(e.id))
 
     def detect_experiments_removed(self):
-        missing_ids = ({ e['id'] for e in self.old_experiments } -
-                       { e['id'] for e in self.current_experiments })
-
-        for i in missing_ids:
+        for i in self.experiment_changes.removed:
             e = self.old_opt.config.get_experiment_from_id(i)
-            yield Change('Experiment `%s` paused.' % e.key)
+            yield Change(kind='experiment_paused', entity_id=e.id, key=e.key)
 
     def detect_experiments_renamed(self):
-        for i in self.retained_experiment_ids:
+        for i in self.experiment_changes.modified:
             e0 = self.old_opt.config.get_experiment_from_id(i)
             e1 = self.current_opt.config.get_experiment_from_id(i)
             if e0.key != e1.key:
-                yield Change('Experiment `%s` renamed to `%s`.' % (
-                    e0.key, e1.key))
+                yield Change(kind='experiment_renamed', entity_id=i,
+                             old_key=e0.key, key=e1.key)
+
+    @cached_property
+    def allocation_changes(self):
+        # An experiment's allocation summary only depends on its own
+        # trafficAllocation and variations, so only modified experiments
+        # are compared, all at once.
+        return allocations.compare(self.old_experiment_map,
+                                   self.current_experiment_map,
+                                   self.experiment_changes.modified)
 
     def detect_traffic_changes(self):
-        for i in self.retained_experiment_ids:
-            c = self.traffic_change(i)
-            if c:
-                yield c
+        for i, kind, prev_traffic, curr_traffic in self.allocation_changes:
+            e = self.current_experiment_map[i]
+            curr_alloc = self.current_allocation.summarize(i)
+            if kind == 'weighting_changed':
+                yield Change(kind=kind, entity_id=i, key=e['key'],
+                             old_allocation=self.old_allocation.summarize(i),
+                             allocation=curr_alloc)
+            else:
+                yield Change(kind=kind, entity_id=i, key=e['key'],
+                             old_traffic=prev_traffic, traffic=curr_traffic,
+                             allocation=curr_alloc)
+
+    @cached_property
+    def event_diff(self):
+        e0 = self.old_event_map
+        e1 = self.current_event_map
+        changes = self.event_changes
+        diff = EventDiff([], [], [], [])
+
+        for eid in changes.added:
+            settings = e1[eid]
+            if len(settings['experimentIds']):
+                diff.live.append((eid, settings['key']))
+
+        for eid in changes.modified:
+            settings = e1[eid]
+            old = e0[eid]
+            experiments0 = old['experimentIds']
+            experiments1 = settings['experimentIds']
+            if old['key'] != settings['key']:
+                diff.renamed.append((eid, old['key'], settings['key']))
+
+            if len(experiments1) and not len(experiments0):
+                diff.live.append((eid, settings['key']))
+            elif len(experiments0) and not len(experiments1):
+                diff.dead.append((eid, old['key']))
+            elif experiments0 != experiments1:
+                # Experiments that were added or removed outright are
+                # reported on their own.
+                ids0 = { i for i in experiments0 if self.is_retained_experiment(i) }
+                ids1 = { i for i in experiments1 if self.is_retained_experiment(i) }
+                if ids0 != ids1:
+                    diff.experiments.append(
+                        (eid, settings['key'], ids1 - ids0, ids0 - ids1))
+
+        for eid in changes.removed:
+            settings = e0[eid]
+            if len(settings['experimentIds']):
+                diff.dead.append((eid, settings['key']))
+
+        return diff
 
     def detect_event_live(self):
-        for event_key in self.event_status_changes(self.old_opt, self.current_opt):
-            yield Change('Event `%s` added to active experiments. Tracking '
-                         'calls will now send curls.' % event_key)
+        for eid, event_key in self.event_diff.live:
+            yield Change(kind='event_live', entity_id=eid, key=event_key)
 
     def detect_event_dead(self):
-        for event_key in self.event_status_changes(self.current_opt, self.old_opt):
-            yield Change('Event `%s` removed from all active experiments. Tracking '
-                         'calls are now not sending curls.' % event_key)
-
-    def event_status_changes(self, opt0, opt1):
-        e0 = event_id_map(opt0)
-        e1 = event_id_map(opt1)
-
-        for eid, settings in e1.items():
-            experiments1 = settings['experimentIds']
-            if not len(experiments1):
-                continue
-
-            if eid not in e0:
-                yield settings['key']
-            else:
-                experiments0 = e0[eid]['experimentIds']
-                if not len(experiments0):
-                    yield settings['key']
+        for eid, event_key in self.event_diff.dead:
+            yield Change(kind='event_dead', entity_id=eid, key=event_key)
 
     def detect_event_renamed(self):
-        e0 = event_id_map(self.old_opt)
-        e1 = event_id_map(self.current_opt)
-        for eid, settings in e1.items():
-            if eid not in e0:
-                continue
-
-            oldkey = e0[eid]['key']
-            if oldkey != settings['key']:
+        for eid, oldkey, newkey in self.event_diff.renamed:
+            yield Change(kind='event_renamed', entity_id=eid,
+                         old_key=oldkey, key=newkey)
+
+    def detect_event_experiments_changed(self):
+        conf = self.current_opt.config
+        for eid, event_key, added, removed in self.event_diff.experiments:
+            yield Change(
+                kind='event_experiments_changed', entity_id=eid, key=event_key,
+                added=sorted(conf.get_experiment_from_id(i).key for i in added),
+                removed=sorted(conf.get_experiment_from_id(i).key
+                               for i in removed))
+
+    def group_summary(self, index, allocation):
+        # Keyed by experiment key rather than id, for the text.
+        experiments = index.experiments
+        return { experiments[i]['key'] if i in experiments else i: share
+                 for i, share in allocation.items() }
+
+    def detect_group_traffic_changes(self):
+        # Groups that were added or removed are reported through their
+        # experiments.
+        for i in self.group_changes.modified:
+            g0 = self.old_index.groups[i]
+            g1 = self.current_index.groups[i]
+            alloc0 = group_allocation(g0)
+            alloc1 = group_allocation(g1)
+            if alloc0 != alloc1:
                 yield Change(
-                    'Event `%s` renamed to `%s` (may affect track calls).' % (
-                        oldkey, settings['key']))
-
-    def traffic_change(self, experiment_id):
-        e = self.current_opt.config.get_experiment_from_id(experiment_id)
-
-        prev_alloc = TrafficAllocation(self.old_opt).summarize(e.id)
-        curr_alloc = TrafficAllocation(self.current_opt).summarize(e.id)
-
-        if prev_alloc == curr_alloc:
-            return None
-
-        curr_traffic = 100 * 100 - curr_alloc.get('not bucketed', 0)
-        prev_traffic = 100 * 100 - prev_alloc.get('not bucketed', 0)
-
-        # Sometimes adding/removing variations results in slight rebalancing
-        # of the traffic allocation. Ignore this when it's very small.
-        epsilon = 10
-
-        if curr_traffic - prev_traffic > epsilon:
-            return Change('Experiment `%s` traffic increased from %s to %s. '
-                          'Currently: %s.' % (
-                              e.key, pct(prev_traffic), pct(curr_traffic),
-                              self.summarize_traffic_allocation(e.id)))
-        elif curr_traffic - prev_traffic < -epsilon:
-            return Change('Experiment `%s` traffic decreased from %s to %s. '
-                          'Currently: %s.' % (
-                              e.key, pct(prev_traffic), pct(curr_traffic),
-                              self.summarize_traffic_allocation(e.id)))
-
-        return Change('Experiment `%s` variation weighting changed. '
-                      'Was: %s; currently: %s.' % (
-                          e.key,
-                          self.summarize_traffic_allocation(e.id, self.old_opt),
-                          self.summarize_traffic_allocation(e.id)))
-
-    def summarize_traffic_allocation(self, experiment_id, optimizely=None):
-        alloc = TrafficAllocation(optimizely or self.current_opt)
-        s = alloc.summarize(experiment_id)
-
-        nb = None
-        if 'not bucketed' in s:
-            nb = s['not bucketed']
-            del s['not bucketed']
-
-        items = ['%s %s' % (pct(p), k)
-                 for k, p in sorted(s.items(), key=itemgetter(0))]
-
-        if nb:
-            items.append('%s not bucketed' % pct(nb))
-
-        return ', '.join(items)
-
-
-def describe(old_datafile, current_datafile):
-    return DatafileDiffer(old_datafile, current_datafile).describe()
+                    kind='group_traffic_changed', entity_id=i, key=i,
+                    old_allocation=self.group_summary(self.old_index, alloc0),
+                    allocation=self.group_summary(self.current_index, alloc1))
+
+    def detect_rollout_rules_added(self):
+        index = self.current_index
+        for i in self.rule_changes.added:
+            rule = index.rollout_rules[i]
+            yield Change(kind='rollout_rule_added', entity_id=i,
+                         feature=index.rule_features[i], key=rule['key'],
+                         traffic=allocations.traffic(rule))
+
+    def detect_rollout_rules_removed(self):
+        index = self.old_index
+        for i in self.rule_changes.removed:
+            yield Change(kind='rollout_rule_removed', entity_id=i,
+                         feature=index.rule_features[i],
+                         key=index.rollout_rules[i]['key'])
+
+    def detect_rollout_rules_toggled(self):
+        index = self.current_index
+        for i in self.rule_changes.modified:
+            enabled = rule_enabled(index.rollout_rules[i])
+            if enabled != rule_enabled(self.old_index.rollout_rules[i]):
+                yield Change(
+                    kind='rollout_rule_enabled' if enabled
+                    else 'rollout_rule_disabled',
+                    entity_id=i, feature=index.rule_features[i],
+                    key=index.rollout_rules[i]['key'])
+
+    def detect_rollout_traffic_changes(self):
+        # Everyone bucketed into a rule sees the same feature, so only the
+        # traffic of a rule matters, not how it's split.
+        index = self.current_index
+        for i, kind, prev_traffic, curr_traffic in allocations.compare(
+                self.old_index.rollout_rules, index.rollout_rules,
+                self.rule_changes.modified):
+            if kind != 'weighting_changed':
+                yield Change(kind='rollout_traffic_changed', entity_id=i,
+                             feature=index.rule_features[i],
+                             key=index.rollout_rules[i]['key'],
+                             old_traffic=prev_traffic, traffic=curr_traffic)
+
+    def detect_feature_variables_added(self):
+        index = self.current_index
+        for i in self.variable_changes.added:
+            v = index.variables[i]
+            yield Change(kind='feature_variable_added', entity_id=i,
+                         feature=index.variable_features[i], key=v['key'],
+                         value=v['defaultValue'])
+
+    def detect_feature_variables_removed(self):
+        index = self.old_index
+        for i in self.variable_changes.removed:
+            yield Change(kind='feature_variable_removed', entity_id=i,
+                         feature=index.variable_features[i],
+                         key=index.variables[i]['key'])
+
+    def detect_feature_variables_changed(self):
+        index = self.current_index
+        for i in self.variable_changes.modified:
+            v0 = self.old_index.variables[i]
+            v1 = index.variables[i]
+            feature = index.variable_features[i]
+            if v0['key'] != v1['key']:
+                yield Change(kind='feature_variable_renamed', entity_id=i,
+                             feature=feature, old_key=v0['key'], key=v1['key'])
+            if v0['defaultValue'] != v1['defaultValue']:
+                yield Change(kind='feature_variable_changed', entity_id=i,
+                             feature=feature, key=v1['key'],
+                             old_value=v0['defaultValue'],
+                             value=v1['defaultValue'])
+
+
+def sort_changes(changes):
+    # Drops duplicates and sorts on the structured keys, without rendering.
+    return sorted(dict.fromkeys(changes), key=attrgetter('sort_key'))
+
+
+def render(changes):
+    return '\n'.join(c.description for c in sort_changes(changes)) or None
+
+
+def render_json(changes):
+    return json.dumps([c.to_dict() for c in sort_changes(changes)],
+                      sort_keys=True)
+
+
+def describe(old_datafile, current_datafile, engine=DEFAULT_ENGINE):
+    return DatafileDiffer(old_datafile, current_datafile, engine).describe()
@@ -0,0 +1,241 @@
+# A local, append-only record of every change detected, in SQLite, so
+# questions like "what changed in experiment X last month" don't need the
+# archive to be diffed again.
+#
+#   python main.py history 10847551550 --experiment checkout-flow --since 30d
+#   python main.py history 10847551550 --event purchase --format json
+#
+# Each row is one structured change (see differ.Change): its project, the
+# timestamp of the webhook that published it, the datafile revision, kind,
+# entity id, key (and old key, for renames), rendered text and fields as JSON. Rows can't be
+# updated or deleted, and a change recorded twice for the same revision
+# (e.g. on a replay) is only kept once. Lookups by entity, key and kind
+# are all answered from indexes, so they stay fast with millions of rows.
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS changes (
+    id INTEGER PRIMARY KEY,
+    project_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    revision TEXT,
+    kind TEXT,
+    entity_id TEXT,
+    key TEXT,
+    old_key TEXT,
+    text TEXT NOT NULL,
+    fields TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS changes_entity
+    ON changes (project_id, entity_id, timestamp, kind);
+CREATE INDEX IF NOT EXISTS changes_key ON changes (project_id, key);
+CREATE INDEX IF NOT EXISTS changes_old_key ON changes (project_id, old_key);
+CREATE INDEX IF NOT EXISTS changes_kind ON changes (project_id, kind, timestamp);
+CREATE INDEX IF NOT EXISTS changes_timestamp ON changes (project_id, timestamp);
+CREATE TRIGGER IF NOT EXISTS changes_no_update BEFORE UPDATE ON changes
+    BEGIN SELECT RAISE(ABORT, 'changes are append-only'); END;
+CREATE TRIGGER IF NOT EXISTS changes_no_delete BEFORE DELETE ON changes
+    BEGIN SELECT RAISE(ABORT, 'changes are append-only'); END;
+'''
+
+# The kinds of change about each kind of entity.
+ENTITY_KINDS = {
+    'experiment': ('experiment_enabled', 'experiment_paused',
+                   'experiment_renamed', 'traffic_increased',
+                   'traffic_decreased', 'weighting_changed'),
+    'event': ('event_live', 'event_dead', 'event_renamed',
+              'event_experiments_changed'),
+    'group': ('group_traffic_changed',),
+    'rollout_rule': ('rollout_rule_added', 'rollout_rule_removed',
+                     'rollout_rule_enabled', 'rollout_rule_disabled',
+                     'rollout_traffic_changed'),
+    'feature_variable': ('feature_variable_added', 'feature_variable_removed',
+                         'feature_variable_renamed',
+                         'feature_variable_changed'),
+}
+
+Entry = namedtuple('Entry', 'project_id timestamp revision change')
+
+
+class ChangeHistory(object):
+    # One connection, shared by the threads of a process. Other processes
+    # can write to the same file; WAL lets readers carry on meanwhile.
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=timeout,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, project_id, timestamp, changes, revision=None):
+        # Returns how many of `changes` weren't already recorded.
+        rows = [(str(project_id), timestamp, revision, c.kind, c.entity_id,
+                 c.fields.get('key'), c.fields.get('old_key'), c.description,
+                 json.dumps(c.fields, sort_keys=True)) for c in changes]
+        with self.lock, self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO changes (project_id, timestamp, '
+                'revision, kind, entity_id, key, old_key, text, fields) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            return self.db.total_changes - before
+
+    def query(self, project_id, entity_id=None, key=None, entity=None,
+              kinds=None, since=None, until=None, limit=100):
+        # Changes in a project, newest first. entity_id or key pick out
+        # one entity; a key matches every entity that has had it, before
+        # or after a rename. entity ('experiment' or 'event') and kinds
+        # restrict the kinds of change, and since/until (unix timestamps)
+        # the time.
+        project_id = str(project_id)
+        where = ['project_id = ?']
+        args = [project_id]
+
+        if entity:
+            kinds = [k for k in ENTITY_KINDS[entity]
+                     if kinds is None or k in kinds]
+        if kinds is not None:
+            if not kinds:
+                return []
+            kinds_sql = 'kind IN (%s)' % ', '.join('?' * len(kinds))
+
+        # Which index answers the query is spelled out: without statistics
+        # SQLite prefers the timestamp index, to save sorting, and would
+        # scan the whole project for one entity.
+        index = 'changes_timestamp'
+        if entity_id is not None:
+            where.append('entity_id = ?')
+            args.append(str(entity_id))
+            index = 'changes_entity'
+        if key is not None:
+            sub = ('SELECT entity_id FROM changes WHERE project_id = ? AND '
+                   'key = ? UNION SELECT entity_id FROM changes WHERE '
+                   'project_id = ? AND old_key = ?')
+            where.append('entity_id IN (%s)' % sub)
+            args.extend([project_id, key, project_id, key])
+            index = 'changes_entity'
+        if kinds is not None:
+            where.append(kinds_sql)
+            args.extend(kinds)
+            if index == 'changes_timestamp':
+                index = 'changes_kind'
+        if since is not None:
+            where.append('timestamp >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('timestamp < ?')
+            args.append(until)
+
+        sql = ('SELECT project_id, timestamp, revision, kind, entity_id, '
+               'text, fields FROM changes INDEXED BY %s WHERE %s '
+               'ORDER BY timestamp DESC, id DESC' % (index, ' AND '.join(where)))
+        if limit:
+            sql += ' LIMIT ?'
+            args.append(limit)
+
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [entry(*row) for row in rows]
+
+
+def entry(project_id, timestamp, revision, kind, entity_id, text, fields):
+    import differ
+    if kind is None:
+        change = differ.Change(text)
+    else:
+        change = differ.Change(kind=kind, entity_id=entity_id,
+                               **json.loads(fields))
+    return Entry(project_id, timestamp, revision, change)
+
+
+def parse_time(value, now=None):
+    # A unix timestamp, a UTC date or time in ISO 8601, or a number of
+    # days ago, e.g. '30d'.
+    if value.isdigit():
+        return int(value)
+    if value.endswith('d') and value[:-1].isdigit():
+        now = time.time() if now is None else now
+        return int(now - timedelta(days=int(value[:-1])).total_seconds())
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return int(when.timestamp())
+
+
+def write_entries(entries, out, fmt='text'):
+    for e in entries:
+        if fmt == 'json':
+            d = e.change.to_dict()
+            d.update(project_id=e.project_id, timestamp=e.timestamp,
+                     revision=e.revision)
+            out.write(json.dumps(d, sort_keys=True) + '\n')
+            continue
+
+        when = datetime.fromtimestamp(e.timestamp, timezone.utc)
+        out.write('%s  r%-6s %s\n' % (when.strftime('%Y-%m-%d %H:%M:%S'),
+                                      e.revision or '-', e.change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='main.py history',
+        description='Show the recorded changes of a project, newest first.')
+    parser.add_argument('project_id')
+    parser.add_argument('--db', default=os.getenv('CHANGE_HISTORY_DB'),
+                        help='history database (default: $CHANGE_HISTORY_DB)')
+    which = parser.add_mutually_exclusive_group()
+    which.add_argument('--experiment', metavar='KEY_OR_ID')
+    which.add_argument('--event', metavar='KEY_OR_ID')
+    which.add_argument('--entity', metavar='ID',
+                       help='any entity, by id')
+    parser.add_argument('--kind', action='append',
+                        help='only changes of this kind (repeatable)')
+    parser.add_argument('--since', type=parse_time,
+                        help='unix timestamp, ISO date or e.g. 30d')
+    parser.add_argument('--until', type=parse_time)
+    parser.add_argument('--limit', type=int, default=100,
+                        help='at most this many changes (0 for all)')
+    parser.add_argument('--format', choices=['text', 'json'], default='text')
+    args = parser.parse_args(argv)
+    if not args.db:
+        parser.error('no database; pass --db or set CHANGE_HISTORY_DB')
+
+    entity = None
+    name = args.experiment or args.event
+    if args.experiment:
+        entity = 'experiment'
+    elif args.event:
+        entity = 'event'
+    entity_id = args.entity
+    key = None
+    if name is not None:
+        # Optimizely ids are all digits, and keys rarely are.
+        if name.isdigit():
+            entity_id = name
+        else:
+            key = name
+
+    store = ChangeHistory(args.db)
+    try:
+        entries = store.query(args.project_id, entity_id=entity_id, key=key,
+                              entity=entity, kinds=args.kind,
+                              since=args.since, until=args.until,
+                              limit=args.limit)
+    finally:
+        store.close()
+    write_entries(entries, sys.stdout, args.format)
@@ -0,0 +1,203 @@
+# A storage backend on local disk, for running the function under load
+# without GCS or for projects that need a faster store. LocalBucket has
+# the same subset of the google.cloud.storage Bucket/Blob API that main.py
+# uses (and that fake_gcs.py fakes), and raises the same exceptions.
+#
+# Objects are plain files under the root directory, laid out like the
+# bucket, so `main.py replay --local` can read them as they are. Files are
+# never modified in place: writes go to a temporary file that is renamed
+# over the object, so readers see either the old or the new contents.
+#
+# Generations come from a counter kept in the directory, so like GCS's
+# they never repeat, however quickly an object is rewritten. Each
+# object's generation is kept in a file of the same name under
+# .generations/. Writes bump the counter and replace the object and its
+# generation while holding an exclusive lock on a lock file, and reads
+# hold a shared one, so compare-and-swap on the latest pointer works
+# across threads and processes.
+from contextlib import contextmanager
+import fcntl
+import os
+import tempfile
+import threading
+
+
+LOCK_NAME = '.lock'
+COUNTER_NAME = '.generation'
+GENERATIONS_DIR = '.generations'
+
+# The generation of objects written some other way, e.g. copied in from a
+# bucket. The counter starts above it.
+UNKNOWN_GENERATION = 1
+
+
+def object_names(root, prefix=None):
+    # Names of the objects under `root`, starting with `prefix`, leaving
+    # out the lock, the generations and any half-written temporary files.
+    top = root
+    if prefix:
+        top = os.path.join(root, *prefix.split('/')[:-1])
+    names = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            full = os.path.join(dirpath, filename)
+            name = os.path.relpath(full, root).replace(os.sep, '/')
+            if prefix is None or name.startswith(prefix):
+                names.append(name)
+    return sorted(names)
+
+
+def replace(path, data):
+    # Atomically replaces the file at `path` with `data`.
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def read_number(path, default):
+    try:
+        with open(path, 'rb') as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return default
+
+
+class LocalBucket(object):
+    def __init__(self, root, name='local'):
+        self.root = os.path.abspath(root)
+        self.name = name
+        os.makedirs(self.root, exist_ok=True)
+        self.lock_path = os.path.join(self.root, LOCK_NAME)
+        self.counter_path = os.path.join(self.root, COUNTER_NAME)
+        self.lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def generation_path(self, name):
+        return os.path.join(self.root, GENERATIONS_DIR, *name.split('/'))
+
+    @contextmanager
+    def locked(self, exclusive):
+        # The thread lock covers threads in this process, which flock
+        # doesn't reliably tell apart; readers only need the file lock.
+        with open(self.lock_path, 'a') as lock:
+            if exclusive:
+                self.lock.acquire()
+            try:
+                fcntl.flock(lock.fileno(),
+                            fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            finally:
+                if exclusive:
+                    self.lock.release()
+
+    def generation(self, name):
+        # The object's current generation, 0 if it doesn't exist. Call
+        # with the lock held.
+        if not os.path.exists(self.path(name)):
+            return 0
+        return read_number(self.generation_path(name), UNKNOWN_GENERATION)
+
+    def read(self, name):
+        # Returns (data, generation) for an object, as of one moment.
+        with self.locked(exclusive=False):
+            with open(self.path(name), 'rb') as f:
+                data = f.read()
+            return data, self.generation(name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name, **kwargs):
+        with self.locked(exclusive=False):
+            current = self.generation(name)
+        if not current:
+            return None
+        b = LocalBlob(self, name)
+        b.generation = current
+        return b
+
+    def list_blobs(self, prefix=None):
+        blobs = []
+        for name in object_names(self.root, prefix):
+            b = self.get_blob(name)
+            if b is not None:
+                blobs.append(b)
+        return blobs
+
+    def write(self, name, data, if_generation_match=None):
+        from google.api_core.exceptions import PreconditionFailed
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            with self.locked(exclusive=True):
+                if if_generation_match is not None:
+                    current = self.generation(name)
+                    if current != if_generation_match:
+                        raise PreconditionFailed('%s generation %s != %s' % (
+                            name, current, if_generation_match))
+                written = read_number(
+                    self.counter_path, UNKNOWN_GENERATION) + 1
+                replace(self.counter_path, str(written).encode('ascii'))
+                replace(self.generation_path(name),
+                        str(written).encode('ascii'))
+                os.replace(tmp, path)
+            return written
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+
+class LocalBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    @property
+    def path(self):
+        return '/b/%s/o/%s' % (self.bucket.name, self.name)
+
+    def exists(self):
+        return os.path.exists(self.bucket.path(self.name))
+
+    def download_as_bytes(self, if_generation_match=None, **kwargs):
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+        try:
+            data, current = self.bucket.read(self.name)
+        except FileNotFoundError:
+            raise NotFound(self.name)
+        if if_generation_match is not None and \
+           if_generation_match != current:
+            raise PreconditionFailed(self.name)
+        self.generation = current
+        return data
+
+    download_as_string = download_as_bytes
+
+    def upload_from_string(self, data, content_type='text/plain',
+                           if_generation_match=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.generation = self.bucket.write(
+            self.name, data, if_generation_match)
@@ -1,12 +1,20 @@
+from cache import LRUCache
+import coalesce
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import deltas
 import differ
-from flask import abort
-from google.cloud import storage
-from hashlib import sha1
-import hmac
+from functools import wraps
+from hashlib import sha256
 import json
 import logging
+import metrics
 import os
-import requests
+import shards
+import signatures
+import threading
+import time
+import tracing
 from urllib.parse import urlparse
 
 
@@ -16,42 +24,274 @@ logging.basicConfig(
 
 logger = logging.getLogger('optimizely-changes')
 
+# Cold starts pay for every import at the top of this file, whatever the
+# request turns out to be. The storage client, requests, Flask and the
+# Slack notifier are slow to import and not needed by every request (a
+# snippet update never touches storage, and a rejected signature needs
+# none of them), so they're imported where they're used.
+
+# The latest datafile for a project is found through a small pointer blob
+# naming the archived revision. `generation` is the generation of the
+# pointer blob itself (0 if there is none yet), which is what writers use
+# as their compare-and-swap precondition.
+Latest = namedtuple('Latest', 'generation pointer datafile')
+
+Fetched = namedtuple('Fetched', 'content sha256 canonical_sha256 datafile')
+
+# `base` is None for a full copy. For a delta it names the snapshot the
+# delta applies to: {'path', 'generation', 'deltas'}, where `deltas` counts
+# the revisions stored against that snapshot so far.
+Revision = namedtuple('Revision',
+                      'path generation sha256 canonical_sha256 datafile base')
+
+# Top-level datafile fields that change on every revision without changing
+# anything the differ reports on. They are left out of the canonical digest.
+VOLATILE_DATAFILE_FIELDS = frozenset(['revision'])
+
+# How many times to re-read and retry when another webhook moves the
+# pointer between our read and our write.
+LATEST_SWAP_ATTEMPTS = 5
+
+
+class LatestPointerConflict(Exception):
+    pass
+
+
+# project_id -> Latest for the latest datafile this instance has seen.
+# Entries are only trusted while the generation of the pointer blob in GCS
+# still matches.
+LATEST_DATAFILE_CACHE_SIZE = 64
+
+latest_datafiles = LRUCache(LATEST_DATAFILE_CACHE_SIZE)
+
+# With ARCHIVE_FORMAT=delta, revisions are archived as gzipped patches
+# against the last full snapshot. A new snapshot is taken every
+# ARCHIVE_SNAPSHOT_INTERVAL revisions, or sooner once a delta stops being
+# much smaller than the datafile itself.
+ARCHIVE_SNAPSHOT_INTERVAL = 50
+ARCHIVE_DELTA_MAX_RATIO = 0.5
+
+# (path, generation) -> parsed snapshot, for rebuilding deltas.
+SNAPSHOT_CACHE_SIZE = 16
+
+snapshots = LRUCache(SNAPSHOT_CACHE_SIZE)
+
+
+# Instance-wide objects are built at most once, even when the first
+# requests on a cold instance arrive together.
+_build_lock = threading.RLock()
+
+def once(cache, key, build):
+    value = cache.get(key)
+    if value is None:
+        with _build_lock:
+            value = cache.get(key)
+            if value is None:
+                value = cache[key] = build()
+    return value
+
 
 def slack_url():
     return os.getenv('SLACK_URL')
 
 def webhook_secrets():
-    return [x.strip() for x in os.getenv('OPTIMIZELY_WEBHOOK_SECRET').split(',')]
+    return signatures.parse_secrets(os.getenv('OPTIMIZELY_WEBHOOK_SECRET'))[0]
+
+# Verifiers are cached by the secret config they were built from.
+_verifiers = {}
+
+def verifier():
+    config = os.getenv('OPTIMIZELY_WEBHOOK_SECRET')
+    v = _verifiers.get(config)
+    if v is None:
+        _verifiers.clear()
+        v = _verifiers[config] = signatures.WebhookVerifier.from_config(config)
+    return v
+
+# The storage client and bucket handle are kept for the life of a warm
+# function instance. The bucket is re-fetched periodically, and both are
+# dropped whenever a storage call fails so the next request starts clean.
+GCS_BUCKET_TTL = 15 * 60
+
+_gcs = {}
+
+def gcs_client():
+    def build():
+        from google.cloud import storage
+        return storage.Client()
+    return once(_gcs, 'client', build)
+
+def archive_format():
+    return os.getenv('ARCHIVE_FORMAT') or 'full'
+
+def coalesce_windows():
+    return coalesce.parse_windows(
+        os.getenv('NOTIFY_COALESCE_SECONDS'),
+        os.getenv('NOTIFY_COALESCE_PROJECT_SECONDS'))
 
 def gcs_bucket():
-    gcs = storage.Client()
-    return gcs.get_bucket(os.getenv('GCS_BUCKET_NAME'))
+    name = os.getenv('GCS_BUCKET_NAME')
+    cached = _gcs.get('bucket')
+    if cached and cached[0] == name and time.monotonic() < cached[2]:
+        return cached[1]
+
+    bucket = gcs_client().get_bucket(name)
+    _gcs['bucket'] = (name, bucket, time.monotonic() + GCS_BUCKET_TTL)
+    return bucket
+
+# Where datafiles are archived. Setting LOCAL_STORAGE_DIR swaps GCS for a
+# directory on local disk (see local_storage.py), e.g. for load tests.
+def storage_bucket():
+    root = os.getenv('LOCAL_STORAGE_DIR')
+    if not root:
+        return gcs_bucket()
+
+    cached = _gcs.get('local')
+    if cached and cached.root == os.path.abspath(root):
+        return cached
+
+    import local_storage
+    bucket = _gcs['local'] = local_storage.LocalBucket(root)
+    return bucket
+
+# Datafiles are fetched through one keep-alive session per instance.
+CDN_TIMEOUT = 30
+
+_http = {}
+
+def http_session():
+    def build():
+        import requests
+        return requests.Session()
+    return once(_http, 'session', build)
+
+# One dispatcher per Slack url, shared by every request on the instance.
+# Delivery carries on after the webhook has returned; note that Cloud
+# Functions may throttle an instance's CPU once there is no request in
+# flight, which at worst delays a notification until the next request.
+NOTIFY_WORKERS = 4
+
+_dispatchers = {}
+
+def dispatcher(url):
+    def build():
+        import notifications
+        return notifications.Dispatcher(
+            notifications.SlackSink(url, pool_size=NOTIFY_WORKERS),
+            max_workers=NOTIFY_WORKERS)
+    return once(_dispatchers, url, build)
+
+_coalescers = {}
+
+def coalescer():
+    default, windows = coalesce_windows()
+    key = (default, tuple(sorted(windows.items())))
+    return once(_coalescers, key, lambda: coalesce.Coalescer(
+        notify_changes, window=default, windows=windows))
+
+# Detected changes are also recorded in a local SQLite database (see
+# history.py) when CHANGE_HISTORY_DB names one.
+_history = {}
+
+def change_history():
+    path = os.getenv('CHANGE_HISTORY_DB')
+    if not path:
+        return None
+    def build():
+        import history
+        return history.ChangeHistory(path)
+    return once(_history, path, build)
+
+# Datafile updates for the same project are processed one at a time on an
+# instance, so concurrent revisions can't both diff against the same
+# latest datafile. Across instances, the latest pointer's generation
+# precondition does the same job.
+PROJECT_WORKERS = 8
+
+_projects = {}
+
+def project_executor():
+    return once(_projects, 'executor',
+                lambda: shards.ProjectExecutor(PROJECT_WORKERS))
+
+# Each datafile update reads the latest datafile while it fetches the new
+# one, and archives the new one while it diffs. At most one of those runs
+# here per project worker.
+_pipeline = {}
+
+def pipeline():
+    return once(_pipeline, 'executor', lambda: ThreadPoolExecutor(
+        max_workers=PROJECT_WORKERS, thread_name_prefix='pipeline'))
+
+def reset_gcs():
+    _gcs.clear()
+    latest_datafiles.clear()
+    snapshots.clear()
+
+def storage_errors():
+    # Errors that may mean the client or bucket has gone bad: credentials,
+    # the connection or the service itself. Other 4xx errors, such as
+    # PreconditionFailed and NotFound, are about one request, and are
+    # common under contention. Only evaluated once something has been
+    # raised.
+    from google.api_core.exceptions import Forbidden, RetryError, \
+        ServerError, Unauthorized
+    from google.auth.exceptions import GoogleAuthError
+    from requests.exceptions import ConnectionError, Timeout
+    return (ServerError, RetryError, Unauthorized, Forbidden,
+            GoogleAuthError, ConnectionError, Timeout)
+
+def invalidates_gcs(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except storage_errors():
+            logger.warning('Storage call failed; dropping cached GCS handles')
+            reset_gcs()
+            raise
+    return wrapper
 
 def webhook_post(request):
-    verify_request(request)
+    with tracing.trace('webhook') as t:
+        verify_request(request)
 
-    event = request.json['event']
-    if event == 'project.datafile_updated':
-        datafile_updated(request.json)
-        return 'ok'
-    elif event == 'project.snippet_updated':
-        snippet_updated(request.json)
-        return 'ok'
+        event = request.json['event']
+        t.set(event=event, project_id=request.json.get('project_id'))
+        if event == 'project.datafile_updated':
+            payload = request.json
+            project_executor().submit(
+                payload['project_id'], tracing.bind(datafile_updated),
+                payload).result()
+            return 'ok'
+        elif event == 'project.snippet_updated':
+            snippet_updated(request.json)
+            return 'ok'
 
-    return 'unhandled event'
+        return 'unhandled event'
 
 
+@tracing.timed('verify_request')
 def verify_request(request):
     sig = request.headers.get('X-Hub-Signature')
     if not sig:
-        abort(400)
-
-    for secret in webhook_secrets():
-        key = bytes(secret, 'utf-8')
-        csig = 'sha1=' + hmac.new(
-            key, msg=request.get_data(), digestmod=sha1).hexdigest()
-        if csig == sig:
-            return
+        reject()
+
+    # The project id is only a hint for which secret to try first; the
+    # payload is trusted once one of the secrets matches.
+    try:
+        project_id = request.json.get('project_id')
+    except Exception:
+        project_id = None
+
+    data = request.get_data()
+    tracing.annotate(bytes=len(data))
+    if not verifier().verify(data, sig, project_id):
+        reject()
+
+
+def reject():
+    from flask import abort
     abort(400)
 
 
@@ -72,61 +312,361 @@ def datafile_updated(payload):
     if '/datafiles/' not in data['cdn_url']:
         return
 
-    old_datafile = load_latest_datafile(payload)
-    current_datafile = save_datafile(payload)
-    desc = differ.describe(old_datafile, current_datafile)
+    # Neither read depends on the other.
+    loading = pipeline().submit(tracing.bind(load_latest), payload)
+    fetched = fetch_datafile(payload)
+    latest = loading.result()
+    if is_duplicate(payload, latest, fetched):
+        touch_latest(payload, latest)
+        return
+
+    # Diff against what we read while the new revision is archived. If
+    # another revision gets published first, the pointer swap is retried
+    # and we diff again against that one.
+    archiving = pipeline().submit(
+        tracing.bind(archive_datafile), payload, fetched, latest)
+    changes = None
+    if latest.datafile is not None:
+        changes = diff_datafiles(latest.datafile, fetched.datafile)
+
+    replaced = archiving.result()
+    if replaced is None:
+        return
+
+    if replaced.datafile is None:
+        logger.info('No previous datafile for project %s to diff against' %
+                    payload['project_id'])
+        return
+
+    if replaced is not latest:
+        changes = diff_datafiles(replaced.datafile, fetched.datafile)
+    record_changes(payload, fetched.datafile, changes)
+    coalescer().add(payload['project_id'], changes)
+
+
+def archive_datafile(payload, fetched, latest):
+    current = save_datafile(payload, fetched, latest)
+    return publish_latest(payload, current, latest)
+
+
+def diff_datafiles(old, current):
+    with tracing.span('diff') as s:
+        changes = differ.DatafileDiffer(old, current).changes()
+        s.set(experiments=len(current.get('experiments', ())),
+              events=len(current.get('events', ())),
+              changes=len(changes))
+    return changes
+
+
+def record_changes(payload, datafile, changes):
+    store = change_history()
+    if store is None or not changes:
+        return
+
+    # The history is a convenience; failing to write it mustn't hold up
+    # the notification.
+    with tracing.span('record_changes') as s:
+        try:
+            s.set(recorded=store.record(
+                payload['project_id'], payload['timestamp'], changes,
+                datafile.get('revision')))
+        except Exception:
+            logger.exception('Failed to record changes for project %s' %
+                             payload['project_id'])
+            s.set(error='recording')
+
+
+def notify_changes(project_id, changes):
+    desc = differ.render(changes)
     if desc:
         notify(desc)
 
 
+@tracing.timed('notify')
 def notify(description):
     logger.info('Notifying for change: %s' % description)
+    tracing.annotate(chars=len(description))
 
     url = slack_url()
     if not url:
         return
 
-    requests.post(url, json={
-	    'username': 'Optimizely',
-	    'icon_url': 'https://app.optimizely.com/static/img/favicon-32x32.png',
-        'text': description,
-    })
+    dispatcher(url).submit(description)
 
 
 def load_latest_datafile(payload):
-    bucket = gcs_bucket()
+    return load_latest(payload).datafile
+
+
+@tracing.timed('load_latest')
+@invalidates_gcs
+def load_latest(payload):
+    bucket = storage_bucket()
+
+    # The pointer can be replaced between reading its generation and its
+    # contents; if so, it's read again.
+    pointer_path = latest_pointer_gcs_path(payload)
+    for _ in range(LATEST_SWAP_ATTEMPTS):
+        b = bucket.get_blob(pointer_path)
+        if b is None:
+            return load_legacy_latest(bucket, payload)
+
+        cached = latest_datafiles.get(payload['project_id'])
+        if cached and cached.generation == b.generation:
+            logger.info('Using cached latest datafile for generation %s' %
+                        b.generation)
+            tracing.annotate(cached=True)
+            return cached
+
+        try:
+            pointer = json.loads(
+                b.download_as_string(if_generation_match=b.generation))
+        except precondition_failed():
+            logger.warning('Latest pointer for project %s moved while '
+                           'reading it; re-reading' % payload['project_id'])
+            continue
+
+        data = bucket.blob(pointer['path']).download_as_string(
+            if_generation_match=pointer['generation'])
+        tracing.annotate(cached=False, bytes=len(data))
+        if pointer.get('base'):
+            # Rebuilding a delta takes one more read, of its snapshot,
+            # however many revisions have been stored against it.
+            base = load_snapshot(bucket, pointer['base'])
+            data = deltas.apply_patch(base, deltas.decode(data)['patch'])
+        else:
+            data = json.loads(data)
+        latest = Latest(b.generation, pointer, data)
+        latest_datafiles.put(payload['project_id'], latest)
+        logger.info('Loaded latest datafile from %s' % pointer['path'])
+        return latest
+
+    raise LatestPointerConflict(
+        'Could not read latest pointer for project %s' % payload['project_id'])
+
+
+def load_snapshot(bucket, base):
+    key = (base['path'], base['generation'])
+    data = snapshots.get(key)
+    if data is None:
+        data = json.loads(bucket.blob(base['path']).download_as_string(
+            if_generation_match=base['generation']))
+        snapshots.put(key, data)
+    return data
+
 
+def load_legacy_latest(bucket, payload):
+    # Projects archived before the pointer existed keep a full copy of the
+    # latest datafile. Read it until the first pointer is written.
     latest_path = latest_datafile_gcs_path(payload)
-    b = bucket.blob(latest_path)
-    if not b.exists():
+    b = bucket.get_blob(latest_path)
+    if b is None:
         logger.info('No existing latest datafile found')
-        return None
+        return Latest(0, None, None)
 
-    data = json.loads(b.download_as_string())
-    logger.info('Loaded latest datafile from %s' % latest_path)
-    return data
+    logger.info('Loaded legacy latest datafile from %s' % latest_path)
+    data = b.download_as_string()
+    tracing.annotate(cached=False, bytes=len(data), legacy=True)
+    return Latest(0, None, json.loads(data))
 
 
-def save_datafile(payload):
+@tracing.timed('fetch_datafile')
+def fetch_datafile(payload):
     url = payload['data']['origin_url']
-    response = requests.get(url)
+    response = http_session().get(url, timeout=CDN_TIMEOUT)
+    response.raise_for_status()
+
+    # The raw body is uploaded and parsed as-is, without decoding it to a
+    # str first.
+    content = response.content
+    datafile = json.loads(content)
+    tracing.annotate(bytes=len(content))
+    return Fetched(content, sha256(content).hexdigest(),
+                   canonical_digest(datafile), datafile)
+
+
+def canonical_digest(datafile):
+    canonical = { k: v for k, v in datafile.items()
+                  if k not in VOLATILE_DATAFILE_FIELDS }
+    return sha256(json.dumps(
+        canonical, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ).hexdigest()
+
+
+# Optimizely resends identical datafiles, and bumps the revision without
+# changing anything else. Either way there is nothing to archive or diff.
+def is_duplicate(payload, latest, fetched):
+    pointer = latest.pointer or {}
+    if pointer.get('sha256') == fetched.sha256:
+        result = 'raw'
+    elif pointer.get('canonical_sha256') == fetched.canonical_sha256:
+        result = 'canonical'
+    else:
+        result = 'miss'
+
+    metrics.incr('datafile.dedupe', result=result)
+    if result == 'miss':
+        return False
+
+    logger.info('Datafile for project %s matches %s (%s); skipping' % (
+        payload['project_id'], pointer['path'], result))
+    return True
+
+
+# A duplicate that is newer than the latest pointer still moves the
+# pointer's timestamp forward, without archiving anything, so that an
+# older revision arriving late can't be published over it.
+def touch_latest(payload, latest):
+    pointer = latest.pointer
+    if pointer['timestamp'] >= payload['timestamp']:
+        return
 
-    bucket = gcs_bucket()
-    b = bucket.blob(datafile_gcs_path(payload))
-    b.upload_from_string(response.text)
-    logger.info('Wrote %s' % b.path)
+    revision = Revision(pointer['path'], pointer['generation'],
+                        pointer['sha256'], pointer['canonical_sha256'],
+                        latest.datafile, pointer.get('base'))
+    publish_latest(payload, revision, latest)
+
+
+@tracing.timed('save_datafile')
+@invalidates_gcs
+def save_datafile(payload, fetched, latest=None):
+    bucket = storage_bucket()
+    if archive_format() == 'delta' and latest and latest.pointer:
+        revision = save_delta(bucket, payload, fetched, latest)
+        if revision:
+            return revision
+
+    b, _ = write_archive(bucket, datafile_gcs_path(payload), fetched.content,
+                         'application/json')
+    logger.info('Wrote %s (%d bytes)' % (b.path, len(fetched.content)))
+    tracing.annotate(format='full', bytes=len(fetched.content))
+
+    snapshots.put((b.name, b.generation), fetched.datafile)
+    return Revision(b.name, b.generation, fetched.sha256,
+                    fetched.canonical_sha256, fetched.datafile, None)
+
+
+# Archives `fetched` as a delta against the snapshot behind `latest`, or
+# returns None if it's time for a new snapshot.
+def save_delta(bucket, payload, fetched, latest):
+    pointer = latest.pointer
+    base = pointer.get('base') or {
+        'path': pointer['path'], 'generation': pointer['generation'],
+        'deltas': 0,
+    }
+    if base['deltas'] + 1 >= ARCHIVE_SNAPSHOT_INTERVAL:
+        return None
 
-    latest_path = latest_datafile_gcs_path(payload)
-    bucket.copy_blob(b, bucket, latest_path)
-    logger.info('Copied %s to %s' % (b.path, latest_path))
+    if pointer.get('base'):
+        snapshot = load_snapshot(bucket, base)
+    else:
+        snapshot = latest.datafile
+    data = deltas.encode(base['path'], base['generation'],
+                         deltas.make_patch(snapshot, fetched.datafile))
+    if len(data) > ARCHIVE_DELTA_MAX_RATIO * len(fetched.content):
+        return None
 
-    return response.json()
+    b, written = write_archive(
+        bucket, datafile_gcs_path(payload) + deltas.DELTA_SUFFIX, data,
+        'application/octet-stream')
+    logger.info('Wrote %s (%d bytes, delta against %s)' % (
+        b.path, len(data), base['path']))
+    tracing.annotate(format='delta', bytes=len(data))
+
+    base = dict(base, deltas=base['deltas'] + 1)
+    if not written:
+        # The delta kept may be against another snapshot, read by whoever
+        # wrote it; its pointer has to name that one. How many deltas that
+        # snapshot has isn't known, so the next revision takes a new one.
+        header = deltas.decode(b.download_as_string(
+            if_generation_match=b.generation))
+        if (header['base'], header['base_generation']) != \
+           (base['path'], base['generation']):
+            base = {'path': header['base'],
+                    'generation': header['base_generation'],
+                    'deltas': ARCHIVE_SNAPSHOT_INTERVAL - 1}
+
+    return Revision(b.name, b.generation, fetched.sha256,
+                    fetched.canonical_sha256, fetched.datafile, base)
+
+
+# Archived revisions are written once, and never replaced: a redelivered
+# webhook handled by two instances at once writes the same path twice, and
+# replacing the first object would leave pointers naming it unreadable.
+# The second write keeps the first object instead. Returns the blob, and
+# whether it was written here.
+def write_archive(bucket, path, data, content_type):
+    b = bucket.blob(path)
+    try:
+        b.upload_from_string(data, content_type=content_type,
+                             if_generation_match=0)
+        return b, True
+    except precondition_failed():
+        existing = bucket.get_blob(path)
+        logger.info('%s is already archived, at generation %s' % (
+            path, existing.generation))
+        return existing, False
+
+
+def precondition_failed():
+    from google.api_core.exceptions import PreconditionFailed
+    return PreconditionFailed
+
+
+# Points the project's latest pointer at `revision`. `latest` is what the
+# caller read before archiving; if another webhook has moved the pointer
+# since, it is re-read and the swap retried. Returns the Latest that was
+# replaced, which is what the new revision should be diffed against, or
+# None if a newer revision has already been published.
+@tracing.timed('publish_latest')
+@invalidates_gcs
+def publish_latest(payload, revision, latest):
+    bucket = storage_bucket()
+    b = bucket.blob(latest_pointer_gcs_path(payload))
+
+    for _ in range(LATEST_SWAP_ATTEMPTS):
+        if latest.pointer and latest.pointer['timestamp'] > payload['timestamp']:
+            logger.info('Skipping %s; %s is newer' % (
+                revision.path, latest.pointer['path']))
+            return None
+
+        pointer = {
+            'path': revision.path,
+            'generation': revision.generation,
+            'sha256': revision.sha256,
+            'canonical_sha256': revision.canonical_sha256,
+            'timestamp': payload['timestamp'],
+        }
+        if revision.base:
+            pointer['base'] = revision.base
+        try:
+            b.upload_from_string(json.dumps(pointer),
+                                 content_type='application/json',
+                                 if_generation_match=latest.generation)
+        except precondition_failed():
+            logger.warning('Latest pointer for project %s moved; retrying' %
+                           payload['project_id'])
+            latest = load_latest(payload)
+            continue
+
+        logger.info('Pointed %s at %s' % (b.name, revision.path))
+        latest_datafiles.put(
+            payload['project_id'],
+            Latest(b.generation, pointer, revision.datafile))
+        return latest
+
+    raise LatestPointerConflict(
+        'Could not update latest pointer for project %s' % payload['project_id'])
 
 
 def latest_datafile_gcs_path(payload):
     return 'datafile/%s/_latest/datafile.json' % payload['project_id']
 
 
+def latest_pointer_gcs_path(payload):
+    return 'datafile/%s/_latest/pointer.json' % payload['project_id']
+
+
 def datafile_gcs_path(payload):
     filename = urlparse(payload['data']['origin_url']).path.split('/')[-1]
     return 'datafile/%s/%s/%s' % (
@@ -146,5 +686,21 @@ def test_server():
     app.run(port=4000)
 
 
+def replay(argv=None):
+    import replay
+    replay.main(argv)
+
+
+def history(argv=None):
+    import history
+    history.main(argv)
+
+
 if __name__ == '__main__':
-    test_server()
+    import sys
+    if sys.argv[1:2] == ['replay']:
+        replay(sys.argv[2:])
+    elif sys.argv[1:2] == ['history']:
+        history(sys.argv[2:])
+    else:
+        test_server()
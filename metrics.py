@@ -0,0 +1,34 @@
+# Process-wide counters. Every increment is also logged as a structured
+# line, so counts can be aggregated across instances from the logs.
+from collections import Counter
+import json
+import logging
+import threading
+
+
+logger = logging.getLogger('optimizely-changes.metrics')
+
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def incr(name, value=1, **tags):
+    key = (name,) + tuple(sorted(tags.items()))
+    with _lock:
+        _counters[key] += value
+
+    fields = {'metric': name, 'value': value}
+    fields.update(tags)
+    logger.info(json.dumps(fields, sort_keys=True))
+
+
+def count(name, **tags):
+    # Sums every counter for `name` whose tags include `tags`.
+    with _lock:
+        return sum(v for k, v in _counters.items()
+                   if k[0] == name and set(tags.items()) <= set(k[1:]))
+
+
+def reset():
+    with _lock:
+        _counters.clear()
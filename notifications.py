@@ -0,0 +1,150 @@
+# Delivers notifications off the webhook's request thread. A Dispatcher
+# hands each message to a small thread pool, which sends it to a Sink and
+# retries transient failures with exponential backoff.
+from concurrent.futures import ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+import logging
+import math
+import requests
+import threading
+import time
+import tracing
+
+
+logger = logging.getLogger('optimizely-changes.notifications')
+
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super(RetryableError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value, now=None):
+    # Seconds to wait, from a Retry-After header of either a number of
+    # seconds or an HTTP date. None if it's missing or can't be read
+    # (including 'inf' and 'nan'), in which case the dispatcher backs off
+    # exponentially.
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        return max(seconds, 0) if math.isfinite(seconds) else None
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when is None or when.tzinfo is None:
+        return None
+    now = time.time() if now is None else now
+    return max(when.timestamp() - now, 0)
+
+
+class Sink(object):
+    # Sinks deliver one message. They raise RetryableError for failures
+    # worth retrying; any other exception gives up on the message.
+    def send(self, text):
+        raise NotImplementedError
+
+
+class LogSink(Sink):
+    def send(self, text):
+        logger.info('Notification: %s' % text)
+
+
+class SlackSink(Sink):
+    # (connect, read) timeouts, in seconds.
+    TIMEOUT = (3.05, 10)
+
+    def __init__(self, url, pool_size=4, timeout=TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def send(self, text):
+        try:
+            response = self.session.post(self.url, timeout=self.timeout, json={
+                'username': 'Optimizely',
+                'icon_url': 'https://app.optimizely.com/static/img/favicon-32x32.png',
+                'text': text,
+            })
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableError(str(e))
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableError(
+                'Slack returned %s' % response.status_code,
+                parse_retry_after(response.headers.get('Retry-After')))
+        response.raise_for_status()
+
+
+class Dispatcher(object):
+    def __init__(self, sink, max_workers=4, attempts=5, backoff=0.5,
+                 max_backoff=30, sleep=time.sleep):
+        self.sink = sink
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='notify')
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def submit(self, text):
+        future = self.executor.submit(self.deliver, text)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def deliver(self, text):
+        with tracing.span('notify.deliver', chars=len(text)) as s:
+            delivered = self.retry(text, s)
+            s.set(delivered=delivered)
+            return delivered
+
+    def retry(self, text, span):
+        for attempt in range(self.attempts):
+            span.set(attempts=attempt + 1)
+            try:
+                self.sink.send(text)
+                return True
+            except RetryableError as e:
+                if attempt + 1 == self.attempts:
+                    logger.error('Giving up on notification after %d '
+                                 'attempts: %s' % (self.attempts, e))
+                    return False
+
+                # However long the server asks for, a worker is only tied
+                # up for max_backoff.
+                delay = e.retry_after
+                if delay is None or not math.isfinite(delay):
+                    delay = self.backoff * 2 ** attempt
+                delay = min(max(delay, 0), self.max_backoff)
+                logger.warning('Notification failed (%s); retrying in %.2fs' % (
+                    e, delay))
+                self.sleep(delay)
+            except Exception:
+                logger.exception('Notification failed')
+                return False
+
+    def flush(self, timeout=None):
+        # Waits for everything submitted so far to be delivered or given up.
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending, timeout=timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
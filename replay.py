@@ -0,0 +1,186 @@
+# Rebuilds a project's change history from its datafile archive: lists the
+# archived revisions in timestamp order and diffs each against the one
+# before it, across a pool of processes.
+#
+#   python main.py replay 10847551550 --local ./archive --output CHANGELOG.md
+#   python main.py replay 10847551550 --bucket example-optimizely-datafiles
+#
+# A local archive is a directory laid out like the bucket, i.e. holding
+# datafile/<project_id>/<timestamp>/<name>.json. Revisions archived as
+# deltas (see deltas.py) are rebuilt from their snapshots.
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import deltas
+import differ
+import json
+from local_storage import object_names
+import os
+import sys
+
+
+class LocalArchive(object):
+    def __init__(self, root):
+        self.root = root
+
+    def list(self, prefix):
+        # A live LOCAL_STORAGE_DIR also has lock, generation and
+        # half-written temporary files, which aren't revisions.
+        return object_names(self.root, prefix)
+
+    def read(self, path):
+        with open(os.path.join(self.root, path), 'rb') as f:
+            return f.read()
+
+
+class GCSArchive(object):
+    def __init__(self, bucket_name):
+        from google.cloud import storage
+        self.bucket = storage.Client().bucket(bucket_name)
+
+    def list(self, prefix):
+        return [b.name for b in self.bucket.list_blobs(prefix=prefix)]
+
+    def read(self, path):
+        return self.bucket.blob(path).download_as_string()
+
+
+def open_archive(spec):
+    kind, location = spec
+    return LocalArchive(location) if kind == 'local' else GCSArchive(location)
+
+
+def revisions(archive, project_id):
+    # (timestamp, path) for every archived revision, oldest first.
+    prefix = 'datafile/%s/' % project_id
+    found = []
+    for path in archive.list(prefix):
+        parts = path[len(prefix):].split('/')
+        if len(parts) == 2 and parts[0].isdigit():
+            found.append((int(parts[0]), path))
+    return sorted(found)
+
+
+# Each worker process opens the archive once, and keeps the snapshots it
+# has parsed while they are still being used as delta bases.
+_worker = {}
+
+WORKER_SNAPSHOTS = 4
+
+def init_worker(spec, engine, structured=False):
+    _worker['archive'] = open_archive(spec)
+    _worker['engine'] = engine
+    _worker['structured'] = structured
+    _worker['snapshots'] = {}
+
+
+def diff_pair(pair):
+    (_, old_path), (timestamp, path) = pair
+    read = _worker['archive'].read
+    snapshots = _worker['snapshots']
+    if len(snapshots) > WORKER_SNAPSHOTS:
+        snapshots.clear()
+    old = deltas.read_revision(read, old_path, snapshots)
+    current = deltas.read_revision(read, path, snapshots)
+    changes = differ.DatafileDiffer(old, current, _worker['engine']).changes()
+    if not _worker['structured']:
+        changes = [str(c) for c in changes]
+    return timestamp, path, current.get('revision'), changes
+
+
+def replay(spec, project_id, engine=differ.DEFAULT_ENGINE, processes=None,
+           chunksize=4, structured=False):
+    # Yields (timestamp, path, revision, changes) for every revision after
+    # the first, in timestamp order. changes are their text, or the
+    # differ.Change objects if structured.
+    found = revisions(open_archive(spec), project_id)
+    pairs = list(zip(found, found[1:]))
+    if not pairs:
+        return
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                             initargs=(spec, engine, structured)) as pool:
+        for result in pool.map(diff_pair, pairs, chunksize=chunksize):
+            yield result
+
+
+def recorded(entries, project_id, path):
+    # Passes entries through, recording their changes on the way.
+    import history
+    store = history.ChangeHistory(path)
+    try:
+        for entry in entries:
+            timestamp, _, revision, changes = entry
+            store.record(project_id, timestamp, changes, revision)
+            yield entry
+    finally:
+        store.close()
+
+
+def write_changelog(entries, out, fmt='markdown', include_empty=False):
+    for timestamp, path, revision, changes in entries:
+        if not changes and not include_empty:
+            continue
+
+        if fmt == 'json':
+            out.write(json.dumps({
+                'timestamp': timestamp,
+                'path': path,
+                'revision': revision,
+                'changes': [str(c) for c in changes],
+            }, sort_keys=True) + '\n')
+            continue
+
+        when = datetime.fromtimestamp(timestamp, timezone.utc)
+        out.write('## %s (revision %s)\n\n' % (
+            when.strftime('%Y-%m-%d %H:%M:%S UTC'), revision))
+        for c in changes:
+            out.write('* %s\n' % c)
+        if not changes:
+            out.write('No changes.\n')
+        out.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='main.py replay',
+        description='Rebuild the change history of a project from its '
+                    'archived datafiles.')
+    parser.add_argument('project_id')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--local', metavar='DIR',
+                        help='directory laid out like the GCS bucket')
+    source.add_argument('--bucket', help='GCS bucket name')
+    parser.add_argument('--output', default='-')
+    parser.add_argument('--format', choices=['markdown', 'json'],
+                        default='markdown')
+    parser.add_argument('--include-empty', action='store_true',
+                        help='also list revisions with no reported changes')
+    parser.add_argument('--engine', choices=sorted(differ.ENGINES),
+                        default=differ.DEFAULT_ENGINE,
+                        help='sdk also validates every revision; the changes '
+                        'reported are the same')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--list', action='store_true',
+                        help='only list the archived revisions')
+    parser.add_argument('--history', metavar='DB',
+                        help='also record the changes in this change history '
+                             'database (see history.py)')
+    args = parser.parse_args(argv)
+
+    spec = ('local', args.local) if args.local else ('gcs', args.bucket)
+    if args.list:
+        for timestamp, path in revisions(open_archive(spec), args.project_id):
+            print('%d %s' % (timestamp, path))
+        return
+
+    entries = replay(spec, args.project_id, args.engine, args.processes,
+                     structured=bool(args.history))
+    if args.history:
+        entries = recorded(entries, args.project_id, args.history)
+
+    if args.output == '-':
+        write_changelog(entries, sys.stdout, args.format, args.include_empty)
+    else:
+        with open(args.output, 'w') as f:
+            write_changelog(entries, f, args.format, args.include_empty)
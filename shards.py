@@ -0,0 +1,49 @@
+# Runs work for different projects concurrently, and work for the same
+# project one item at a time, in the order it was submitted.
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+
+class ProjectExecutor(object):
+    def __init__(self, max_workers=8):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='project')
+        # project_id -> deque of queued work. A project has an entry while
+        # a worker is running or about to run its work.
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def submit(self, project_id, fn, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            queue = self.queues.get(project_id)
+            idle = queue is None
+            if idle:
+                queue = self.queues[project_id] = deque()
+            queue.append((future, fn, args, kwargs))
+
+        if idle:
+            self.executor.submit(self.run_next, project_id)
+        return future
+
+    def run_next(self, project_id):
+        with self.lock:
+            future, fn, args, kwargs = self.queues[project_id].popleft()
+
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        # Requeue rather than loop, so a busy project doesn't hold a worker
+        # while other projects wait.
+        with self.lock:
+            if self.queues[project_id]:
+                self.executor.submit(self.run_next, project_id)
+            else:
+                del self.queues[project_id]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,68 @@
+# Verifies Optimizely's X-Hub-Signature header ('sha1=' + the hex HMAC-SHA1
+# of the request body) against any of several webhook secrets.
+from hashlib import sha1
+import hmac
+import threading
+
+
+SCHEME = 'sha1='
+
+
+def parse_secrets(value):
+    # Secrets are comma separated, each optionally prefixed with the id of
+    # the project it belongs to: 'secret1,10847551550:secret2'. Returns the
+    # secrets, and a map of project id to the index of its secret. Project
+    # ids are all digits; otherwise a ':' is part of the secret.
+    secrets = []
+    routes = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        project_id, sep, secret = item.partition(':')
+        if sep and project_id.strip().isdigit():
+            routes[project_id.strip()] = len(secrets)
+        else:
+            secret = item
+        secrets.append(secret.strip())
+    return secrets, routes
+
+
+class WebhookVerifier(object):
+    def __init__(self, secrets, routes=None):
+        # The keyed HMAC states are built once, and copied per request.
+        self.macs = [hmac.new(s.encode('utf-8'), digestmod=sha1)
+                     for s in secrets]
+        self.routes = dict(routes or {})
+        self.learned = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, value):
+        return cls(*parse_secrets(value))
+
+    def matches(self, index, body, expected):
+        mac = self.macs[index].copy()
+        mac.update(body)
+        return hmac.compare_digest(mac.hexdigest(), expected)
+
+    def verify(self, body, signature, project_id=None):
+        # With a project id, the secret configured for the project (or the
+        # one that last verified it) is tried first, so normally only one
+        # HMAC is computed.
+        if not signature or not signature.startswith(SCHEME):
+            return False
+        expected = signature[len(SCHEME):]
+
+        key = str(project_id) if project_id is not None else None
+        hint = self.routes.get(key, self.learned.get(key))
+        if hint is not None and self.matches(hint, body, expected):
+            return True
+
+        for i in range(len(self.macs)):
+            if i != hint and self.matches(i, body, expected):
+                if key is not None:
+                    with self.lock:
+                        self.learned[key] = i
+                return True
+        return False
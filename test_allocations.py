@@ -0,0 +1,125 @@
+import allocations
+from bench.bench_allocations import per_experiment, retained_ids
+from bench.synthetic import generate_datafile, mutate
+from differ import DatafileDiffer
+import json
+import os
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+
+def experiment(eid, allocation, variations=('a', 'b')):
+    return {
+        'id': eid,
+        'key': 'experiment-%s' % eid,
+        'variations': [{'id': 'v-' + k, 'key': k} for k in variations],
+        'trafficAllocation': [{'entityId': v and 'v-' + v, 'endOfRange': end}
+                              for v, end in allocation],
+    }
+
+
+class CompareTest(TestCase):
+    backend = 'array'
+
+    def compare(self, old, current):
+        old = { e['id']: e for e in old }
+        current = { e['id']: e for e in current }
+        return allocations.compare(old, current, list(current),
+                                   backend=self.backend)
+
+    def test_unchanged(self):
+        e = experiment('1', [('a', 5000), ('b', 10000)])
+        self.assertEqual([], self.compare([e], [json.loads(json.dumps(e))]))
+
+    def test_ranges_split_differently(self):
+        # Same shares, in different ranges.
+        self.assertEqual([], self.compare(
+            [experiment('1', [('a', 5000), ('b', 10000)])],
+            [experiment('1', [('a', 2500), ('a', 5000), ('b', 7500),
+                              ('b', 10000)])]))
+
+    def test_traffic(self):
+        self.assertEqual([
+            ('1', 'traffic_increased', 100, 1000),
+            ('2', 'traffic_decreased', 10000, 5000),
+        ], self.compare([
+            experiment('1', [('a', 50), ('b', 100), ('', 10000)]),
+            experiment('2', [('a', 5000), ('b', 10000)]),
+        ], [
+            experiment('1', [('a', 500), ('b', 1000), ('', 10000)]),
+            experiment('2', [('a', 2500), ('b', 5000), ('', 10000)]),
+        ]))
+
+    def test_within_epsilon(self):
+        self.assertEqual([
+            ('1', 'weighting_changed', 9999, 9990),
+            ('2', 'weighting_changed', 10000, 10000),
+        ], self.compare([
+            experiment('1', [('a', 5000), ('b', 9999), ('', 10000)]),
+            experiment('2', [('a', 5000), ('b', 10000)]),
+        ], [
+            experiment('1', [('a', 3330), ('b', 6660), ('c', 9990), ('', 10000)],
+                       variations='abc'),
+            experiment('2', [('b', 4000), ('a', 10000)], variations='ba'),
+        ]))
+
+    def test_compares_variation_keys(self):
+        # A variation renamed but allocated the same.
+        old = experiment('1', [('a', 5000), ('b', 10000)])
+        current = experiment('1', [('a', 5000), ('b', 10000)])
+        current['variations'][1]['key'] = 'c'
+        self.assertEqual([('1', 'weighting_changed', 10000, 10000)],
+                         self.compare([old], [current]))
+
+    def test_nothing_to_compare(self):
+        self.assertEqual([], self.compare([], []))
+        self.assertEqual([], self.compare(
+            [experiment('1', [('', 10000)])], [experiment('1', [])]))
+
+    def test_matches_per_experiment(self):
+        old = generate_datafile(experiments=300, variations=3, seed=1)
+        current = mutate(old, density=0.5, seed=2)
+        differ = DatafileDiffer(old, current)
+        ids = retained_ids(differ)
+        expected = per_experiment(differ, ids)
+        self.assertTrue(expected)
+        self.assertEqual(expected, allocations.compare(
+            differ.old_experiment_map, differ.current_experiment_map, ids,
+            backend=self.backend))
+
+    def test_matches_per_experiment_on_fixtures(self):
+        for name in sorted(os.listdir('data')):
+            with self.subTest(name):
+                with open(os.path.join('data', name, '0.json')) as f:
+                    old = json.load(f)
+                with open(os.path.join('data', name, '1.json')) as f:
+                    current = json.load(f)
+                differ = DatafileDiffer(old, current)
+                ids = retained_ids(differ)
+                self.assertEqual(per_experiment(differ, ids), allocations.compare(
+                    differ.old_experiment_map, differ.current_experiment_map,
+                    ids, backend=self.backend))
+
+
+@unittest.skipIf(allocations.numpy() is None, 'needs numpy')
+class NumpyCompareTest(CompareTest):
+    backend = 'numpy'
+
+
+class BackendTest(TestCase):
+    def test_picks_numpy_for_large_tables(self):
+        e = { '1': experiment('1', [('a', 5000), ('b', 10000)]) }
+        with patch.object(allocations, 'compare_numpy') as compare_numpy, \
+             patch.object(allocations, 'numpy', return_value=object()):
+            allocations.compare(e, e, ['1'])
+            compare_numpy.assert_not_called()
+            with patch.object(allocations, 'NUMPY_MIN_RANGES', 4):
+                allocations.compare(e, e, ['1'])
+            compare_numpy.assert_called_once()
+
+    def test_without_numpy(self):
+        e = { '1': experiment('1', [('a', 5000), ('b', 10000)]) }
+        with patch.object(allocations, 'numpy', return_value=None), \
+             patch.object(allocations, 'NUMPY_MIN_RANGES', 0):
+            self.assertEqual([], allocations.compare(e, e, ['1']))
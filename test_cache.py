@@ -0,0 +1,28 @@
+from cache import LRUCache
+from unittest import TestCase
+
+
+class LRUCacheTest(TestCase):
+    def test_get_put(self):
+        c = LRUCache(2)
+        c.put('a', 1)
+        self.assertEqual(1, c.get('a'))
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(2, c.get('b', 2))
+
+    def test_evicts_least_recently_used(self):
+        c = LRUCache(2)
+        c.put('a', 1)
+        c.put('b', 2)
+        c.get('a')
+        c.put('c', 3)
+        self.assertIn('a', c)
+        self.assertNotIn('b', c)
+        self.assertIn('c', c)
+        self.assertEqual(2, len(c))
+
+    def test_pop(self):
+        c = LRUCache(2)
+        c.put('a', 1)
+        self.assertEqual(1, c.pop('a'))
+        self.assertNotIn('a', c)
@@ -0,0 +1,154 @@
+from coalesce import Coalescer, parse_windows
+from differ import Change
+from unittest import TestCase
+from unittest.mock import Mock
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def enabled(i):
+    return Change('Experiment `%s` enabled.' % i, 'experiment_enabled', i)
+
+
+def paused(i):
+    return Change('Experiment `%s` paused.' % i, 'experiment_paused', i)
+
+
+def renamed(i):
+    return Change('Experiment `%s` renamed.' % i, 'experiment_renamed', i)
+
+
+def live(i):
+    return Change('Event `%s` live.' % i, 'event_live', i)
+
+
+def dead(i):
+    return Change('Event `%s` dead.' % i, 'event_dead', i)
+
+
+class CoalescerTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.send = Mock()
+        self.schedule = Mock()
+
+    def coalescer(self, window=60, windows=None):
+        return Coalescer(self.send, window=window, windows=windows,
+                         clock=self.clock, schedule=self.schedule)
+
+    def sent(self):
+        return [(p, [str(c) for c in changes])
+                for (p, changes), _ in self.send.call_args_list]
+
+    def test_no_window_sends_immediately(self):
+        c = self.coalescer(window=0)
+        c.add(1, [enabled('a')])
+        c.add(1, [])
+        self.assertEqual([(1, ['Experiment `a` enabled.'])], self.sent())
+        self.schedule.assert_not_called()
+
+    def test_merges_within_window(self):
+        c = self.coalescer()
+        c.add(1, [enabled('a')])
+        self.clock.now = 30
+        c.add(1, [renamed('b')])
+        c.flush_due()
+        self.send.assert_not_called()
+
+        self.clock.now = 60
+        c.flush_due()
+        self.assertEqual(
+            [(1, ['Experiment `a` enabled.', 'Experiment `b` renamed.'])],
+            self.sent())
+        self.schedule.assert_called_once_with(60, c.flush_due)
+
+    def test_new_window_after_flush(self):
+        c = self.coalescer()
+        c.add(1, [enabled('a')])
+        self.clock.now = 60
+        c.flush_due()
+        c.add(1, [renamed('a')])
+        self.clock.now = 119
+        c.flush_due()
+        self.assertEqual(1, self.send.call_count)
+        self.clock.now = 120
+        c.flush_due()
+        self.assertEqual(2, self.send.call_count)
+        self.assertEqual(2, self.schedule.call_count)
+
+    def test_projects_are_separate(self):
+        c = self.coalescer(windows={'2': 10})
+        c.add(1, [enabled('a')])
+        c.add(2, [enabled('b')])
+        self.clock.now = 10
+        c.flush_due()
+        self.assertEqual([(2, ['Experiment `b` enabled.'])], self.sent())
+        c.flush()
+        self.assertEqual(2, self.send.call_count)
+
+    def test_per_project_window_disables(self):
+        c = self.coalescer(windows={'2': 0})
+        c.add(2, [enabled('b')])
+        self.assertEqual(1, self.send.call_count)
+
+    def test_enabled_then_paused_cancels(self):
+        c = self.coalescer()
+        c.add(1, [enabled('a'), enabled('b')])
+        c.add(1, [renamed('a')])
+        c.add(1, [paused('a')])
+        c.flush()
+        self.assertEqual([(1, ['Experiment `b` enabled.'])], self.sent())
+
+    def test_paused_then_enabled_cancels(self):
+        c = self.coalescer()
+        c.add(1, [paused('a'), renamed('b')])
+        c.add(1, [enabled('a')])
+        c.flush()
+        self.assertEqual([(1, ['Experiment `b` renamed.'])], self.sent())
+
+    def test_events_cancel(self):
+        c = self.coalescer()
+        c.add(1, [live('e')])
+        c.add(1, [dead('e')])
+        c.flush()
+        self.send.assert_not_called()
+
+    def test_rollout_rules_cancel(self):
+        c = self.coalescer()
+        c.add(1, [Change('Rule `r` turned off.', 'rollout_rule_disabled', 'r')])
+        c.add(1, [Change('Rule `r` turned on.', 'rollout_rule_enabled', 'r')])
+        c.flush()
+        self.send.assert_not_called()
+
+    def test_duplicates_dropped(self):
+        c = self.coalescer()
+        c.add(1, [renamed('a')])
+        c.add(1, [renamed('a')])
+        c.flush()
+        self.assertEqual([(1, ['Experiment `a` renamed.'])], self.sent())
+
+    def test_large_batches(self):
+        # A mass pause and its undo, as in one big batch. Adding each
+        # change doesn't scan the ones already in it.
+        c = self.coalescer()
+        n = 20000
+        c.add(1, [paused(i) for i in range(n)] + [renamed('a')])
+        c.add(1, [enabled(i) for i in range(0, n, 2)])
+        batch = c.batches[1]
+        self.assertEqual(n // 2 + 1, len(batch.changes))
+        self.assertEqual(n // 2 + 1, len(batch.by_kind))
+        c.flush()
+        sent = self.sent()[0][1]
+        self.assertEqual('Experiment `1` paused.', sent[0])
+        self.assertEqual('Experiment `a` renamed.', sent[-1])
+
+    def test_parse_windows(self):
+        self.assertEqual((0, {}), parse_windows(None, None))
+        self.assertEqual((30, {'1': 300, '2': 0}),
+                         parse_windows('30', '1=300, 2=0'))
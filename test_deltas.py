@@ -0,0 +1,88 @@
+from bench.synthetic import generate_datafile, mutate
+import copy
+import deltas
+import json
+import os
+from unittest import TestCase
+
+
+def fixtures():
+    for name in sorted(os.listdir('data')):
+        with open('data/%s/0.json' % name, 'r') as before, \
+             open('data/%s/1.json' % name, 'r') as after:
+            yield name, json.loads(before.read()), json.loads(after.read())
+
+
+class PatchTest(TestCase):
+    def roundtrip(self, old, new):
+        snapshot = copy.deepcopy(old)
+        patch = deltas.make_patch(old, new)
+        self.assertEqual(new, deltas.apply_patch(old, patch))
+        self.assertEqual(snapshot, old)
+        return patch
+
+    def test_fixtures(self):
+        for name, old, new in fixtures():
+            with self.subTest(name):
+                self.roundtrip(old, new)
+                self.roundtrip(new, old)
+
+    def test_synthetic(self):
+        old = generate_datafile(experiments=200, events=200)
+        for density in (0.01, 0.1, 1):
+            with self.subTest(density=density):
+                self.roundtrip(old, mutate(old, density=density))
+
+    def test_lists(self):
+        for old, new in [
+            ([1, 2, 3, 4], [1, 3, 4]),
+            ([1, 2, 3], [1, 5, 6, 2, 3]),
+            ([1, 2, 3], []),
+            ([], [1]),
+            ([1, 2, 3], [3, 2, 1]),
+            ({'a': [1]}, {'a': {'b': 1}}),
+            ({'a/b': 1, '~c': 2}, {'a/b': 2}),
+            (1, 'x'),
+        ]:
+            with self.subTest(old=old, new=new):
+                self.roundtrip(old, new)
+
+    def test_small_for_single_edit(self):
+        old = generate_datafile(experiments=500, events=500)
+        new = copy.deepcopy(old)
+        del new['experiments'][100]
+        new['events'][3]['key'] = 'renamed'
+        self.assertEqual([
+            {'op': 'remove', 'path': '/experiments/100'},
+            {'op': 'replace', 'path': '/events/3/key', 'value': 'renamed'},
+        ], self.roundtrip(old, new))
+
+    def test_encode(self):
+        data = deltas.encode('datafile/1/1/a.json', 3, [
+            {'op': 'replace', 'path': '/revision', 'value': '2'}])
+        self.assertEqual({
+            'base': 'datafile/1/1/a.json',
+            'base_generation': 3,
+            'patch': [{'op': 'replace', 'path': '/revision', 'value': '2'}],
+        }, deltas.decode(data))
+
+
+class ReadRevisionTest(TestCase):
+    def test_reads_full_and_delta(self):
+        _, old, new = next(fixtures())
+        objects = {
+            'a.json': json.dumps(old).encode('utf-8'),
+            'b.json.delta': deltas.encode(
+                'a.json', 1, deltas.make_patch(old, new)),
+        }
+        reads = []
+        def read(path):
+            reads.append(path)
+            return objects[path]
+
+        snapshots = {}
+        self.assertEqual(old, deltas.read_revision(read, 'a.json', snapshots))
+        self.assertEqual(new, deltas.read_revision(read, 'b.json.delta', snapshots))
+        self.assertEqual(new, deltas.read_revision(read, 'b.json.delta', snapshots))
+        self.assertEqual(['a.json', 'b.json.delta', 'a.json', 'b.json.delta'],
+                         reads)
@@ -1,6 +1,12 @@
-from differ import TrafficAllocation, describe, Change
+from bench.synthetic import generate_datafile, mutate
+import copy
+from differ import TrafficAllocation, describe, Change, DatafileConfig, \
+    LightweightOptimizely, DatafileDiffer, DatafileIndex, ENGINES, render, \
+    render_json, pct
 import json
+import os
 from unittest import TestCase
+from unittest.mock import patch
 from optimizely.optimizely import Optimizely
 
 
@@ -23,6 +29,13 @@ class TrafficAllocationTest(TestCase):
     def test_fails_not_running(self):
         self.assertRaises(ValueError, self.ta.summarize, 999999)
 
+    def test_memoized(self):
+        e = self.opt.config.get_experiment_from_key('dan-testing-notifications')
+        with patch.object(TrafficAllocation, 'compute',
+                          wraps=self.ta.compute) as compute:
+            self.assertIs(self.ta.summarize(e.id), self.ta.summarize(e.id))
+            self.assertEqual(1, compute.call_count)
+
     def test_works_5050(self):
         self.assertEqual(
             { 'control': 5000, 'upsell-refined': 5000 },
@@ -106,6 +119,198 @@ class DatafileDifferTest(TestCase):
             '1.67% c, 94.99% not bucketed.',
             self.diff('event-renamed'))
 
+    def test_event_experiments_changed(self):
+        self.assertEqual(
+            'Event `campaign-create` now tracked by `list-upload-activation-1001`; '
+            'no longer tracked by `dashboard-blank-slate-v3-ecommerce-0718`.',
+            self.diff('event-experiments-changed'))
+
+    def test_group_traffic_changed(self):
+        self.assertEqual(
+            'Exclusion group `12000000001` traffic changed. Was: 50% '
+            'checkout-button-color, 50% checkout-copy; currently: 20% '
+            'checkout-button-color, 20% checkout-copy, 60% not bucketed.',
+            self.diff('group-traffic-changed'))
+
+    def test_group_experiment_enabled(self):
+        self.assertEqual(
+            'Exclusion group `12000000001` traffic changed. Was: 50% '
+            'checkout-button-color, 50% not bucketed; currently: 50% '
+            'checkout-button-color, 50% checkout-copy.\n'
+            'Experiment `checkout-copy` enabled. 50% long, 50% short.',
+            self.diff('group-experiment-enabled'))
+
+    def test_rollout_rule_added(self):
+        self.assertEqual(
+            'Feature `new-checkout` rollout rule `beta-users` added with 10% '
+            'of traffic.',
+            self.diff('rollout-rule-added'))
+
+    def test_rollout_rule_removed(self):
+        self.assertEqual(
+            'Feature `new-checkout` rollout rule `beta-users` removed.',
+            self.diff('rollout-rule-removed'))
+
+    def test_rollout_rule_enabled(self):
+        self.assertEqual(
+            'Feature `new-checkout` rollout rule `everyone-else` turned on.',
+            self.diff('rollout-rule-enabled'))
+
+    def test_rollout_rule_disabled(self):
+        self.assertEqual(
+            'Feature `new-checkout` rollout rule `beta-users` turned off.',
+            self.diff('rollout-rule-disabled'))
+
+    def test_rollout_traffic_changed(self):
+        self.assertEqual(
+            'Feature `new-checkout` rollout rule `beta-users` traffic changed '
+            'from 10% to 50%.',
+            self.diff('rollout-traffic-changed'))
+
+    def test_feature_variable_added(self):
+        self.assertEqual(
+            'Feature `new-checkout` variable `max_items` added with default '
+            '`10`.',
+            self.diff('feature-variable-added'))
+
+    def test_feature_variable_removed(self):
+        self.assertEqual(
+            'Feature `new-checkout` variable `max_items` removed.',
+            self.diff('feature-variable-removed'))
+
+    def test_feature_variable_renamed(self):
+        self.assertEqual(
+            'Feature `new-checkout` variable `button_text` renamed to '
+            '`cta_text`.',
+            self.diff('feature-variable-renamed'))
+
+    def test_feature_variable_changed(self):
+        self.assertEqual(
+            'Feature `new-checkout` variable `max_items` default changed from '
+            '`10` to `20`.',
+            self.diff('feature-variable-changed'))
+
+    def test_allocations_walked_once_per_config(self):
+        for name in ('variation-percent-change', 'traffic-allocation-increase',
+                     'event-renamed'):
+            with open('data/%s/0.json' % name, 'r') as before, \
+                 open('data/%s/1.json' % name, 'r') as after:
+                d = DatafileDiffer(json.loads(before.read()),
+                                   json.loads(after.read()))
+            with patch.object(TrafficAllocation, 'compute', autospec=True,
+                              side_effect=TrafficAllocation.compute) as compute:
+                d.describe()
+            computed = [c[0] for c in compute.call_args_list]
+            with self.subTest(name):
+                self.assertTrue(computed)
+                self.assertEqual(len(set(computed)), len(computed))
+
+    def test_detectors_scoped_to_changed_entities(self):
+        old = generate_datafile(experiments=2000, events=500)
+        current = copy.deepcopy(old)
+        current['experiments'][42]['key'] = 'renamed'
+        current['events'][7]['key'] = 'renamed-event'
+
+        d = DatafileDiffer(old, current)
+        with patch.object(DatafileConfig, 'get_experiment_from_id',
+                          autospec=True,
+                          side_effect=DatafileConfig.get_experiment_from_id) as get:
+            changes = d.changes()
+        self.assertEqual(2, len(changes))
+        self.assertEqual([current['experiments'][42]['id']],
+                         d.experiment_changes.modified)
+        self.assertEqual([current['events'][7]['id']], d.event_changes.modified)
+        self.assertLess(get.call_count, 10)
+
+    def test_feature_detectors_scoped_to_changed_entities(self):
+        old = generate_datafile(experiments=200, events=0, groups=500,
+                                features=1000)
+        current = copy.deepcopy(old)
+        group = current['groups'][42]
+        group['trafficAllocation'][0]['endOfRange'] = 1000
+        rule = current['rollouts'][7]['experiments'][0]
+        rule['trafficAllocation'][0]['endOfRange'] = \
+            1000 if rule['trafficAllocation'][0]['endOfRange'] == 5000 else 5000
+        variable = current['featureFlags'][9]['variables'][1]
+        variable['defaultValue'] = 'changed'
+
+        d = DatafileDiffer(old, current)
+        with patch.object(DatafileConfig, 'get_experiment_from_id',
+                          autospec=True,
+                          side_effect=DatafileConfig.get_experiment_from_id) as get:
+            changes = d.changes()
+        self.assertEqual({'group_traffic_changed', 'rollout_traffic_changed',
+                          'feature_variable_changed'},
+                         { c.kind for c in changes })
+        self.assertEqual(3, len(changes))
+        self.assertEqual([group['id']], d.group_changes.modified)
+        self.assertEqual([rule['id']], d.rule_changes.modified)
+        self.assertEqual([variable['id']], d.variable_changes.modified)
+        self.assertFalse(d.experiment_changes.modified)
+        self.assertEqual(0, get.call_count)
+
+
+class EngineTest(TestCase):
+    def load(self, name, n):
+        with open('data/%s/%d.json' % (name, n), 'r') as f:
+            return json.loads(f.read())
+
+    def test_engines_agree_on_fixtures(self):
+        # The engines only serve lookups by id, so those are what's
+        # compared: every experiment and variation, and every allocation
+        # summary.
+        for name in sorted(os.listdir('data')):
+            for n in (0, 1):
+                d = self.load(name, n)
+                sdk = ENGINES['sdk'](d)
+                lightweight = ENGINES['lightweight'](d)
+                with self.subTest(name=name, n=n):
+                    for i, raw in DatafileIndex(d).experiments.items():
+                        e0 = sdk.config.get_experiment_from_id(i)
+                        e1 = lightweight.config.get_experiment_from_id(i)
+                        self.assertEqual((e0.id, e0.key), (e1.id, e1.key))
+                        for v in raw['variations']:
+                            self.assertEqual(
+                                sdk.config.get_variation_from_id(
+                                    e0.key, v['id']).key,
+                                lightweight.config.get_variation_from_id(
+                                    e1.key, v['id']).key)
+                        self.assertEqual(
+                            TrafficAllocation(sdk).summarize(i),
+                            TrafficAllocation(lightweight).summarize(i))
+
+            old, current = self.load(name, 0), self.load(name, 1)
+            with self.subTest(name):
+                self.assertEqual(
+                    describe(old, current, 'sdk'),
+                    describe(old, current, 'lightweight'))
+
+    def test_sdk_engine_validates(self):
+        old = self.load('experiment-renamed', 0)
+        current = self.load('experiment-renamed', 1)
+        del current['experiments'][0]['layerId']
+        with patch('logging.Logger.error'):
+            self.assertRaises(ValueError, describe, old, current, 'sdk')
+        self.assertEqual(
+            'Experiment `dan-testing-notifications` renamed to '
+            '`dan-testing-notifications-foo`.',
+            describe(old, current, 'lightweight'))
+
+    def test_lightweight_allocation(self):
+        opt = LightweightOptimizely(self.load('experiment-enabled', 1))
+        e = opt.config.get_experiment_from_id('11716925753')
+        self.assertEqual('dan-testing-notifications', e.key)
+        self.assertEqual({
+            'a': 50, 'b': 50, 'not bucketed': 9900
+        }, TrafficAllocation(opt).summarize(e.id))
+
+    def test_missing_entities(self):
+        conf = DatafileConfig(self.load('experiment-enabled', 1))
+        self.assertIsNone(conf.get_experiment_from_id('999999'))
+        self.assertIsNone(conf.get_variation_from_id(
+            'dan-testing-notifications', '999999'))
+        self.assertIsNone(conf.get_variation_from_id('nope', '11695924248'))
+
 
 class ChangeTest(TestCase):
     def test_hashing(self):
@@ -114,3 +319,55 @@ class ChangeTest(TestCase):
 
     def test_str(self):
         self.assertEqual('foo', str(Change('foo')))
+
+    def test_structured(self):
+        c = Change(kind='traffic_increased', entity_id='1', key='x',
+                   old_traffic=100, traffic=5000,
+                   allocation={'a': 2500, 'b': 2500, 'not bucketed': 5000})
+        self.assertEqual(
+            'Experiment `x` traffic increased from 1% to 50%. Currently: '
+            '25% a, 25% b, 50% not bucketed.', str(c))
+        self.assertEqual(c, Change(kind='traffic_increased', entity_id='1',
+                                   key='x', old_traffic=100, traffic=5000,
+                                   allocation=dict(c.fields['allocation'])))
+        self.assertNotEqual(c, Change(kind='traffic_increased', entity_id='1',
+                                      key='x', old_traffic=100, traffic=4000,
+                                      allocation=c.fields['allocation']))
+
+    def test_render_json(self):
+        with open('data/event-experiments-changed/0.json') as before, \
+             open('data/event-experiments-changed/1.json') as after:
+            changes = DatafileDiffer(json.load(before), json.load(after)).changes()
+        self.assertEqual([{
+            'kind': 'event_experiments_changed',
+            'entity_id': changes[0].entity_id,
+            'key': 'campaign-create',
+            'added': ['list-upload-activation-1001'],
+            'removed': ['dashboard-blank-slate-v3-ecommerce-0718'],
+            'text': str(changes[0]),
+        }], json.loads(render_json(changes)))
+
+    def test_sorted_like_text(self):
+        # Sorting on structured keys gives the same order as sorting the
+        # rendered text.
+        old = generate_datafile(experiments=300, events=300, groups=5,
+                                features=50)
+        pairs = [(old, mutate(old, density, seed))
+                 for density in (0.1, 1) for seed in range(3)]
+        for name in sorted(os.listdir('data')):
+            with open('data/%s/0.json' % name) as before, \
+                 open('data/%s/1.json' % name) as after:
+                pairs.append((json.load(before), json.load(after)))
+
+        for a, b in pairs:
+            for changes in (DatafileDiffer(a, b).changes(),
+                            DatafileDiffer(b, a).changes()):
+                self.assertEqual(sorted({ str(c) for c in changes }),
+                                 [str(c) for c in changes])
+                self.assertEqual(render(changes) or '',
+                                 '\n'.join(sorted({ str(c) for c in changes })))
+
+    def test_pct(self):
+        self.assertEqual('1.67%', pct(167))
+        self.assertEqual('50%', pct(5000))
+        self.assertIs(pct(167), pct(167))
@@ -0,0 +1,182 @@
+from differ import Change, DatafileDiffer
+import history
+from history import ChangeHistory, parse_time
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+
+def fixture(name, n):
+    with open('data/%s/%d.json' % (name, n), 'r') as f:
+        return json.load(f)
+
+
+def renamed(eid, old_key, key):
+    return Change(kind='experiment_renamed', entity_id=eid, old_key=old_key,
+                  key=key)
+
+
+class ChangeHistoryTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'history.db')
+        self.store = ChangeHistory(self.path)
+        self.addCleanup(self.store.close)
+
+    def test_roundtrip(self):
+        changes = DatafileDiffer(fixture('traffic-allocation-increase', 0),
+                                 fixture('traffic-allocation-increase', 1)
+                                 ).changes()
+        self.assertEqual(len(changes), self.store.record(1, 100, changes, '7'))
+        [e] = self.store.query(1)
+        self.assertEqual(('1', 100, '7'), e[:3])
+        self.assertEqual(changes[0], e.change)
+        self.assertEqual(str(changes[0]), str(e.change))
+
+    def test_description_only(self):
+        self.store.record(1, 100, [Change('Something happened.')])
+        self.assertEqual([Change('Something happened.')],
+                         [e.change for e in self.store.query(1)])
+
+    def test_records_once(self):
+        c = renamed('10', 'a', 'b')
+        self.assertEqual(1, self.store.record(1, 100, [c]))
+        self.assertEqual(0, self.store.record(1, 100, [c]))
+        self.assertEqual(1, self.store.record(1, 101, [c]))
+        self.assertEqual(2, len(self.store.query(1)))
+
+    def test_append_only(self):
+        self.store.record(1, 100, [renamed('10', 'a', 'b')])
+        for sql in ('UPDATE changes SET key = "c"', 'DELETE FROM changes'):
+            with self.subTest(sql):
+                self.assertRaises(sqlite3.IntegrityError,
+                                  self.store.db.execute, sql)
+
+    def test_queries(self):
+        self.store.record(1, 100, [
+            renamed('10', 'a', 'b'),
+            Change(kind='event_renamed', entity_id='20', old_key='x',
+                   key='b'),
+        ], '1')
+        self.store.record(1, 200, [
+            Change(kind='experiment_paused', entity_id='10', key='b'),
+            Change(kind='experiment_paused', entity_id='11', key='c'),
+        ], '2')
+        self.store.record(2, 200, [
+            Change(kind='experiment_paused', entity_id='10', key='b'),
+        ], '1')
+
+        def query(**kwargs):
+            return [(e.timestamp, e.change.kind, e.change.entity_id)
+                    for e in self.store.query(1, **kwargs)]
+
+        self.assertEqual([
+            (200, 'experiment_paused', '11'),
+            (200, 'experiment_paused', '10'),
+            (100, 'event_renamed', '20'),
+            (100, 'experiment_renamed', '10'),
+        ], query())
+        self.assertEqual([
+            (200, 'experiment_paused', '10'),
+            (100, 'experiment_renamed', '10'),
+        ], query(entity_id='10'))
+        # By its key before the rename, too.
+        self.assertEqual(query(entity_id='10'),
+                         query(key='a', entity='experiment'))
+        self.assertEqual([(100, 'event_renamed', '20')],
+                         query(key='b', entity='event'))
+        self.assertEqual([
+            (200, 'experiment_paused', '10'),
+            (100, 'event_renamed', '20'),
+            (100, 'experiment_renamed', '10'),
+        ], query(key='b'))
+        self.assertEqual([(100, 'experiment_renamed', '10')],
+                         query(kinds=['experiment_renamed']))
+        self.assertEqual([], query(kinds=['event_live'], entity='experiment'))
+        self.assertEqual([(100, 'event_renamed', '20'),
+                          (100, 'experiment_renamed', '10')],
+                         query(since=100, until=200))
+        self.assertEqual([(200, 'experiment_paused', '11')], query(limit=1))
+
+    def test_uses_indexes(self):
+        queries = [
+            ({'entity_id': '10'}, 'changes_entity'),
+            ({'key': 'a'}, 'changes_entity'),
+            ({'key': 'a', 'entity': 'event'}, 'changes_entity'),
+            ({'kinds': ['event_dead']}, 'changes_kind'),
+            ({'since': 100}, 'changes_timestamp'),
+        ]
+        db = self.store.db
+        for kwargs, index in queries:
+            with self.subTest(kwargs):
+                plan = []
+                def execute(sql, args):
+                    plan.extend(row[-1] for row in db.execute(
+                        'EXPLAIN QUERY PLAN ' + sql, args))
+                    return db.execute(sql, args)
+                with patch.object(self.store, 'db', Mock(execute=execute)):
+                    self.store.query(1, **kwargs)
+                self.assertIn('USING INDEX %s ' % index, plan[0])
+                self.assertFalse([p for p in plan if p.startswith('SCAN')])
+
+    def test_shared_between_connections(self):
+        self.store.record(1, 100, [renamed('10', 'a', 'b')])
+        other = ChangeHistory(self.path)
+        self.addCleanup(other.close)
+        self.assertEqual(1, len(other.query(1)))
+
+
+class ParseTimeTest(TestCase):
+    def test_works(self):
+        self.assertEqual(1539053286, parse_time('1539053286'))
+        self.assertEqual(1538352000, parse_time('2018-10-01'))
+        self.assertEqual(1538352000, parse_time('2018-10-01T00:00:00+00:00'))
+        self.assertEqual(1000000 - 30 * 86400, parse_time('30d', now=1000000))
+
+
+class CLITest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'history.db')
+        store = ChangeHistory(self.path)
+        store.record(1, 1539053286, [renamed('10', 'a', 'b')], '459')
+        store.record(1, 1539053300, [
+            Change(kind='experiment_paused', entity_id='10', key='b'),
+            Change(kind='event_dead', entity_id='20', key='a'),
+        ], '460')
+        store.close()
+
+    def run_cli(self, *argv):
+        out = io.StringIO()
+        with patch.object(history.sys, 'stdout', out):
+            history.main(['1', '--db', self.path] + list(argv))
+        return out.getvalue()
+
+    def test_experiment(self):
+        self.assertEqual(
+            '2018-10-09 02:48:20  r460    Experiment `b` paused.\n'
+            '2018-10-09 02:48:06  r459    Experiment `a` renamed to `b`.\n',
+            self.run_cli('--experiment', 'a'))
+        self.assertEqual(self.run_cli('--experiment', 'a'),
+                         self.run_cli('--experiment', '10'))
+
+    def test_json(self):
+        [line] = self.run_cli('--event', 'a', '--format', 'json').splitlines()
+        self.assertEqual({
+            'entity_id': '20', 'key': 'a', 'kind': 'event_dead',
+            'project_id': '1', 'revision': '460', 'timestamp': 1539053300,
+            'text': 'Event `a` removed from all active experiments. Tracking '
+                    'calls are now not sending curls.',
+        }, json.loads(line))
+
+    def test_needs_db(self):
+        with patch.dict(os.environ, clear=True), \
+             patch.object(history.sys, 'stderr', io.StringIO()):
+            self.assertRaises(SystemExit, history.main, ['1'])
@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from local_storage import LocalBucket
+import os
+import replay
+import shutil
+import tempfile
+from unittest import TestCase
+
+
+class LocalBucketTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.bucket = LocalBucket(self.root)
+
+    def test_roundtrip(self):
+        b = self.bucket.blob('datafile/1/2/a.json')
+        b.upload_from_string('{"a": 1}')
+        self.assertTrue(b.generation)
+
+        found = self.bucket.get_blob('datafile/1/2/a.json')
+        self.assertEqual(b.generation, found.generation)
+        self.assertEqual(b'{"a": 1}', found.download_as_string(
+            if_generation_match=found.generation))
+        self.assertTrue(b.exists())
+
+        # Laid out like the bucket, without anything else in the files.
+        with open(os.path.join(self.root, 'datafile', '1', '2', 'a.json')) as f:
+            self.assertEqual('{"a": 1}', f.read())
+
+    def test_empty(self):
+        b = self.bucket.blob('empty')
+        b.upload_from_string(b'')
+        self.assertEqual(b'', b.download_as_bytes())
+
+    def test_missing(self):
+        self.assertIsNone(self.bucket.get_blob('nope'))
+        self.assertFalse(self.bucket.blob('nope').exists())
+        self.assertRaises(NotFound, self.bucket.blob('nope').download_as_bytes)
+
+    def test_generation_changes_on_write(self):
+        b = self.bucket.blob('x')
+        b.upload_from_string('1')
+        first = b.generation
+        b.upload_from_string('2')
+        self.assertNotEqual(first, b.generation)
+        self.assertRaises(PreconditionFailed, b.download_as_bytes,
+                          if_generation_match=first)
+
+    def test_generations_never_repeat(self):
+        # Rewriting an object reuses inodes and, on coarse filesystems,
+        # modification times; a stale compare-and-swap must still fail.
+        b = self.bucket.blob('pointer')
+        b.upload_from_string('a', if_generation_match=0)
+        stale = b.generation
+        seen = [stale]
+        for data in ['b', 'a'] * 50:
+            b.upload_from_string(data, if_generation_match=b.generation)
+            seen.append(b.generation)
+        self.assertEqual(sorted(set(seen)), seen)
+        self.assertRaises(PreconditionFailed, b.upload_from_string, 'c',
+                          if_generation_match=stale)
+
+    def test_objects_copied_in(self):
+        # Files put in place some other way, e.g. with gsutil, still have
+        # a generation to swap against.
+        os.makedirs(os.path.join(self.root, 'datafile', '1'))
+        with open(os.path.join(self.root, 'datafile', '1', 'p.json'), 'w') as f:
+            f.write('{}')
+        found = self.bucket.get_blob('datafile/1/p.json')
+        first = found.generation
+        self.assertTrue(first)
+        found.upload_from_string('1', if_generation_match=first)
+        self.assertNotEqual(first, found.generation)
+        self.assertEqual(found.generation,
+                         self.bucket.get_blob('datafile/1/p.json').generation)
+        self.assertEqual(['datafile/1/p.json'],
+                         [x.name for x in self.bucket.list_blobs()])
+
+    def test_preconditions(self):
+        b = self.bucket.blob('pointer')
+        b.upload_from_string('1', if_generation_match=0)
+        self.assertRaises(PreconditionFailed, b.upload_from_string, '2',
+                          if_generation_match=0)
+        b.upload_from_string('2', if_generation_match=b.generation)
+        self.assertEqual(b'2', b.download_as_bytes())
+        self.assertEqual(['pointer'],
+                         [x.name for x in self.bucket.list_blobs()])
+
+    def test_compare_and_swap_races(self):
+        b = self.bucket.blob('pointer')
+        b.upload_from_string('0', if_generation_match=0)
+        start = b.generation
+
+        def swap(i):
+            try:
+                self.bucket.blob('pointer').upload_from_string(
+                    str(i), if_generation_match=start)
+                return True
+            except PreconditionFailed:
+                return False
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            won = list(pool.map(swap, range(32)))
+        self.assertEqual(1, won.count(True))
+        self.assertEqual(['pointer'],
+                         [x.name for x in self.bucket.list_blobs()])
+
+    def test_readable_by_replay(self):
+        self.bucket.blob('datafile/1/5/a.json').upload_from_string('{}')
+        self.bucket.blob('datafile/1/_latest/pointer.json').upload_from_string('{}')
+        self.assertEqual([(5, 'datafile/1/5/a.json')], replay.revisions(
+            replay.open_archive(('local', self.root)), 1))
+
+    def test_replay_skips_write_in_progress(self):
+        self.bucket.blob('datafile/1/5/a.json').upload_from_string('{}')
+        directory = os.path.join(self.root, 'datafile', '1', '5')
+        with open(os.path.join(directory, '.tmpx1y2z3'), 'w') as f:
+            f.write('{')
+        self.assertEqual([(5, 'datafile/1/5/a.json')], replay.revisions(
+            replay.open_archive(('local', self.root)), 1))
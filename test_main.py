@@ -1,11 +1,30 @@
+from fake_gcs import FakeClient
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound, PreconditionFailed, \
+    ServiceUnavailable
 from hashlib import sha1
 import hmac
 from google.cloud import storage
+import history
 import json
+from local_storage import LocalBucket
+import coalesce
+import main
+import metrics
+import notifications
 from main import webhook_post, webhook_secrets, datafile_gcs_path, \
-    latest_datafile_gcs_path, gcs_bucket
+    latest_datafile_gcs_path, latest_pointer_gcs_path, gcs_bucket, \
+    reset_gcs, load_latest_datafile, fetch_datafile, save_datafile, \
+    publish_latest
 import os
 import requests
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from unittest import TestCase
 from unittest.mock import Mock, patch
 from werkzeug.exceptions import BadRequest
@@ -39,6 +58,18 @@ class WebhookHandlerTest(TestCase):
             headers={'X-Hub-Signature': sign(data)})
         self.assertEqual('unhandled event', webhook_post(request))
 
+    def test_project_secret(self):
+        d = { 'event': 'foo', 'project_id': 123 }
+        data = json.dumps(d).encode('utf-8')
+        s = 'sha1=' + hmac.new(b'baz', msg=data, digestmod=sha1).hexdigest()
+        request = Mock(
+            get_data=Mock(return_value=data),
+            json=d,
+            headers={'X-Hub-Signature': s})
+        with patch.object(os, 'getenv', {
+                'OPTIMIZELY_WEBHOOK_SECRET': 'foo, 123:baz'}.get):
+            self.assertEqual('unhandled event', webhook_post(request))
+
     def test_alternate_secret(self):
         d = { 'event': 'foo' }
         data = json.dumps(d).encode('utf-8')
@@ -56,6 +87,9 @@ class WebhookSecretsTest(TestCase):
     def test_works(self):
         self.assertEqual(['foo', 'bar'], webhook_secrets())
 
+    def test_verifier_cached(self):
+        self.assertIs(main.verifier(), main.verifier())
+
 
 class DatafilePathsTest(TestCase):
     def test_works(self):
@@ -91,7 +125,7 @@ class DatafilePathsTest(TestCase):
             latest_datafile_gcs_path(payload))
 
 
-@patch.object(requests, 'post', Mock())
+@patch.object(requests.Session, 'post', Mock(return_value=Mock(status_code=200)))
 @patch.object(os, 'getenv', {
     'OPTIMIZELY_WEBHOOK_SECRET': 'foo, bar',
     'SLACK_URL': 'slack url',
@@ -113,24 +147,750 @@ class SnippetUpdateTest(TestCase):
             json=self.payload,
             headers={'X-Hub-Signature': sign(data)})
         webhook_post(request)
-        requests.post.assert_called_once_with('slack url', json={
-            'username': 'Optimizely',
-            'icon_url': 'https://app.optimizely.com/static/img/favicon-32x32.png',
-            'text': ("WebX javascript updated. Sorry, that's all I know :grimacing:. "
-                     "For details view the <https://app.optimizely.com/v2/projects/"
-                     "8896740779/change_history|changelog>."),
-        })
+        main.dispatcher('slack url').flush()
+        requests.Session.post.assert_called_once_with(
+            'slack url', timeout=notifications.SlackSink.TIMEOUT, json={
+                'username': 'Optimizely',
+                'icon_url': 'https://app.optimizely.com/static/img/favicon-32x32.png',
+                'text': ("WebX javascript updated. Sorry, that's all I know :grimacing:. "
+                         "For details view the <https://app.optimizely.com/v2/projects/"
+                         "8896740779/change_history|changelog>."),
+            })
 
 
-mock_gcs = Mock()
-
-@patch.object(storage, 'Client', Mock(return_value=mock_gcs))
 @patch.object(os, 'getenv', {
     'GCS_BUCKET_NAME': 'xxx'
 }.get)
 class GCSBucketTest(TestCase):
+    def setUp(self):
+        reset_gcs()
+        mock_gcs = Mock()
+        p = patch.object(storage, 'Client', Mock(return_value=mock_gcs))
+        p.start()
+        self.addCleanup(p.stop)
+
     def test_works(self):
+        mock_gcs = storage.Client.return_value
         b = Mock()
         mock_gcs.get_bucket.return_value = b
         self.assertEqual(b, gcs_bucket())
         mock_gcs.get_bucket.assert_called_once_with('xxx')
+
+    def test_reuses_client_and_bucket(self):
+        mock_gcs = storage.Client.return_value
+        self.assertIs(gcs_bucket(), gcs_bucket())
+        storage.Client.assert_called_once_with()
+        mock_gcs.get_bucket.assert_called_once_with('xxx')
+
+    def test_refetches_after_ttl(self):
+        mock_gcs = storage.Client.return_value
+        with patch.object(main.time, 'monotonic', Mock(return_value=0)):
+            gcs_bucket()
+        with patch.object(main.time, 'monotonic',
+                          Mock(return_value=main.GCS_BUCKET_TTL + 1)):
+            gcs_bucket()
+        storage.Client.assert_called_once_with()
+        self.assertEqual(2, mock_gcs.get_bucket.call_count)
+
+    def test_invalidated_on_error(self):
+        mock_gcs = storage.Client.return_value
+        mock_gcs.get_bucket.return_value.get_blob.side_effect = \
+            ServiceUnavailable('nope')
+        payload = { 'project_id': 1 }
+        self.assertRaises(ServiceUnavailable, load_latest_datafile, payload)
+        gcs_bucket()
+        self.assertEqual(2, storage.Client.call_count)
+        self.assertEqual(2, mock_gcs.get_bucket.call_count)
+
+    def test_kept_on_request_errors(self):
+        # Contention and missing objects say nothing about the client.
+        mock_gcs = storage.Client.return_value
+        payload = { 'project_id': 1 }
+        for error in (PreconditionFailed('moved'), NotFound('gone')):
+            mock_gcs.get_bucket.return_value.get_blob.side_effect = error
+            with self.subTest(error):
+                self.assertRaises(type(error), load_latest_datafile, payload)
+        gcs_bucket()
+        storage.Client.assert_called_once_with()
+        mock_gcs.get_bucket.assert_called_once_with('xxx')
+
+
+def datafile_payload(project_id=10847551550, timestamp=1539053286):
+    return {
+        'timestamp': timestamp,
+        'project_id': project_id,
+        'data': {
+            'cdn_url': 'https://cdn.optimizely.com/datafiles/BJwszDYczj8GsM3wAqR3tu.json',
+            'environment': 'Production',
+            'origin_url': 'https://optimizely.s3.amazonaws.com/datafiles/BJwszDYczj8GsM3wAqR3tu.json',
+            'revision': 459
+        },
+        'event': 'project.datafile_updated'
+    }
+
+
+def fixture(name, n):
+    with open('data/%s/%d.json' % (name, n), 'r') as f:
+        return f.read()
+
+
+def cdn_session(text):
+    return Mock(get=Mock(return_value=Mock(content=text.encode('utf-8'))))
+
+
+@patch.object(os, 'getenv', {
+    'OPTIMIZELY_WEBHOOK_SECRET': 'foo, bar',
+    'GCS_BUCKET_NAME': 'xxx',
+}.get)
+class DatafileUpdatedTest(TestCase):
+    def setUp(self):
+        reset_gcs()
+        self.gcs = FakeClient()
+        self.bucket = self.gcs.bucket('xxx')
+        p = patch.object(storage, 'Client', Mock(return_value=self.gcs))
+        p.start()
+        self.addCleanup(p.stop)
+
+    def post(self, payload):
+        data = json.dumps(payload).encode('utf-8')
+        request = Mock(
+            get_data=Mock(return_value=data),
+            json=payload,
+            headers={'X-Hub-Signature': sign(data)})
+        return webhook_post(request)
+
+    def publish(self, payload, text):
+        # Archive a revision the way another instance would have.
+        path = datafile_gcs_path(payload)
+        archived = self.bucket.put(path, text)
+        self.bucket.put(latest_pointer_gcs_path(payload), json.dumps({
+            'path': path,
+            'generation': archived.generation,
+            'sha256': 'x',
+            'timestamp': payload['timestamp'],
+        }))
+
+    def test_backend_calls_per_webhook(self):
+        payload = datafile_payload()
+        self.bucket.put(latest_datafile_gcs_path(payload),
+                        fixture('experiment-enabled', 0))
+
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-enabled', 1)))):
+            self.assertEqual('ok', self.post(payload))
+            self.assertEqual(1, storage.Client.call_count)
+            self.assertEqual({
+                'get_bucket': 1,
+                'get_blob': 2,
+                'download': 1,
+                'upload': 2,
+            }, dict(self.gcs.calls))
+
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-renamed', 1)))):
+            self.gcs.calls.clear()
+            self.post(datafile_payload(timestamp=1539053287))
+            self.assertEqual(1, storage.Client.call_count)
+            self.assertEqual({
+                'get_blob': 1,
+                'upload': 2,
+            }, dict(self.gcs.calls))
+
+    def test_records_history(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'history.db')
+        self.addCleanup(lambda: main._history.pop(path).close())
+
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-renamed', 0))
+        with patch.object(os, 'getenv', {
+                'OPTIMIZELY_WEBHOOK_SECRET': 'foo, bar',
+                'GCS_BUCKET_NAME': 'xxx',
+                'CHANGE_HISTORY_DB': path}.get), \
+             patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                 fixture('experiment-renamed', 1)))), \
+             patch.object(main, 'notify', Mock()):
+            self.post(datafile_payload())
+            main.notify.assert_called_once()
+
+        [entry] = history.ChangeHistory(path).query(10847551550)
+        self.assertEqual(1539053286, entry.timestamp)
+        self.assertEqual(json.loads(fixture('experiment-renamed', 1))[
+            'revision'], entry.revision)
+        self.assertEqual('Experiment `dan-testing-notifications` renamed to '
+                         '`dan-testing-notifications-foo`.', str(entry.change))
+
+    def test_history_failure_still_notifies(self):
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-renamed', 0))
+        store = Mock(record=Mock(side_effect=sqlite3.OperationalError('locked')))
+        with patch.object(main, 'change_history', Mock(return_value=store)), \
+             patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                 fixture('experiment-renamed', 1)))), \
+             patch.object(main, 'notify', Mock()), \
+             self.assertLogs('optimizely-changes', 'ERROR'):
+            self.assertEqual('ok', self.post(datafile_payload()))
+            main.notify.assert_called_once()
+
+    def test_notifies(self):
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-renamed', 0))
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-renamed', 1)))), \
+             patch.object(main, 'notify', Mock()):
+            self.post(datafile_payload())
+            main.notify.assert_called_once_with(
+                'Experiment `dan-testing-notifications` renamed to '
+                '`dan-testing-notifications-foo`.')
+
+    def test_traces_stages(self):
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-renamed', 0))
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-renamed', 1)))), \
+             patch.object(main, 'slack_url', Mock(return_value=None)), \
+             self.assertLogs('optimizely-changes.tracing') as cm:
+            self.post(datafile_payload())
+
+        [record] = [json.loads(r.getMessage()) for r in cm.records]
+        self.assertEqual('project.datafile_updated', record['event'])
+        self.assertEqual(10847551550, record['project_id'])
+        spans = { s['name']: s for s in record['spans'] }
+        self.assertEqual(sorted(['verify_request', 'load_latest',
+                                 'fetch_datafile', 'save_datafile',
+                                 'publish_latest', 'diff', 'notify']),
+                         sorted(s['name'] for s in record['spans']))
+        self.assertEqual(len(fixture('experiment-renamed', 1)),
+                         spans['fetch_datafile']['bytes'])
+        self.assertEqual('full', spans['save_datafile']['format'])
+        self.assertFalse(spans['load_latest']['cached'])
+        self.assertEqual(1, spans['diff']['changes'])
+        self.assertEqual(len(json.loads(fixture('experiment-renamed', 1))[
+            'experiments']), spans['diff']['experiments'])
+
+    def test_pipeline_overlaps_stages(self):
+        # Reading the latest overlaps fetching the new datafile, and
+        # archiving overlaps diffing. Each pair of stages meets at a
+        # barrier, which only lets them through if both are running at
+        # once; run one after the other, the first would time out.
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-renamed', 0))
+        reads = threading.Barrier(2, timeout=10)
+        writes = threading.Barrier(2, timeout=10)
+        met = []
+
+        def meet(barrier, name, f):
+            def wrapper(*args, **kwargs):
+                barrier.wait()
+                met.append(name)
+                return f(*args, **kwargs)
+            return wrapper
+
+        session = cdn_session(fixture('experiment-renamed', 1))
+        session.get.side_effect = meet(
+            reads, 'fetch', lambda *args, **kwargs: session.get.return_value)
+        with patch.object(main, 'http_session', Mock(return_value=session)), \
+             patch.object(main, 'load_latest',
+                          meet(reads, 'load_latest', main.load_latest)), \
+             patch.object(main, 'save_datafile',
+                          meet(writes, 'save_datafile', main.save_datafile)), \
+             patch.object(main, 'diff_datafiles',
+                          meet(writes, 'diff', main.diff_datafiles)), \
+             patch.object(main, 'notify', Mock()):
+            self.post(datafile_payload())
+            main.notify.assert_called_once_with(
+                'Experiment `dan-testing-notifications` renamed to '
+                '`dan-testing-notifications-foo`.')
+
+        self.assertEqual({'fetch', 'load_latest'}, set(met[:2]))
+        self.assertEqual({'save_datafile', 'diff'}, set(met[2:]))
+
+    def test_rediffs_when_pointer_moves_during_archive(self):
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-renamed', 0))
+        save_datafile = main.save_datafile
+
+        def save_after_other(payload, fetched, latest):
+            # Another instance publishes while we archive.
+            self.publish(datafile_payload(timestamp=2),
+                         fixture('experiment-renamed', 1))
+            return save_datafile(payload, fetched, latest)
+
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-removed', 1)))), \
+             patch.object(main, 'save_datafile', save_after_other), \
+             patch.object(main, 'notify', Mock()):
+            self.post(datafile_payload(timestamp=3))
+            main.notify.assert_called_once_with(
+                'Experiment `dan-testing-notifications-foo` paused.')
+
+    def post_coalesced(self, revisions):
+        env = {
+            'OPTIMIZELY_WEBHOOK_SECRET': 'foo, bar',
+            'GCS_BUCKET_NAME': 'xxx',
+            'NOTIFY_COALESCE_PROJECT_SECONDS': '10847551550=60',
+        }
+        with patch.object(os, 'getenv', env.get), \
+             patch.object(coalesce, 'timer', Mock()):
+            for i, (name, n) in enumerate(revisions):
+                with patch.object(main, 'http_session', Mock(
+                        return_value=cdn_session(fixture(name, n)))):
+                    self.post(datafile_payload(timestamp=2 + i))
+            main.notify.assert_not_called()
+            main.coalescer().flush()
+
+    def test_coalesces(self):
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-renamed', 0))
+        with patch.object(main, 'notify', Mock()):
+            self.post_coalesced([
+                ('experiment-renamed', 1),
+                ('experiment-removed', 1),
+            ])
+            main.notify.assert_called_once_with(
+                'Experiment `dan-testing-notifications-foo` paused.\n'
+                'Experiment `dan-testing-notifications` renamed to '
+                '`dan-testing-notifications-foo`.')
+
+    def test_coalesced_changes_cancel_out(self):
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-enabled', 0))
+        with patch.object(main, 'notify', Mock()):
+            self.post_coalesced([
+                ('experiment-enabled', 1),
+                ('experiment-enabled', 0),
+            ])
+            main.notify.assert_not_called()
+
+    def test_first_datafile_not_diffed(self):
+        payload = datafile_payload()
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-enabled', 1)))), \
+             patch.object(main, 'notify', Mock()):
+            self.post(payload)
+            main.notify.assert_not_called()
+
+        self.assertEqual(json.loads(fixture('experiment-enabled', 1)),
+                         load_latest_datafile(payload))
+
+    def test_latest_cache_checks_generation(self):
+        payload = datafile_payload()
+        self.publish(datafile_payload(timestamp=1),
+                     fixture('experiment-enabled', 0))
+
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-enabled', 1)))):
+            self.post(payload)
+
+        self.gcs.calls.clear()
+        self.assertEqual(json.loads(fixture('experiment-enabled', 1)),
+                         load_latest_datafile(payload))
+        self.assertEqual(0, self.gcs.calls['download'])
+
+        # Another instance wrote since; the cached copy must not be used.
+        self.publish(datafile_payload(timestamp=1539053290),
+                     fixture('experiment-renamed', 0))
+        self.assertEqual(json.loads(fixture('experiment-renamed', 0)),
+                         load_latest_datafile(payload))
+        self.assertEqual(2, self.gcs.calls['download'])
+
+    def test_uploads_fetched_bytes(self):
+        payload = datafile_payload()
+        session = cdn_session(fixture('experiment-enabled', 1))
+        with patch.object(main, 'http_session', Mock(return_value=session)):
+            self.post(payload)
+
+        session.get.assert_called_once_with(
+            payload['data']['origin_url'], timeout=main.CDN_TIMEOUT)
+        data, _ = self.bucket.objects[datafile_gcs_path(payload)]
+        self.assertIs(session.get.return_value.content, data)
+        self.assertNotIn(latest_datafile_gcs_path(payload), self.bucket.objects)
+
+    def save(self, payload, name, n):
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture(name, n)))):
+            return save_datafile(payload, fetch_datafile(payload))
+
+    def test_skips_identical_datafile(self):
+        metrics.reset()
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-renamed', 0)))):
+            self.post(datafile_payload(timestamp=1))
+            self.gcs.calls.clear()
+            with patch.object(main.differ, 'DatafileDiffer', Mock()):
+                self.post(datafile_payload(timestamp=2))
+                main.differ.DatafileDiffer.assert_not_called()
+
+        # Only the pointer's timestamp moves; nothing new is archived.
+        self.assertEqual({'get_blob': 1, 'upload': 1}, dict(self.gcs.calls))
+        self.assertNotIn(datafile_gcs_path(datafile_payload(timestamp=2)),
+                         self.bucket.objects)
+        self.assertEqual(1, metrics.count('datafile.dedupe', result='raw'))
+        self.assertEqual(1, metrics.count('datafile.dedupe', result='miss'))
+
+    def test_late_duplicate_does_not_touch_pointer(self):
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-renamed', 0)))):
+            self.post(datafile_payload(timestamp=2))
+            self.gcs.calls.clear()
+            self.post(datafile_payload(timestamp=1))
+        self.assertEqual({'get_blob': 1}, dict(self.gcs.calls))
+
+    def test_duplicate_blocks_older_revision(self):
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-renamed', 0)))):
+            self.post(datafile_payload(timestamp=1))
+            self.post(datafile_payload(timestamp=3))
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture('experiment-renamed', 1)))):
+            self.post(datafile_payload(timestamp=2))
+        self.assertEqual(json.loads(fixture('experiment-renamed', 0)),
+                         load_latest_datafile(datafile_payload()))
+
+    def test_skips_revision_only_change(self):
+        metrics.reset()
+        name = 'experiment-description-modified'
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture(name, 0)))):
+            self.post(datafile_payload(timestamp=1))
+        self.gcs.calls.clear()
+        with patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                fixture(name, 1)))), \
+             patch.object(main.differ, 'DatafileDiffer', Mock()):
+            self.post(datafile_payload(timestamp=2))
+            main.differ.DatafileDiffer.assert_not_called()
+
+        self.assertEqual(1, self.gcs.calls['upload'])
+        self.assertEqual(1, metrics.count('datafile.dedupe', result='canonical'))
+        self.assertEqual(json.loads(fixture(name, 0)),
+                         load_latest_datafile(datafile_payload()))
+
+    def test_canonical_digest_ignores_order_and_revision(self):
+        self.assertEqual(
+            main.canonical_digest({'revision': '1', 'a': [1, 2], 'b': {'x': 1, 'y': 2}}),
+            main.canonical_digest({'b': {'y': 2, 'x': 1}, 'a': [1, 2], 'revision': '2'}))
+        self.assertNotEqual(
+            main.canonical_digest({'a': [1, 2]}),
+            main.canonical_digest({'a': [2, 1]}))
+
+    def test_publish_retries_when_pointer_moves(self):
+        p0 = datafile_payload(timestamp=1)
+        p1 = datafile_payload(timestamp=2)
+        p2 = datafile_payload(timestamp=3)
+        self.publish(p0, fixture('experiment-renamed', 0))
+
+        # Both webhooks read the same latest before either publishes.
+        latest = main.load_latest(p1)
+        self.assertEqual(latest, main.load_latest(p2))
+
+        r1 = self.save(p1, 'experiment-renamed', 1)
+        self.assertEqual(json.loads(fixture('experiment-renamed', 0)),
+                         publish_latest(p1, r1, latest).datafile)
+
+        r2 = self.save(p2, 'experiment-enabled', 1)
+        self.assertEqual(r1.datafile, publish_latest(p2, r2, latest).datafile)
+        self.assertEqual(r2.datafile, load_latest_datafile(p2))
+
+    def test_load_latest_rereads_moved_pointer(self):
+        p0 = datafile_payload(timestamp=1)
+        p1 = datafile_payload(timestamp=2)
+        self.publish(p0, fixture('experiment-renamed', 0))
+        get_blob = self.bucket.get_blob
+        moved = []
+
+        def get_blob_then_publish(name, **kwargs):
+            # Another instance publishes right after the pointer's
+            # generation is read, once.
+            b = get_blob(name, **kwargs)
+            if not moved:
+                moved.append(True)
+                self.publish(p1, fixture('experiment-renamed', 1))
+            return b
+
+        with patch.object(self.bucket, 'get_blob', get_blob_then_publish):
+            latest = main.load_latest(p1)
+        self.assertEqual(json.loads(fixture('experiment-renamed', 1)),
+                         latest.datafile)
+        self.assertEqual(
+            self.bucket.get_blob(latest_pointer_gcs_path(p1)).generation,
+            latest.generation)
+
+    def test_publish_rereads_pointer_moved_during_retry(self):
+        p0 = datafile_payload(timestamp=1)
+        p1 = datafile_payload(timestamp=2)
+        p2 = datafile_payload(timestamp=3)
+        self.publish(p0, fixture('experiment-renamed', 0))
+        latest = main.load_latest(p2)
+        self.publish(p1, fixture('experiment-renamed', 1))
+
+        get_blob = self.bucket.get_blob
+        moves = []
+
+        def get_blob_then_publish(name, **kwargs):
+            # The pointer moves again while the retry re-reads it.
+            b = get_blob(name, **kwargs)
+            if name.endswith('pointer.json') and not moves:
+                moves.append(True)
+                self.publish(p1, fixture('experiment-renamed', 1))
+            return b
+
+        r2 = self.save(p2, 'experiment-enabled', 1)
+        with patch.object(self.bucket, 'get_blob', get_blob_then_publish):
+            replaced = publish_latest(p2, r2, latest)
+        self.assertEqual(json.loads(fixture('experiment-renamed', 1)),
+                         replaced.datafile)
+        self.assertEqual(r2.datafile, load_latest_datafile(p2))
+
+    def race_same_timestamp(self, archive_format):
+        # A redelivered webhook handled by two instances at once: both
+        # archive the same revision to the same path, then publish it.
+        env = {'GCS_BUCKET_NAME': 'xxx', 'ARCHIVE_FORMAT': archive_format}
+        p1 = datafile_payload(timestamp=1)
+        p2 = datafile_payload(timestamp=2)
+        self.publish(p1, fixture('experiment-renamed', 0))
+        with patch.object(os, 'getenv', env.get), \
+             patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                 fixture('experiment-renamed', 1)))):
+            latest = main.load_latest(p2)
+            first = save_datafile(p2, fetch_datafile(p2), latest)
+            second = save_datafile(p2, fetch_datafile(p2), latest)
+            self.assertEqual((first.path, first.generation),
+                             (second.path, second.generation))
+            self.assertEqual(latest.datafile,
+                             publish_latest(p2, first, latest).datafile)
+            publish_latest(p2, second, latest)
+
+            reset_gcs()
+            self.assertEqual(json.loads(fixture('experiment-renamed', 1)),
+                             load_latest_datafile(datafile_payload(timestamp=3)))
+        return first
+
+    def test_same_timestamp_race(self):
+        self.assertIsNone(self.race_same_timestamp('full').base)
+
+    def test_same_timestamp_race_delta(self):
+        self.assertTrue(self.race_same_timestamp('delta').base)
+
+    def test_same_timestamp_delta_against_other_snapshot(self):
+        # The delta already archived was made against another snapshot
+        # than the one this instance read; the pointer names that one.
+        p1 = datafile_payload(timestamp=1)
+        p2 = datafile_payload(timestamp=2)
+        self.publish(p1, fixture('experiment-renamed', 0))
+        other = self.bucket.put('datafile/10847551550/0/other.json',
+                                fixture('experiment-renamed', 0))
+        path = datafile_gcs_path(p2) + '.delta'
+        self.bucket.put(path, main.deltas.encode(other.name, other.generation, []))
+
+        env = {'GCS_BUCKET_NAME': 'xxx', 'ARCHIVE_FORMAT': 'delta'}
+        with patch.object(os, 'getenv', env.get), \
+             patch.object(main, 'http_session', Mock(return_value=cdn_session(
+                 fixture('experiment-renamed', 0)))):
+            latest = main.load_latest(p2)
+            r = save_datafile(p2, fetch_datafile(p2), latest)
+        self.assertEqual(path, r.path)
+        self.assertEqual({'path': other.name, 'generation': other.generation,
+                          'deltas': main.ARCHIVE_SNAPSHOT_INTERVAL - 1}, r.base)
+
+    def test_publish_does_not_go_backwards(self):
+        p0 = datafile_payload(timestamp=5)
+        p1 = datafile_payload(timestamp=4)
+        self.publish(p0, fixture('experiment-renamed', 0))
+
+        latest = main.load_latest(p1)
+        r1 = self.save(p1, 'experiment-renamed', 1)
+        self.assertIsNone(publish_latest(p1, r1, latest))
+        self.assertEqual(json.loads(fixture('experiment-renamed', 0)),
+                         load_latest_datafile(p1))
+
+    def post_revisions(self, revisions, archive_format='delta'):
+        env = {
+            'OPTIMIZELY_WEBHOOK_SECRET': 'foo, bar',
+            'GCS_BUCKET_NAME': 'xxx',
+            'ARCHIVE_FORMAT': archive_format,
+        }
+        with patch.object(os, 'getenv', env.get), \
+             patch.object(main, 'notify', Mock()):
+            for i, (name, n) in enumerate(revisions):
+                with patch.object(main, 'http_session', Mock(
+                        return_value=cdn_session(fixture(name, n)))):
+                    self.post(datafile_payload(timestamp=1 + i))
+            return main.notify
+
+    def test_delta_archive(self):
+        notify = self.post_revisions([
+            ('experiment-renamed', 0),
+            ('experiment-renamed', 1),
+            ('experiment-removed', 1),
+        ])
+        self.assertEqual([
+            'datafile/10847551550/1/BJwszDYczj8GsM3wAqR3tu.json',
+            'datafile/10847551550/2/BJwszDYczj8GsM3wAqR3tu.json.delta',
+            'datafile/10847551550/3/BJwszDYczj8GsM3wAqR3tu.json.delta',
+            'datafile/10847551550/_latest/pointer.json',
+        ], sorted(self.bucket.objects))
+        self.assertEqual(2, notify.call_count)
+
+        pointer = json.loads(self.bucket.objects[
+            latest_pointer_gcs_path(datafile_payload())][0])
+        self.assertEqual({
+            'path': 'datafile/10847551550/1/BJwszDYczj8GsM3wAqR3tu.json',
+            'generation': 1,
+            'deltas': 2,
+        }, pointer['base'])
+
+        # Loading the latest revision reads the pointer, the delta and its
+        # snapshot, however long the chain of deltas.
+        reset_gcs()
+        self.gcs.calls.clear()
+        self.assertEqual(json.loads(fixture('experiment-removed', 1)),
+                         load_latest_datafile(datafile_payload()))
+        self.assertEqual(3, self.gcs.calls['download'])
+
+    def test_delta_archive_takes_snapshots(self):
+        with patch.object(main, 'ARCHIVE_SNAPSHOT_INTERVAL', 2):
+            self.post_revisions([
+                ('experiment-renamed', 0),
+                ('experiment-renamed', 1),
+                ('experiment-removed', 1),
+                ('experiment-renamed', 1),
+            ])
+        self.assertEqual([
+            'datafile/10847551550/1/BJwszDYczj8GsM3wAqR3tu.json',
+            'datafile/10847551550/2/BJwszDYczj8GsM3wAqR3tu.json.delta',
+            'datafile/10847551550/3/BJwszDYczj8GsM3wAqR3tu.json',
+            'datafile/10847551550/4/BJwszDYczj8GsM3wAqR3tu.json.delta',
+            'datafile/10847551550/_latest/pointer.json',
+        ], sorted(self.bucket.objects))
+        reset_gcs()
+        self.assertEqual(json.loads(fixture('experiment-renamed', 1)),
+                         load_latest_datafile(datafile_payload()))
+
+    def test_full_archive_by_default(self):
+        self.post_revisions([
+            ('experiment-renamed', 0),
+            ('experiment-renamed', 1),
+        ], archive_format=None)
+        self.assertEqual([
+            'datafile/10847551550/1/BJwszDYczj8GsM3wAqR3tu.json',
+            'datafile/10847551550/2/BJwszDYczj8GsM3wAqR3tu.json',
+            'datafile/10847551550/_latest/pointer.json',
+        ], sorted(self.bucket.objects))
+
+    def test_load_latest_gives_up(self):
+        payload = datafile_payload()
+        self.publish(payload, fixture('experiment-renamed', 0))
+        with patch.object(main, 'LATEST_SWAP_ATTEMPTS', 0):
+            self.assertRaises(main.LatestPointerConflict, main.load_latest,
+                              payload)
+
+    def test_publish_gives_up(self):
+        payload = datafile_payload()
+        r = self.save(payload, 'experiment-renamed', 1)
+        latest = main.load_latest(payload)
+        with patch.object(main, 'LATEST_SWAP_ATTEMPTS', 0):
+            self.assertRaises(main.LatestPointerConflict, publish_latest,
+                              payload, r, latest)
+
+
+class LocalStorageTest(TestCase):
+    def setUp(self):
+        reset_gcs()
+        self.addCleanup(reset_gcs)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def post_revisions(self, revisions, archive_format=None):
+        env = {
+            'OPTIMIZELY_WEBHOOK_SECRET': 'foo, bar',
+            'LOCAL_STORAGE_DIR': self.root,
+            'ARCHIVE_FORMAT': archive_format,
+        }
+        with patch.object(os, 'getenv', env.get), \
+             patch.object(storage, 'Client', Mock()), \
+             patch.object(main, 'notify', Mock()):
+            for i, (name, n) in enumerate(revisions):
+                with patch.object(main, 'http_session', Mock(
+                        return_value=cdn_session(fixture(name, n)))):
+                    data = json.dumps(datafile_payload(timestamp=1 + i))
+                    self.assertEqual('ok', webhook_post(Mock(
+                        get_data=Mock(return_value=data.encode('utf-8')),
+                        json=json.loads(data),
+                        headers={'X-Hub-Signature': sign(
+                            data.encode('utf-8'))})))
+            storage.Client.assert_not_called()
+            return main.notify
+
+    def archived(self):
+        return sorted(b.name for b in LocalBucket(self.root).list_blobs())
+
+    def test_archives_to_disk(self):
+        notify = self.post_revisions([
+            ('experiment-renamed', 0),
+            ('experiment-renamed', 1),
+        ])
+        self.assertEqual([
+            'datafile/10847551550/1/BJwszDYczj8GsM3wAqR3tu.json',
+            'datafile/10847551550/2/BJwszDYczj8GsM3wAqR3tu.json',
+            'datafile/10847551550/_latest/pointer.json',
+        ], self.archived())
+        notify.assert_called_once_with(
+            'Experiment `dan-testing-notifications` renamed to '
+            '`dan-testing-notifications-foo`.')
+
+        reset_gcs()
+        with patch.object(os, 'getenv', {'LOCAL_STORAGE_DIR': self.root}.get):
+            self.assertEqual(json.loads(fixture('experiment-renamed', 1)),
+                             load_latest_datafile(datafile_payload()))
+
+    def test_delta_archive(self):
+        notify = self.post_revisions([
+            ('experiment-renamed', 0),
+            ('experiment-renamed', 1),
+            ('experiment-removed', 1),
+        ], archive_format='delta')
+        self.assertEqual([
+            'datafile/10847551550/1/BJwszDYczj8GsM3wAqR3tu.json',
+            'datafile/10847551550/2/BJwszDYczj8GsM3wAqR3tu.json.delta',
+            'datafile/10847551550/3/BJwszDYczj8GsM3wAqR3tu.json.delta',
+            'datafile/10847551550/_latest/pointer.json',
+        ], self.archived())
+        self.assertEqual(2, notify.call_count)
+
+
+class HttpSessionTest(TestCase):
+    def test_reused(self):
+        self.assertIsInstance(main.http_session(), requests.Session)
+        self.assertIs(main.http_session(), main.http_session())
+
+
+class SharedObjectsTest(TestCase):
+    def test_built_once_by_concurrent_first_requests(self):
+        barrier = threading.Barrier(8)
+
+        def slow_executor(workers):
+            time.sleep(0.05)
+            return Mock()
+
+        with patch.object(main, '_projects', {}), \
+             patch.object(main, '_coalescers', {}), \
+             patch.object(main.shards, 'ProjectExecutor', slow_executor), \
+             patch.object(main.coalesce, 'Coalescer',
+                          lambda *args, **kwargs: slow_executor(0)), \
+             ThreadPoolExecutor(max_workers=8) as pool:
+            def first_request(_):
+                barrier.wait()
+                return main.project_executor(), main.coalescer()
+            built = list(pool.map(first_request, range(8)))
+        self.assertEqual(1, len({ id(e) for e, _ in built }))
+        self.assertEqual(1, len({ id(c) for _, c in built }))
+
+
+class ColdStartTest(TestCase):
+    def test_heavy_imports_deferred(self):
+        out = subprocess.check_output([sys.executable, '-c', (
+            'import main, sys; print(",".join(sorted(m for m in ('
+            '"google.cloud.storage", "requests", "flask", "optimizely", '
+            '"jsonschema") if m in sys.modules)))')])
+        self.assertEqual(b'', out.strip())
@@ -0,0 +1,26 @@
+import metrics
+from unittest import TestCase
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_counts(self):
+        metrics.incr('foo')
+        metrics.incr('foo', 2)
+        self.assertEqual(3, metrics.count('foo'))
+        self.assertEqual(0, metrics.count('bar'))
+
+    def test_tags(self):
+        metrics.incr('foo', result='a', project=1)
+        metrics.incr('foo', result='b', project=1)
+        metrics.incr('foo', result='a', project=2)
+        self.assertEqual(3, metrics.count('foo'))
+        self.assertEqual(2, metrics.count('foo', result='a'))
+        self.assertEqual(1, metrics.count('foo', result='a', project=2))
+
+    def test_reset(self):
+        metrics.incr('foo')
+        metrics.reset()
+        self.assertEqual(0, metrics.count('foo'))
@@ -0,0 +1,189 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from email.utils import formatdate
+from notifications import Dispatcher, SlackSink, Sink, RetryableError, \
+    parse_retry_after
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock
+
+
+class StubSlack(object):
+    # A local HTTP server that answers POSTs with scripted status codes,
+    # or (status, headers) pairs (200 once the script runs out), and
+    # records what it was sent.
+    def __init__(self, statuses=(), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.received = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with stub.lock:
+                    stub.received.append(json.loads(body))
+                    status = stub.statuses.pop(0) if stub.statuses else 200
+                status, headers = status if isinstance(status, tuple) \
+                    else (status, {})
+                time.sleep(stub.delay)
+                try:
+                    self.send_response(status)
+                    for k, v in headers.items():
+                        self.send_header(k, v)
+                    self.send_header('Content-Length', '2')
+                    self.end_headers()
+                    self.wfile.write(b'ok')
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client timed out and hung up.
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/hook' % self.server.server_address[1]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class DispatcherTest(TestCase):
+    def stub(self, *args, **kwargs):
+        s = StubSlack(*args, **kwargs)
+        self.addCleanup(s.close)
+        return s
+
+    def dispatcher(self, sink, **kwargs):
+        d = Dispatcher(sink, sleep=Mock(), **kwargs)
+        self.addCleanup(d.shutdown)
+        return d
+
+    def test_delivers(self):
+        slack = self.stub()
+        d = self.dispatcher(SlackSink(slack.url))
+        self.assertTrue(d.submit('hello').result(5))
+        self.assertEqual([{
+            'username': 'Optimizely',
+            'icon_url': 'https://app.optimizely.com/static/img/favicon-32x32.png',
+            'text': 'hello',
+        }], slack.received)
+
+    def test_retries_with_backoff(self):
+        slack = self.stub([500, 503, 429])
+        d = self.dispatcher(SlackSink(slack.url), backoff=1)
+        self.assertTrue(d.submit('hello').result(5))
+        self.assertEqual(4, len(slack.received))
+        self.assertEqual([((1,),), ((2,),), ((4,),)],
+                         d.sleep.call_args_list)
+
+    def test_retry_after(self):
+        slack = self.stub([(429, {'Retry-After': '3'}),
+                           (503, {'Retry-After': 'soon'}),
+                           (503, {'Retry-After': formatdate(usegmt=True)})])
+        d = self.dispatcher(SlackSink(slack.url), backoff=1)
+        self.assertTrue(d.submit('hello').result(5))
+        self.assertEqual(4, len(slack.received))
+        # An unreadable header falls back to backoff; a date in the past
+        # (by the time it's read) means now.
+        delays = [c[0][0] for c in d.sleep.call_args_list]
+        self.assertEqual([3, 2], delays[:2])
+        self.assertLess(delays[2], 1.5)
+
+    def test_retry_after_capped(self):
+        slack = self.stub([(429, {'Retry-After': '86400'}),
+                           (503, {'Retry-After': 'inf'})])
+        d = self.dispatcher(SlackSink(slack.url), backoff=1, max_backoff=30)
+        self.assertTrue(d.submit('hello').result(5))
+        self.assertEqual([((30,),), ((2,),)], d.sleep.call_args_list)
+
+    def test_unusable_delays_back_off(self):
+        sink = Mock(send=Mock(side_effect=[
+            RetryableError('x', float('nan')), RetryableError('x', float('inf')),
+            RetryableError('x', -1), None]))
+        d = self.dispatcher(sink, backoff=1, max_backoff=30)
+        self.assertTrue(d.submit('hello').result(5))
+        self.assertEqual([((1,),), ((2,),), ((0,),)], d.sleep.call_args_list)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(120, parse_retry_after('120'))
+        self.assertEqual(0, parse_retry_after('-5'))
+        self.assertEqual(30, parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:30 GMT', now=1445412480))
+        self.assertEqual(0, parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT', now=1445412510))
+        for value in (None, '', 'soon', 'Wed, 99 Oct', 'inf', '-inf', 'nan'):
+            with self.subTest(value):
+                self.assertIsNone(parse_retry_after(value))
+
+    def test_gives_up(self):
+        slack = self.stub([500] * 10)
+        d = self.dispatcher(SlackSink(slack.url), attempts=3)
+        self.assertFalse(d.submit('hello').result(5))
+        self.assertEqual(3, len(slack.received))
+
+    def test_does_not_retry_client_errors(self):
+        slack = self.stub([404])
+        d = self.dispatcher(SlackSink(slack.url))
+        self.assertFalse(d.submit('hello').result(5))
+        self.assertEqual(1, len(slack.received))
+
+    def test_times_out(self):
+        slack = self.stub(delay=0.5)
+        d = self.dispatcher(SlackSink(slack.url, timeout=(1, 0.05)), attempts=2)
+        self.assertFalse(d.submit('hello').result(5))
+        self.assertEqual(1, d.sleep.call_count)
+
+    def test_connection_refused_is_retried(self):
+        slack = self.stub()
+        url = slack.url
+        slack.close()
+        d = self.dispatcher(SlackSink(url), attempts=2)
+        self.assertFalse(d.submit('hello').result(5))
+        self.assertEqual(1, d.sleep.call_count)
+
+    def test_submit_does_not_block(self):
+        slack = self.stub(delay=0.3)
+        d = self.dispatcher(SlackSink(slack.url))
+        start = time.monotonic()
+        d.submit('hello')
+        self.assertLess(time.monotonic() - start, 0.2)
+        d.flush()
+        self.assertEqual(1, len(slack.received))
+
+    def test_bounded_concurrency(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        class SlowSink(Sink):
+            def send(self, text):
+                with lock:
+                    active.append(text)
+                    peak.append(len(active))
+                time.sleep(0.02)
+                with lock:
+                    active.remove(text)
+
+        d = self.dispatcher(SlowSink(), max_workers=2)
+        for i in range(8):
+            d.submit(str(i))
+        d.flush()
+        self.assertEqual(8, len(peak))
+        self.assertEqual(2, max(peak))
+
+    def test_pluggable_sink(self):
+        sink = Mock(send=Mock(side_effect=[RetryableError('x', 7), None]))
+        d = self.dispatcher(sink)
+        self.assertTrue(d.submit('hello').result(5))
+        d.sleep.assert_called_once_with(7)
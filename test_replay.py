@@ -0,0 +1,111 @@
+import deltas
+import history
+import io
+import json
+import os
+import replay
+import shutil
+import tempfile
+from unittest import TestCase
+
+
+def fixture(name, n):
+    with open('data/%s/%d.json' % (name, n), 'rb') as f:
+        return f.read()
+
+
+class ReplayTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.spec = ('local', self.root)
+
+        # Timestamps deliberately sort differently as strings.
+        self.archive(1, 900, fixture('experiment-renamed', 0))
+        self.archive(1, 1000, fixture('experiment-renamed', 1))
+        self.archive(1, 1100, fixture('experiment-removed', 1))
+        self.archive(1, 1200, fixture('experiment-description-modified', 0))
+        self.archive(2, 1000, fixture('experiment-enabled', 0))
+        os.makedirs(os.path.join(self.root, 'datafile/1/_latest'))
+        with open(os.path.join(self.root, 'datafile/1/_latest/pointer.json'), 'w') as f:
+            f.write('{}')
+
+    def archive(self, project_id, timestamp, data, name='abc.json'):
+        d = os.path.join(self.root, 'datafile', str(project_id), str(timestamp))
+        os.makedirs(d)
+        with open(os.path.join(d, name), 'wb') as f:
+            f.write(data)
+
+    def test_revisions(self):
+        self.assertEqual([
+            (900, 'datafile/1/900/abc.json'),
+            (1000, 'datafile/1/1000/abc.json'),
+            (1100, 'datafile/1/1100/abc.json'),
+            (1200, 'datafile/1/1200/abc.json'),
+        ], replay.revisions(replay.open_archive(self.spec), 1))
+
+    def test_replay(self):
+        entries = list(replay.replay(self.spec, 1, processes=2, chunksize=1))
+        self.assertEqual([
+            (1000, 'datafile/1/1000/abc.json', '501', [
+                'Experiment `dan-testing-notifications` renamed to '
+                '`dan-testing-notifications-foo`.']),
+            (1100, 'datafile/1/1100/abc.json', '493', [
+                'Experiment `dan-testing-notifications-foo` paused.']),
+            (1200, 'datafile/1/1200/abc.json', '499', [
+                'Experiment `dan-testing-notifications` enabled. 1.67% a, '
+                '1.67% b, 1.67% c, 94.99% not bucketed.']),
+        ], entries)
+
+    def test_replays_deltas(self):
+        base = json.loads(fixture('experiment-renamed', 0))
+        for timestamp, name, n in [(2000, 'experiment-renamed', 1),
+                                   (2100, 'experiment-removed', 1)]:
+            patch = deltas.make_patch(base, json.loads(fixture(name, n)))
+            self.archive(3, timestamp, deltas.encode(
+                'datafile/3/1900/abc.json', 1, patch), 'abc.json.delta')
+        self.archive(3, 1900, fixture('experiment-renamed', 0))
+
+        entries = list(replay.replay(self.spec, 3, processes=1))
+        self.assertEqual([
+            (2000, 'datafile/3/2000/abc.json.delta', '501', [
+                'Experiment `dan-testing-notifications` renamed to '
+                '`dan-testing-notifications-foo`.']),
+            (2100, 'datafile/3/2100/abc.json.delta', '493', [
+                'Experiment `dan-testing-notifications-foo` paused.']),
+        ], entries)
+
+    def test_single_revision(self):
+        self.assertEqual([], list(replay.replay(self.spec, 2)))
+
+    def test_changelog(self):
+        out = io.StringIO()
+        replay.write_changelog([
+            (1539053286, 'p', '459', ['a', 'b']),
+            (1539053287, 'p', '460', []),
+        ], out)
+        self.assertEqual(
+            '## 2018-10-09 02:48:06 UTC (revision 459)\n\n* a\n* b\n\n',
+            out.getvalue())
+
+    def test_cli(self):
+        output = os.path.join(self.root, 'changes.jsonl')
+        replay.main(['1', '--local', self.root, '--format', 'json',
+                     '--output', output, '--include-empty', '--processes', '1'])
+        with open(output) as f:
+            lines = [json.loads(l) for l in f]
+        self.assertEqual([1000, 1100, 1200], [l['timestamp'] for l in lines])
+
+    def test_cli_records_history(self):
+        db = os.path.join(self.root, 'history.db')
+        replay.main(['1', '--local', self.root, '--format', 'json',
+                     '--output', os.path.join(self.root, 'changes.jsonl'),
+                     '--processes', '1', '--history', db])
+        store = history.ChangeHistory(db)
+        self.addCleanup(store.close)
+        self.assertEqual([
+            (1200, '499', 'experiment_enabled'),
+            (1100, '493', 'experiment_paused'),
+            (1000, '501', 'experiment_renamed'),
+        ], [(e.timestamp, e.revision, e.change.kind)
+            for e in store.query(1)])
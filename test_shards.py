@@ -0,0 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor
+from fake_gcs import FakeClient
+from google.cloud import storage
+from hashlib import sha1
+import hmac
+import json
+import main
+import os
+import random
+from shards import ProjectExecutor
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+
+class ProjectExecutorTest(TestCase):
+    def setUp(self):
+        self.executor = ProjectExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_same_project_in_order(self):
+        seen = []
+
+        def work(i):
+            time.sleep(random.random() / 1000)
+            seen.append(i)
+            return i
+
+        futures = [self.executor.submit('p', work, i) for i in range(50)]
+        self.assertEqual(list(range(50)), [f.result(5) for f in futures])
+        self.assertEqual(list(range(50)), seen)
+
+    def test_same_project_never_concurrent(self):
+        active = []
+        overlaps = []
+
+        def work():
+            active.append(1)
+            overlaps.append(len(active))
+            time.sleep(0.001)
+            active.pop()
+
+        futures = [self.executor.submit('p', work) for _ in range(20)]
+        for f in futures:
+            f.result(5)
+        self.assertEqual(1, max(overlaps))
+
+    def test_projects_run_in_parallel(self):
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def block():
+            blocked.set()
+            release.wait(5)
+
+        a = self.executor.submit('a', block)
+        blocked.wait(5)
+        # b isn't stuck behind a.
+        self.assertEqual('b', self.executor.submit('b', lambda: 'b').result(5))
+        # More work for a waits for the first item.
+        a2 = self.executor.submit('a', lambda: 'a2')
+        self.assertFalse(a2.done())
+        release.set()
+        a.result(5)
+        self.assertEqual('a2', a2.result(5))
+
+    def test_exceptions(self):
+        def fail():
+            raise ValueError('nope')
+
+        f = self.executor.submit('p', fail)
+        self.assertRaises(ValueError, f.result, 5)
+        self.assertEqual(1, self.executor.submit('p', lambda: 1).result(5))
+        self.assertEqual({}, self.executor.queues)
+
+
+def fixture(name, n):
+    with open('data/%s/%d.json' % (name, n), 'r') as f:
+        return json.loads(f.read())
+
+
+class ProjectStressTest(TestCase):
+    # Interleaved webhooks for many projects, sent concurrently against a
+    # local fake bucket. Every project's revisions alternate between two
+    # datafiles, so each revision should be reported as diffed against the
+    # one before it exactly once. Diffs are started before the revision is
+    # published and may be thrown away, so what counts is what reaches the
+    # coalescer.
+    projects = 20
+    revisions = 8
+
+    def setUp(self):
+        main.reset_gcs()
+        self.gcs = FakeClient()
+        self.datafiles = {}
+        self.diffs = []
+        self.lock = threading.Lock()
+
+        env = {'OPTIMIZELY_WEBHOOK_SECRET': 'foo', 'GCS_BUCKET_NAME': 'xxx'}
+        def diff(old, current):
+            return Mock(changes=Mock(return_value=[
+                (old['projectId'], old['revision'], current['revision'])]))
+
+        def record(project_id, changes):
+            with self.lock:
+                self.diffs.extend(changes)
+
+        for p in (
+                patch.object(os, 'getenv', env.get),
+                patch.object(storage, 'Client', Mock(return_value=self.gcs)),
+                patch.object(main, 'http_session', Mock(return_value=Mock(
+                    get=self.cdn_get))),
+                patch.object(main.differ, 'DatafileDiffer', diff),
+                patch.object(main, 'coalescer', Mock(
+                    return_value=Mock(add=record))),
+                patch.object(main, 'project_executor', Mock(
+                    return_value=ProjectExecutor(max_workers=8))),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def cdn_get(self, url, timeout=None):
+        time.sleep(random.random() / 1000)
+        return Mock(content=self.datafiles[url])
+
+    def payload(self, project_id, revision):
+        url = 'https://cdn.optimizely.com/datafiles/%s-%s.json' % (
+            project_id, revision)
+        d = fixture('experiment-enabled', revision % 2)
+        d['projectId'] = str(project_id)
+        d['revision'] = str(revision)
+        self.datafiles[url] = json.dumps(d).encode('utf-8')
+        return {
+            'timestamp': 1000 + revision,
+            'project_id': project_id,
+            'data': {
+                'cdn_url': url,
+                'environment': 'Production',
+                'origin_url': url,
+                'revision': revision,
+            },
+            'event': 'project.datafile_updated',
+        }
+
+    def post(self, payload):
+        data = json.dumps(payload).encode('utf-8')
+        sig = 'sha1=' + hmac.new(b'foo', msg=data, digestmod=sha1).hexdigest()
+        return main.webhook_post(Mock(
+            get_data=Mock(return_value=data),
+            json=payload,
+            headers={'X-Hub-Signature': sig}))
+
+    def test_interleaved_projects(self):
+        # Each project's revisions are sent in order, from its own thread,
+        # interleaved with every other project's.
+        def send(project_id):
+            return [self.post(self.payload(project_id, r))
+                    for r in range(self.revisions)]
+
+        with ThreadPoolExecutor(max_workers=self.projects) as pool:
+            results = list(pool.map(send, range(self.projects)))
+        self.assertEqual([['ok'] * self.revisions] * self.projects, results)
+
+        expected = sorted(
+            (str(p), str(r - 1), str(r))
+            for p in range(self.projects) for r in range(1, self.revisions))
+        self.assertEqual(expected, sorted(self.diffs))
+
+        for p in range(self.projects):
+            latest = main.load_latest({'project_id': p})
+            self.assertEqual(str(self.revisions - 1), latest.datafile['revision'])
+
+    def test_concurrent_revisions_of_one_project(self):
+        # All revisions of one project at once, in any order. Whatever
+        # order they land in, each published revision is diffed against
+        # the one published before it and the newest one wins.
+        payloads = [self.payload(0, r) for r in range(self.revisions * 3)]
+        random.shuffle(payloads)
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(self.post, payloads))
+
+        # A revision that only differs in its revision number is skipped as
+        # a duplicate, so the newest revision may be represented by an
+        # equivalent earlier one.
+        newest = self.revisions * 3 - 1
+        latest = main.load_latest({'project_id': 0})
+        self.assertEqual(1000 + newest, latest.pointer['timestamp'])
+        self.assertEqual(newest % 2, int(latest.datafile['revision']) % 2)
+        chain = [old for _, old, _ in self.diffs] + [latest.datafile['revision']]
+        self.assertEqual(len(set(chain)), len(chain))
+        for (_, old, current), (_, nxt, _) in zip(self.diffs, self.diffs[1:]):
+            self.assertEqual(current, nxt)
+            self.assertLess(int(old), int(current))
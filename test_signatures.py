@@ -0,0 +1,72 @@
+from hashlib import sha1
+import hmac
+from signatures import WebhookVerifier, parse_secrets
+from unittest import TestCase
+from unittest.mock import patch
+
+
+def sign(secret, body):
+    return 'sha1=' + hmac.new(
+        secret.encode('utf-8'), msg=body, digestmod=sha1).hexdigest()
+
+
+class ParseSecretsTest(TestCase):
+    def test_plain(self):
+        self.assertEqual((['foo', 'bar'], {}), parse_secrets('foo, bar'))
+
+    def test_routes(self):
+        self.assertEqual(
+            (['foo', 'bar', 'baz'], {'123': 1, '456': 2}),
+            parse_secrets('foo,123:bar, 456:baz,'))
+
+    def test_secrets_with_colons(self):
+        self.assertEqual(
+            (['a:b', 'c:d:e', 'f:g'], {'123': 2}),
+            parse_secrets('a:b, c:d:e, 123:f:g'))
+
+    def test_empty(self):
+        self.assertEqual(([], {}), parse_secrets(None))
+
+
+class WebhookVerifierTest(TestCase):
+    body = b'{"project_id": 123}'
+
+    def setUp(self):
+        self.verifier = WebhookVerifier.from_config('a, b, 123:c, d')
+
+    def count_hmacs(self, *args):
+        with patch.object(WebhookVerifier, 'matches', autospec=True,
+                          side_effect=WebhookVerifier.matches) as matches:
+            result = self.verifier.verify(*args)
+        return result, matches.call_count
+
+    def test_verifies_any_secret(self):
+        for secret in 'abcd':
+            self.assertTrue(self.verifier.verify(self.body, sign(secret, self.body)))
+
+    def test_rejects(self):
+        self.assertFalse(self.verifier.verify(self.body, sign('x', self.body)))
+        self.assertFalse(self.verifier.verify(self.body + b' ', sign('a', self.body)))
+        self.assertFalse(self.verifier.verify(self.body, None))
+        self.assertFalse(self.verifier.verify(self.body, 'xxx'))
+        self.assertFalse(self.verifier.verify(
+            self.body, sign('a', self.body).replace('sha1=', 'sha256=')))
+
+    def test_configured_route_computes_one_hmac(self):
+        self.assertEqual((True, 1), self.count_hmacs(
+            self.body, sign('c', self.body), 123))
+
+    def test_wrong_route_falls_back(self):
+        self.assertEqual((True, 4), self.count_hmacs(
+            self.body, sign('d', self.body), 123))
+
+    def test_learns_route(self):
+        self.assertEqual((True, 4), self.count_hmacs(
+            self.body, sign('d', self.body), 789))
+        self.assertEqual((True, 1), self.count_hmacs(
+            self.body, sign('d', self.body), '789'))
+
+    def test_failures_not_learned(self):
+        self.assertEqual((False, 4), self.count_hmacs(
+            self.body, sign('x', self.body), 789))
+        self.assertEqual({}, self.verifier.learned)
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import tracing
+from unittest import TestCase
+
+
+class TracingTest(TestCase):
+    def setUp(self):
+        tracing.reset()
+
+    def logged(self, cm):
+        return [json.loads(r.getMessage()) for r in cm.records]
+
+    def test_trace_logs_spans(self):
+        with self.assertLogs('optimizely-changes.tracing') as cm:
+            with tracing.trace('webhook', event='x') as t:
+                with tracing.span('a', bytes=3):
+                    with tracing.span('b') as s:
+                        s.set(count=2)
+                t.set(project_id=1)
+
+        [record] = self.logged(cm)
+        self.assertEqual('webhook', record['trace'])
+        self.assertEqual('x', record['event'])
+        self.assertEqual(1, record['project_id'])
+        self.assertEqual(['b', 'a'], [s['name'] for s in record['spans']])
+        self.assertEqual(2, record['spans'][0]['count'])
+        self.assertEqual(3, record['spans'][1]['bytes'])
+        self.assertGreaterEqual(record['ms'], record['spans'][1]['ms'])
+
+    def test_annotate_and_timed(self):
+        @tracing.timed('work')
+        def work(n):
+            tracing.annotate(n=n)
+            return n * 2
+
+        tracing.annotate(ignored=True)
+        with self.assertLogs('optimizely-changes.tracing') as cm:
+            with tracing.trace('webhook'):
+                self.assertEqual(4, work(2))
+        [record] = self.logged(cm)
+        self.assertEqual([{'name': 'work', 'n': 2}],
+                         [{k: v for k, v in s.items() if k != 'ms'}
+                          for s in record['spans']])
+
+    def test_error(self):
+        with self.assertLogs('optimizely-changes.tracing') as cm:
+            with self.assertRaises(ValueError):
+                with tracing.trace('webhook'):
+                    with tracing.span('a'):
+                        raise ValueError()
+        [record] = self.logged(cm)
+        self.assertEqual('ValueError', record['spans'][0]['error'])
+
+    def test_bind(self):
+        def work():
+            with tracing.span('worker'):
+                pass
+            return tracing.current()
+
+        with ThreadPoolExecutor(1) as pool, \
+             self.assertLogs('optimizely-changes.tracing') as cm:
+            with tracing.trace('webhook') as t:
+                self.assertIs(t, pool.submit(tracing.bind(work)).result())
+            self.assertIsNone(pool.submit(work).result())
+        [record] = self.logged(cm)
+        self.assertEqual(['worker'], [s['name'] for s in record['spans']])
+
+    def test_totals(self):
+        for _ in range(3):
+            with tracing.span('a'):
+                pass
+        count, total, longest = tracing.totals('a')
+        self.assertEqual(3, count)
+        self.assertGreaterEqual(total, longest)
+        self.assertEqual((0, 0.0, 0.0), tracing.totals('b'))
+        self.assertIsNone(tracing.current())
@@ -0,0 +1,160 @@
+# Per-stage timings for webhooks. A trace covers one webhook; spans inside
+# it time the stages (signature check, GCS reads and writes, CDN fetch,
+# diff, notify) and carry a few counts such as bytes moved. Each finished
+# trace is logged as one structured line, and every span is also added to
+# process-wide totals, so the overhead is a couple of clock reads and an
+# append per stage.
+#
+# Spans outside a trace (e.g. notifications sent from the coalescer's
+# timer) only go to the totals.
+from contextlib import contextmanager
+from functools import wraps
+import json
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('optimizely-changes.tracing')
+
+_local = threading.local()
+
+# name -> [count, total seconds, max seconds]
+_totals = {}
+_lock = threading.Lock()
+
+
+class Span(object):
+    __slots__ = ('name', 'fields', 'seconds')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.seconds = None
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def record(self):
+        r = {'name': self.name, 'ms': round(self.seconds * 1000, 3)}
+        r.update(self.fields)
+        return r
+
+
+class Trace(object):
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.spans = []
+        self.seconds = None
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def record(self):
+        r = {
+            'trace': self.name,
+            'ms': round(self.seconds * 1000, 3),
+            'spans': [s.record() for s in self.spans],
+        }
+        r.update(self.fields)
+        return r
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+def stack():
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    return _local.spans
+
+
+@contextmanager
+def trace(name, **fields):
+    t = Trace(name, fields)
+    previous = current()
+    _local.trace = t
+    start = time.perf_counter()
+    try:
+        yield t
+    finally:
+        t.seconds = time.perf_counter() - start
+        _local.trace = previous
+        logger.info(json.dumps(t.record(), sort_keys=True, default=str))
+
+
+@contextmanager
+def span(name, **fields):
+    s = Span(name, fields)
+    spans = stack()
+    spans.append(s)
+    start = time.perf_counter()
+    try:
+        yield s
+    except Exception as e:
+        s.fields['error'] = type(e).__name__
+        raise
+    finally:
+        s.seconds = time.perf_counter() - start
+        spans.pop()
+        finish(s)
+
+
+def finish(s):
+    with _lock:
+        totals = _totals.get(s.name)
+        if totals is None:
+            totals = _totals[s.name] = [0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += s.seconds
+        totals[2] = max(totals[2], s.seconds)
+
+    t = current()
+    if t is not None:
+        t.spans.append(s)
+
+
+def annotate(**fields):
+    # Adds fields to the innermost open span on this thread, if any.
+    spans = stack()
+    if spans:
+        spans[-1].fields.update(fields)
+
+
+def timed(name):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(f):
+    # Carries the calling thread's trace over to wherever `f` is run, e.g.
+    # a worker thread.
+    t = current()
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _local.trace = t
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _local.trace = previous
+    return wrapper
+
+
+def totals(name):
+    # (count, total seconds, max seconds) for every span called `name`.
+    with _lock:
+        return tuple(_totals.get(name, (0, 0.0, 0.0)))
+
+
+def reset():
+    with _lock:
+        _totals.clear()